@@ -0,0 +1,130 @@
+# %%
+# Compare the float64 master file with the compact float32 one (storage.compact_frame): the time and peak memory of making
+# the region and world sums and the expectations from it, and how far the compact results are from the float64 ones.
+# Each variant runs in a fresh process so the peak RSS readings are independent.
+# Run from the repository root:  python benchmarks/bench_compact_master.py [--scale 10] [--rtol 1e-4]
+import argparse
+import contextlib
+import io
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_master_assembly import load_inputs
+
+# %%
+# the master file with regions, from the pipeline's region mapping for the full dataset or synthetic regions
+def make_master(scale, seed):
+
+    import aggregate
+    import synthetic
+
+    inputs, source = load_inputs(scale, seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        master = aggregate.assemble_master(*aggregate.make_master_blocks(inputs['coal'], inputs['gas'], None, inputs['tong'], inputs['scen']))
+
+    if source == 'full dataset':
+        master = aggregate.add_regions(master)
+        credence = None
+    else:
+        master.insert(1, 'region', synthetic.make_regions(synthetic.make_countries(200 * scale)).reindex(master['country']).to_numpy())
+        credence = synthetic.make_credences(seed = seed)
+
+    return(master, credence, source)
+
+# %%
+def run_variant(variant, scale, seed, queue):
+
+    from expectations import make_expectations_over_levels
+    from storage import compact_frame, compact_view
+    from rollup import Rollup
+
+    master, credence, source = make_master(scale, seed)
+
+    # ru_maxrss is in kB on linux, so the variant's own peak is the growth of the peak over the one reached building the master file
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+
+    # as master.py, with and without --compact (where the float64 master is dropped once it is compacted)
+    data = master if variant == 'float64' else compact_view(compact_frame(master))
+    del master
+    rollup = Rollup(data)
+    rgn_data, world_totals = rollup['region'], rollup['world']
+
+    expectations = make_expectations_over_levels(data, ['country', 'region', 'world'], ['Central'], credence)['Central']
+
+    seconds = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    frame_mb = sum(df.memory_usage(deep = True).sum() for df in [data, rgn_data, world_totals]) / 2 ** 20
+
+    queue.put({'variant': variant, 'source': source, 'shape': data.shape, 'seconds': seconds, 'frames_mb': frame_mb,
+               'peak_rss_mb': rss_after / 1024, 'rss_growth_mb': (rss_after - rss_before) / 1024,
+               'results': {'region sums': rgn_data, 'world sums': world_totals, 'region expectation': expectations['region'],
+                           'world expectation': expectations['world']}})
+
+# %%
+# the largest difference of a compact result from the float64 one, relative to the largest value of its column
+def compare(reference, compact, keys):
+
+    ref = reference.set_index([reference[key].astype(str) for key in keys]).drop(columns = keys)
+    cmp = compact.set_index([compact[key].astype(str) for key in keys]).drop(columns = keys)
+
+    cols = [col for col in ref.columns if col in cmp.columns and pd.api.types.is_numeric_dtype(ref[col])]
+    ref, cmp = ref[cols].to_numpy(dtype = float), cmp.reindex(ref.index)[cols].to_numpy(dtype = float)
+
+    scale = np.nanmax(np.abs(ref), axis = 0)
+    scale[~(scale > 0)] = 1
+
+    return(float(np.nanmax(np.abs(cmp - ref) / scale)) if ref.size else 0.0)
+
+# %%
+def main():
+
+    parser = argparse.ArgumentParser(description = 'runtime, peak RSS and accuracy of the compact float32 master file against the float64 one')
+    parser.add_argument('--scale', type = int, default = 1, help = 'multiplier on the synthetic countries and plants (ignored for the full dataset)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--rtol', type = float, default = 1e-4, help = 'the largest error, relative to the largest value of a column, the compact results may have')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = {}
+
+    for variant in ['float64', 'compact']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target = run_variant, args = (variant, args.scale, args.seed, queue))
+        proc.start()
+        results[variant] = queue.get()
+        proc.join()
+
+    ref, cmp = results['float64'], results['compact']
+    print(f"region/world sums and expectations of the master file on {ref['source']}, {ref['shape'][0]} rows x {ref['shape'][1]} columns")
+    for r in [ref, cmp]:
+        print(f"{r['variant']:>8}: {r['seconds']:7.2f} s, frames {r['frames_mb']:8.1f} MB, peak RSS {r['peak_rss_mb']:8.1f} MB, growth {r['rss_growth_mb']:8.1f} MB")
+    print(f"   delta: {cmp['seconds'] - ref['seconds']:+7.2f} s, frames {cmp['frames_mb'] - ref['frames_mb']:+8.1f} MB, "
+          f"peak RSS {cmp['peak_rss_mb'] - ref['peak_rss_mb']:+8.1f} MB, growth {cmp['rss_growth_mb'] - ref['rss_growth_mb']:+8.1f} MB")
+
+    # the tolerance check of the compact results against the float64 ones
+    failed = []
+    for name, reference in ref['results'].items():
+        keys = [key for key in ['region', 'SSP', 'RCP'] if key in reference.columns]
+        error = compare(reference, cmp['results'][name], keys)
+        print(f"{name:>20}: max relative error {error:.2e}")
+        if not error <= args.rtol:
+            failed.append(name)
+
+    if failed:
+        raise SystemExit(f'the compact results are off by more than {args.rtol} for: {", ".join(failed)}')
+    print(f'all compact results within {args.rtol} of the float64 ones')
+
+# %%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# %%
+# Compare the peak memory of assembling the master file with the old chain of outer merges against the indexed
+# column assembly in aggregate.assemble_master. Each variant runs in a fresh process so the peak RSS readings are independent.
+# Run from the repository root:  python benchmarks/bench_master_assembly.py [--scale 10]
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+from functools import reduce
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# %%
+# the cleaned inputs written by the pipeline stages, used when they exist (and aren't git-lfs pointers)
+DATA_FILES = {'coal': 'data/coal_panel.csv', 'gas': 'data/gas_panel.csv', 'tong': 'data/tong_country_sector_CO2.csv', 'scen': 'data/scen_CO2_cntry.csv'}
+
+# %%
+def is_lfs_pointer(path):
+    with open(path, 'rb') as f:
+        return(f.read(40).startswith(b'version https://git-lfs'))
+
+# %%
+def load_inputs(scale, seed):
+
+    if all(os.path.exists(path) and not is_lfs_pointer(path) for path in DATA_FILES.values()):
+        inputs = {name: pd.read_csv(path, index_col = 0) for name, path in DATA_FILES.items()}
+        return(inputs, 'full dataset')
+
+    import synthetic
+
+    # roughly the size of the real data at scale 1: ~200 countries, ~10,000 coal and ~7,000 gas plants
+    countries = synthetic.make_countries(200 * scale)
+    inputs = {'coal': synthetic.make_gem_plants(10000 * scale, countries, seed = seed),
+              'gas': synthetic.make_gem_plants(7000 * scale, countries, statuses = ['operating', 'construction', 'announced', 'pre-construction'], seed = seed + 1),
+              'tong': synthetic.make_tong_panel(countries[:int(len(countries) * 0.7)], seed = seed),
+              'scen': synthetic.make_scenarios(countries[:int(len(countries) * 0.9)], seed = seed)}
+
+    return(inputs, f'synthetic data at scale {scale}')
+
+# %%
+# the assembly aggregate_to_master used before: one outer merge per block, each copying the growing wide frame
+def legacy_assemble_master(scenario_CO2_2021_on, expectable, country_blocks):
+    master = pd.merge(scenario_CO2_2021_on, expectable, on = ['country', 'RCP', 'SSP'], how = 'outer')
+    master = reduce(lambda left, right: pd.merge(left, right, on = 'country', how = 'outer'), [master] + country_blocks)
+    return(master.fillna(0))
+
+# %%
+def run_variant(variant, scale, seed, queue):
+
+    import aggregate
+
+    inputs, source = load_inputs(scale, seed)
+    blocks = aggregate.make_master_blocks(inputs['coal'], inputs['gas'], None, inputs['tong'], inputs['scen'])
+    del inputs
+
+    # ru_maxrss is in kB on linux, so the assembly's own peak is the growth of the peak over the one reached building the blocks
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if variant == 'merge chain':
+        master = legacy_assemble_master(*blocks)
+    else:
+        master = aggregate.assemble_master(*blocks)
+    seconds = time.perf_counter() - start
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    queue.put({'variant': variant, 'source': source, 'shape': master.shape, 'seconds': seconds, 
+               'peak_rss_mb': rss_after / 1024, 'assembly_rss_growth_mb': (rss_after - rss_before) / 1024})
+
+# %%
+def main():
+
+    parser = argparse.ArgumentParser(description = 'peak RSS of assembling the master file, merge chain vs indexed assembly')
+    parser.add_argument('--scale', type = int, default = 1, help = 'multiplier on the synthetic countries and plants (ignored for the full dataset)')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = []
+
+    for variant in ['merge chain', 'indexed assembly']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target = run_variant, args = (variant, args.scale, args.seed, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+
+    print(f"master assembly on {results[0]['source']}, {results[0]['shape'][0]} rows x {results[0]['shape'][1]} columns")
+    for r in results:
+        print(f"{r['variant']:>17}: {r['seconds']:7.2f} s, peak RSS {r['peak_rss_mb']:8.1f} MB, growth during assembly {r['assembly_rss_growth_mb']:8.1f} MB")
+
+# %%
+if __name__ == "__main__":
+    main()
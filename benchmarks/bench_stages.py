@@ -0,0 +1,283 @@
+# %%
+# Time and memory-profile every stage of the pipeline, from countrynamefix to plot_data, on seeded synthetic raw inputs
+# (synthetic.make_raw_gem, make_raw_tong, make_raw_primap, ...) at several scales of the countries and plants, and store the
+# results as JSON, so the scaling of each stage can be read off and a run can be compared against an earlier one.
+# Each scale runs in a fresh process, in a temporary directory holding its own data/ (the stages read and write there),
+# so the real data/ is never touched and the memory readings of one scale don't carry over into the next.
+# Run from the repository root:  python benchmarks/bench_stages.py [--scales 1 10 100] [--compare benchmarks/results/stages_OLD.json]
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# %%
+# the size of the raw inputs at scale 1, roughly that of the real files: ~200 countries, the GEM trackers with their
+# retired and cancelled plants, and the scenario subset (one source and entity, 3 models)
+BASE_SIZES = {'countries': 200, 'coal': 13000, 'gas': 9000, 'steel': 1500}
+
+# %%
+# the resident memory of this process in MB, from /proc where there is one, or else its peak so far
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20)
+    except OSError:
+        return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+# %%
+# sample the resident memory on a thread while a stage runs, keeping the highest reading
+# (a stage's temporary arrays are freed by the time it returns, so the memory after it says little about its peak)
+class RssSampler:
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.peak = rss_mb()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target = self.sample, daemon = True)
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self.thread.start()
+        return(self)
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+# %%
+# the (rows, columns) of a stage's output, or of each of its outputs
+def output_shape(result):
+    if isinstance(result, pd.DataFrame):
+        return(list(result.shape))
+    if isinstance(result, tuple):
+        return([output_shape(part) for part in result])
+    return(None)
+
+# %%
+# run one stage (with its printing silenced) and record its time, and how far the resident memory rose above where it started
+def measure(records, stage, func, *args, **kwargs):
+
+    gc.collect()
+    rss_start = rss_mb()
+
+    with RssSampler() as sampler, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+    records.append({'stage': stage, 'seconds': seconds, 'rss_start_mb': rss_start, 'rss_peak_mb': sampler.peak,
+                    'rss_growth_mb': sampler.peak - rss_start, 'output': output_shape(result)})
+
+    return(result)
+
+# %%
+# write the synthetic raw inputs of a scale into data/ of the working directory, where the pipeline reads them
+def write_inputs(scale, seed):
+
+    import synthetic
+
+    sizes = {name: size * scale for name, size in BASE_SIZES.items()}
+    countries = synthetic.make_countries(sizes['countries'])
+
+    coal, gas, steel = synthetic.make_raw_gem(countries, sizes['coal'], sizes['gas'], sizes['steel'], seed = seed)
+    emit_int, utilization = synthetic.make_steel_weights(countries, seed = seed)
+    # the scenarios and Tong panel miss some countries, like the real files do
+    tong = synthetic.make_raw_tong(countries[:int(len(countries) * 0.7)], seed = seed)
+    scen = synthetic.make_raw_primap(countries[:int(len(countries) * 0.9)], seed = seed)
+    regions = synthetic.make_regions(countries).rename_axis('country').reset_index()
+    regions.insert(1, 'short', regions['country'].str[-3:])
+
+    os.makedirs('data/tong_committed_emissions', exist_ok = True)
+    synthetic.make_name_mapping(countries).to_csv('data/accurate_cntry_name_mapping.csv', index = False)
+    coal.to_csv('data/GEM_coalplants_july2022.csv', index = False)
+    gas.to_csv('data/GEM_gasplants_august2022.csv', index = False)
+    steel.to_csv('data/GEM_steelplants_march2022.csv', index = False)
+    emit_int.to_csv('data/emit_int_weights.csv')
+    utilization.to_csv('data/utilization_rt_weights.csv')
+    tong.to_csv('data/tong_committed_emissions/tong_panel.csv', index = False)
+    scen.to_csv('data/Guetschow_PMSSPBIE_KYOTOGHGAR4_subset.csv', index = False)
+    regions.to_csv('data/cntry_short_region_map.csv', index = False)
+    synthetic.make_credences(seed = seed).to_csv('data/credences-venmans-carr.csv', index = False)
+
+    return({**sizes, 'tong_rows': len(tong), 'scenario_rows': len(scen), 'scenario_years': int(scen.columns.str.fullmatch(r'\d{4}').sum())})
+
+# %%
+# run every stage of the pipeline on one scale, in the order master.py runs them
+def run_scale(scale, seed, plot_rows, queue):
+
+    from countrynamefix import countrynamefix
+    from rcp_ssp import clean_scen_CO2
+    from tong import clean_tong
+    from clean_gem import format_GEM
+    from aggregate import format_consid_commit, aggregate_to_master, widen_master
+    from expectations import make_expectation_over_data
+    from plotting import plot_data
+    from rollup import Rollup
+    from lock_in import make_lock_in
+
+    with tempfile.TemporaryDirectory(prefix = 'bench_stages_') as workdir:
+        os.chdir(workdir)
+
+        start = time.perf_counter()
+        sizes = write_inputs(scale, seed)
+        write_seconds = time.perf_counter() - start
+
+        records = []
+        tong_fix, scen_fix, coal_fix, gas_fix, steel_fix = measure(records, 'countrynamefix', countrynamefix)
+        scen = measure(records, 'clean_scen_CO2', clean_scen_CO2, scen_fix)
+        tong = measure(records, 'clean_tong', clean_tong, tong_fix)
+        coal, gas, steel = measure(records, 'format_GEM', format_GEM, coal_fix, gas_fix, steel_fix)
+        for asset, plants in [('coal', coal), ('gas', gas), ('steel', steel)]:
+            measure(records, f'format_consid_commit[{asset}]', format_consid_commit, plants, asset)
+        tables = measure(records, 'aggregate_to_master', aggregate_to_master, coal, gas, steel, tong, scen)
+        master = measure(records, 'widen_master', widen_master, tables)
+        for level, area in [('country', 'country'), ('region', 'region'), ('world', ['SSP', 'RCP'])]:
+            measure(records, f'make_expectation_over_data[{level}]', make_expectation_over_data, master, area)
+        measure(records, 'make_lock_in', make_lock_in, Rollup(master))
+
+        # the number of figures grows with the scale too, but plot_data clips its data in place so it gets a copy
+        if plot_rows:
+            os.makedirs('plots', exist_ok = True)
+            rows = master.iloc[:plot_rows * scale].reset_index(drop = True).copy()
+            measure(records, 'plot_data', plot_data, rows, 'raw', 'bench_', 'plots/', n_workers = 1)
+            records[-1]['figures'] = len(rows)
+
+        os.chdir('/')
+
+    queue.put({'scale': scale, 'sizes': {**sizes, 'master_rows': master.shape[0], 'master_cols': master.shape[1]},
+               'write_inputs_seconds': write_seconds, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'stages': records})
+
+# %%
+# wait for the result of a scale's process, or None if it dies without one (e.g. killed for running out of memory at a large scale)
+def wait_for(proc, queue):
+    while True:
+        try:
+            return(queue.get(timeout = 1))
+        except queue_module.Empty:
+            if not proc.is_alive():
+                return(None)
+
+# %%
+# the environment the results were measured in
+def describe_run(label, seed):
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return({'label': label or commit or 'local', 'commit': commit, 'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'seed': seed, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count()})
+
+# %%
+# compare the stages of two results files, scale by scale
+# a stage regressed when it got more than tolerance slower (or grew more than tolerance more memory), and by more than
+# min_seconds (or min_mb), so the noise of the fastest stages isn't flagged
+def compare(old, new, tolerance, min_seconds = 0.05, min_mb = 10):
+
+    old_stages = {(run['scale'], rec['stage']): rec for run in old['runs'] for rec in run['stages']}
+
+    rows, regressions = [], []
+    for run in new['runs']:
+        for rec in run['stages']:
+            prev = old_stages.get((run['scale'], rec['stage']))
+            if prev is None:
+                continue
+
+            for metric, floor in [('seconds', min_seconds), ('rss_growth_mb', min_mb)]:
+                ratio = rec[metric] / prev[metric] if prev[metric] > 0 else (np.inf if rec[metric] > 0 else 1.0)
+                regressed = rec[metric] > prev[metric] * (1 + tolerance) and rec[metric] - prev[metric] > floor
+                rows.append({'scale': run['scale'], 'stage': rec['stage'], 'metric': metric, 'old': prev[metric], 'new': rec[metric],
+                             'ratio': ratio, 'regressed': regressed})
+                if regressed:
+                    regressions.append(f"{rec['stage']} {metric} at scale {run['scale']}")
+
+    return(pd.DataFrame(rows), regressions)
+
+# %%
+def main():
+
+    parser = argparse.ArgumentParser(description = 'runtime and peak memory of every pipeline stage on synthetic inputs at several scales')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1, 10, 100], help = 'multipliers on the synthetic countries and plants')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--plot-rows', type = int, default = 20, help = 'rows of the master file plot_data draws per unit of scale, 0 skips it')
+    parser.add_argument('--label', help = 'the name of this run in its results file (default: the current commit)')
+    parser.add_argument('--out', help = 'where to write the results (default: benchmarks/results/stages_LABEL.json)')
+    parser.add_argument('--compare', metavar = 'PATH', help = 'an earlier results file to check this run against')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'the fraction a stage may get slower (or use more memory) before it counts as a regression')
+    args = parser.parse_args()
+
+    results = {**describe_run(args.label, args.seed), 'runs': []}
+
+    ctx = mp.get_context('spawn')
+    for scale in args.scales:
+        queue = ctx.Queue()
+        proc = ctx.Process(target = run_scale, args = (scale, args.seed, args.plot_rows, queue))
+        proc.start()
+        run = wait_for(proc, queue)
+        proc.join()
+
+        if run is None:
+            print(f'scale {scale}: the benchmark process exited with code {proc.exitcode} before finishing, its stages are left out')
+            results['failed'] = results.get('failed', []) + [{'scale': scale, 'exitcode': proc.exitcode}]
+            continue
+        results['runs'].append(run)
+
+        sizes = run['sizes']
+        print(f"scale {scale}: {sizes['countries']} countries, {sizes['coal']} coal, {sizes['gas']} gas and {sizes['steel']} steel plants, "
+              f"{sizes['scenario_rows']} scenario rows, master {sizes['master_rows']} x {sizes['master_cols']}, peak RSS {run['peak_rss_mb']:.0f} MB")
+        for rec in run['stages']:
+            print(f"  {rec['stage']:>36}: {rec['seconds']:8.2f} s, peak RSS growth {rec['rss_growth_mb']:8.1f} MB")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"stages_{results['label']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok = True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print(f'results written to {out}')
+
+    # the scaling of each stage: its time at every scale over its time at the smallest one
+    if len(results['runs']) > 1:
+        seconds = pd.DataFrame({run['scale']: {rec['stage']: rec['seconds'] for rec in run['stages']} for run in results['runs']})
+        print('time relative to the smallest scale:')
+        print(seconds.div(seconds.iloc[:, 0], axis = 0).round(1).to_string())
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        table, regressions = compare(old, results, args.tolerance)
+        print(f"against {old['label']} ({old['created']}):")
+        print(table.to_string(index = False, float_format = lambda x: f'{x:.3g}'))
+        if regressions:
+            raise SystemExit(f'{len(regressions)} regressions of more than {args.tolerance:.0%}: {", ".join(regressions)}')
+        print(f'no stage regressed by more than {args.tolerance:.0%}')
+
+# %%
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# %%
+# seeded generators for synthetic inputs shaped like the cleaned pipeline data, used when the real files aren't available
+import pandas as pd
+import numpy as np
+
+# %%
+def make_countries(n_countries):
+    return([f'Country {i:03d}' for i in range(n_countries)])
+
+# %%
+# GEM-shaped plant table, as returned by format_GEM: one row per plant with its country, status, start/retirement years and CO2
+def make_gem_plants(n_plants, countries, statuses = ['operating', 'construction', 'pre-permit', 'announced', 'permitted'], seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    start = rng.integers(1960, 2040, n_plants).astype(float)
+    retire = start + 40
+
+    # some plants list their own retirement year
+    listed = rng.random(n_plants) < 0.3
+    retire[listed] = start[listed] + rng.integers(10, 60, listed.sum())
+
+    plants = pd.DataFrame({'country': rng.choice(countries, n_plants), 
+                           'Status': rng.choice(statuses, n_plants, p = np.linspace(2, 1, len(statuses)) / np.linspace(2, 1, len(statuses)).sum()), 
+                           'Start year': start, 
+                           'Planned retire': retire, 
+                           'Capacity (MW)': rng.gamma(2, 300, n_plants)})
+    plants['CO2 (Mt/yr)'] = plants['Capacity (MW)'] * rng.uniform(0.002, 0.008, n_plants)
+
+    return(plants)
+
+# %%
+# Tong-shaped sector panel, as returned by clean_tong: one row per country and a '{Sector}.{Year}' column per sector and year
+def make_tong_panel(countries, years = np.arange(2021, 2101), sectors = ['Electricity', 'Industry', 'Other energy', 'Residential', 'Transport'], seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    # committed emissions decline linearly from a random 2021 level to 0 by a random end year
+    level = rng.gamma(1, 50, (len(countries), len(sectors), 1))
+    end_yr = rng.integers(2040, 2101, (len(countries), len(sectors), 1))
+    values = level * np.clip((end_yr - years) / (end_yr - years[0]), 0, 1)
+
+    panel = pd.DataFrame(values.reshape(len(countries), -1), columns = [f'{s}.{y}' for s in sectors for y in years])
+    panel.insert(0, 'country', countries)
+
+    return(panel)
+
+# %%
+# PRIMAP-shaped scenario table, as returned by clean_scen_CO2: one row per country/SSP/RCP with a column per year from 1850
+# (with the SSP and RCP as the typed keys clean_scen_CO2 gives them, so src has to be on the path)
+def make_scenarios(countries, ssps = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5'], rcps = [1.9, 2.6, 3.4, 4.5, 6.0, 'BL'], years = np.arange(1850, 2101), seed = 0):
+    from rcp_ssp import as_scen_keys
+
+    rng = np.random.default_rng(seed)
+
+    keys = as_scen_keys(pd.MultiIndex.from_product([countries, ssps, rcps], names = ['country', 'SSP', 'RCP']).to_frame(index = False))
+
+    # emissions grow until a peak year and then fall towards a scenario specific level
+    level = rng.gamma(1, 100, (len(keys), 1))
+    peak = rng.integers(2010, 2080, (len(keys), 1))
+    values = level * np.where(years < peak, np.exp((years - peak) / 60), 1 - rng.uniform(0, 1.2, (len(keys), 1)) * (years - peak) / (2100 - peak + 1))
+
+    scen = pd.concat([keys, pd.DataFrame(values, columns = [str(y) for y in years])], axis = 1)
+
+    # pad with one numeric column before the years, like the index column the subset file carries
+    scen.insert(3, 'Unnamed: 0', np.arange(len(scen)))
+
+    return(scen)
+
+# %%
+# a region for every country, like data/cntry_short_region_map.csv gives them
+def make_regions(countries, n_regions = 10):
+    return(pd.Series([f'Region {i % n_regions}' for i in range(len(countries))], index = countries, name = 'region'))
+
+# %%
+# credences-venmans-carr.csv-shaped credences: the weights of each SSP/RCP pair, 0 for some pairs like the real file
+def make_credences(ssps = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5'], rcps = [1.9, 2.6, 3.4, 4.5, 6.0, 'BL'], seed = 0):
+    from rcp_ssp import as_scen_keys
+
+    rng = np.random.default_rng(seed)
+
+    credence = pd.MultiIndex.from_product([ssps, rcps], names = ['SSP', 'RCP']).to_frame(index = False)
+    for weight in ['Central', 'Optimistic', 'Pessimistic']:
+        weights = rng.uniform(0, 1, len(credence)) * (rng.uniform(0, 1, len(credence)) > 0.2)
+        credence[weight] = weights / weights.sum()
+
+    return(as_scen_keys(credence))
+
+# %% [markdown]
+# ### Raw inputs
+# Seeded stand-ins for the raw files in data/, with the columns (and the messy year fields, alternative country spellings and
+# statuses the pipeline filters out) of the real ones, so every stage from countrynamefix on can run on them.
+
+# %%
+# accurate_cntry_name_mapping.csv-shaped mapping: every country's accurate name, and an alternative spelling of it
+def make_name_mapping(countries):
+
+    names = np.repeat(countries, 2)
+    alts = np.array([[name, name.replace('Country', 'Ctry.')] for name in countries]).ravel()
+
+    return(pd.DataFrame({'country.name.en': names, 'country.name.alt': alts}))
+
+# %%
+# a country column spelling about a third of the countries the alternative way, like the raw files disagree with each other
+def spell_countries(countries, rng):
+    countries = np.asarray(countries, dtype = object)
+    return(np.where(rng.random(len(countries)) < 0.3, [name.replace('Country', 'Ctry.') for name in countries], countries))
+
+# %%
+# year fields like GEM writes them: mostly plain years, some ranges, planning windows, decades, lists, plans and junk, some missing
+def make_year_field(years, rng, missing = 0.1):
+
+    years = np.asarray(years).astype(int)
+    field = years.astype(str).astype(object)
+
+    kind = rng.choice(['year', 'range', 'window', 'decade', 'list', 'plan', 'junk', 'missing'], len(years),
+                      p = np.append(np.array([0.8, 0.04, 0.04, 0.03, 0.03, 0.02, 0.04]) * (1 - missing), missing))
+    field[kind == 'range'] = [f'{y - 3}-{y}' for y in years[kind == 'range']]
+    field[kind == 'window'] = [f'{y - 4}-{(y + 5) % 100:02d}' for y in years[kind == 'window']]
+    field[kind == 'decade'] = [f'{y // 10 * 10}s' for y in years[kind == 'decade']]
+    field[kind == 'list'] = [f'{y}, {y + 40}' for y in years[kind == 'list']]
+    field[kind == 'plan'] = '14th plan'
+    field[kind == 'junk'] = rng.choice(['TBD', 'unknown', '0:00'], (kind == 'junk').sum())
+    field[kind == 'missing'] = np.nan
+
+    return(field)
+
+# %%
+# the raw GEM coal, gas and steel plant trackers, as countrynamefix reads them
+# the steel capacity columns are named so weight_steel finds the weights of make_steel_weights for them
+STEEL_ROUTES = ['crude', 'BOF', 'EAF', 'OHF', 'Iron', 'BF', 'DRI', 'Ferronickel', 'Sinter plant', 'Coking plant', 'Pelletizing']
+
+def make_raw_gem(countries, n_coal, n_gas, n_steel, seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    coal_start = rng.integers(1960, 2040, n_coal)
+    coal = pd.DataFrame({'Country': spell_countries(rng.choice(countries, n_coal), rng),
+                         'Status': rng.choice(['operating', 'construction', 'pre-permit', 'announced', 'permitted', 'retired', 'cancelled', 'shelved'], n_coal),
+                         'Year': make_year_field(coal_start, rng),
+                         'Planned Retire': make_year_field(coal_start + rng.integers(25, 60, n_coal), rng, missing = 0.7),
+                         'Capacity (MW)': rng.gamma(2, 300, n_coal),
+                         'RETIRED': np.where(rng.random(n_coal) < 0.05, coal_start + 30, np.nan)})
+    coal.insert(4, 'Annual CO2 (million tonnes / annum)', coal['Capacity (MW)'] * rng.uniform(0.002, 0.008, n_coal))
+
+    gas_start = rng.integers(1960, 2040, n_gas)
+    gas = pd.DataFrame({'Country': spell_countries(rng.choice(countries, n_gas), rng),
+                        'Status': rng.choice(['operating', 'construction', 'announced', 'pre-construction', 'retired', 'cancelled', 'shelved'], n_gas),
+                        'Start year': make_year_field(gas_start, rng),
+                        'Planned retire': make_year_field(gas_start + rng.integers(25, 60, n_gas), rng, missing = 0.7),
+                        'Capacity elec. (MW)': rng.gamma(2, 200, n_gas)})
+
+    # the steel tracker is read as strings, with its capacities sometimes blank, unknown or '>0'
+    steel_start = rng.integers(1900, 2030, n_steel)
+    steel = pd.DataFrame({'Country': spell_countries(rng.choice(countries, n_steel), rng),
+                          'Status': rng.choice(['operating', 'construction', 'proposed', 'retired', 'mothballed'], n_steel),
+                          'Start year': make_year_field(steel_start, rng),
+                          'Closed/idled year': make_year_field(steel_start + 60, rng, missing = 0.9),
+                          'Plant age (years)': np.where(rng.random(n_steel) < 0.5, (2022 - steel_start).astype(str), 'unknown')})
+    for route in STEEL_ROUTES:
+        capacity = rng.gamma(1, 1000, n_steel).round().astype(int).astype(str).astype(object)
+        capacity[rng.random(n_steel) < 0.5] = np.nan
+        capacity[rng.random(n_steel) < 0.05] = rng.choice([' ', 'unknown', '>0'], 1)[0]
+        steel[f'Nominal {route} capacity (ttpa)'] = capacity
+
+    return(coal, gas, steel)
+
+# %%
+# the steel weight files weight_steel reads: emissions intensities (emit_int_weights.csv) and capacity utilization
+# rates (utilization_rt_weights.csv) of each production route, for most (but not all) of the countries
+def make_steel_weights(countries, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    weighted = list(np.asarray(countries)[rng.random(len(countries)) < 0.8])
+
+    emit_int = pd.DataFrame({f'{route} emissions intensity': rng.uniform(0.5, 2.5, len(weighted)) for route in STEEL_ROUTES},
+                            index = pd.Index(weighted, name = 'Units: Tonnes of CO2 per tonne of steel'))
+    utilization = pd.DataFrame({f'{route} capacity utilization per annum': rng.uniform(0.5, 0.95, len(weighted)) for route in STEEL_ROUTES}, index = weighted)
+
+    return(emit_int, utilization)
+
+# %%
+# the raw Tong et al. panel (tong_panel.csv): one row per country, sector and year, in GtCO2, with some areas which aren't countries
+def make_raw_tong(countries, years = np.arange(2000, 2101), sectors = ['Electricity', 'Industry', 'Other energy', 'Residential', 'Transport'], seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    panel = make_tong_panel(list(countries) + ['Other Africa', 'Other non-OECD Asia'], years, sectors, seed)
+    tong = panel.melt(id_vars = 'country', var_name = 'column', value_name = 'Yearly Emissions (GtCO2) - derived')
+    tong[['Sector', 'Year']] = tong['column'].str.rsplit('.', n = 1, expand = True)
+    tong['Yearly Emissions (GtCO2) - derived'] /= 1000
+    tong['Country'] = spell_countries(tong.pop('country'), rng)
+
+    return(tong[['Country', 'Year', 'Sector', 'Yearly Emissions (GtCO2) - derived']].astype({'Year': int}))
+
+# %%
+# the raw PRIMAP downscaled scenarios (Guetschow_PMSSPBIE_KYOTOGHGAR4_subset.csv): one row per source, entity, country and
+# scenario, named like 'SSP119IMAGE' (SSP, RCP code and model), in GgCO2eq with a column per year
+# more sources and entities make a file shaped like the full one, which clean_scen_CO2 and stream_scen_CO2 filter
+def make_raw_primap(countries, ssps = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5'], rcps = ['19', '26', '34', '45', '60', 'BL'],
+                    models = ['IMAGE', 'MESGB', 'REMIND'], years = np.arange(1850, 2101), sources = ['PMSSPBIE'], entities = ['KYOTOGHGAR4'], seed = 0):
+
+    rng = np.random.default_rng(seed)
+
+    keys = pd.MultiIndex.from_product([sources, entities, countries, [ssp + rcp + model for ssp in ssps for rcp in rcps for model in models]],
+                                      names = ['source', 'entity', 'country', 'scenario']).to_frame(index = False)
+    keys['country'] = spell_countries(keys['country'], rng)
+    keys['category'] = 'IPC0'
+    keys['unit'] = 'CO2eq * Gg / a'
+
+    # each model wanders around the country's trajectory
+    cntry_scen = make_scenarios(countries, ssps, rcps, years, seed)
+    base = np.repeat(cntry_scen[[str(y) for y in years]].to_numpy(), len(models), axis = 0)
+    values = np.tile(base, (len(sources) * len(entities), 1)) * rng.uniform(800, 1200, (len(keys), 1))
+
+    return(pd.concat([keys, pd.DataFrame(values, columns = [str(y) for y in years])], axis = 1))
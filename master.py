@@ -6,111 +6,190 @@
 
 # import libraries used in in this file, specialized libraries are included in functions
 import pandas as pd
+import argparse
 import warnings
 warnings.filterwarnings('ignore')
 
 # import the data operations from their respective files
 from countrynamefix import countrynamefix
-from rcp_ssp import clean_scen_CO2
+from rcp_ssp import clean_scen_CO2, stream_scen_CO2
 from tong import clean_tong
 from clean_gem import format_GEM
-from aggregate import aggregate_to_master
+from aggregate import aggregate_to_master, widen_master
 from affectability import make_affectability_data
-from expectations import make_expectation_over_data
+from expectations import make_expectations_over_levels
 from plotting import plot_data
+from stage_cache import run_stage
+from ensemble import make_ensemble
+from storage import compact_frame, compact_view
+from rollup import Rollup
+from lock_in import make_lock_in
 
 
 # In[ ]:
 
 
-tong_cntry_fix, scen_cntry_fix, coal_cntry_fix, gas_cntry_fix, steel_cntry_fix = countrynamefix()
-scen_clean = clean_scen_CO2(scen_cntry_fix)
-tong_clean = clean_tong(tong_cntry_fix)
-coal_plants_clean, gas_plants_clean, steel_plants_clean = format_GEM(coal_cntry_fix, gas_cntry_fix, steel_cntry_fix)
-cntry_rgn_data = aggregate_to_master(coal_plants_clean, gas_plants_clean, steel_plants_clean, tong_clean, scen_clean)
+# every stage below is cached in data/.stage_cache under a key made from the files it reads, its parameters, its code,
+# and the keys of the stages it takes data from, so a rerun only re-executes the stages whose inputs changed
+# use --force STAGE (repeatable) to rerun a stage and everything downstream of it anyway, or --force all to rerun everything
+parser = argparse.ArgumentParser(description = 'run the carbon lock-in pipeline')
+parser.add_argument('--force', action = 'append', default = [], metavar = 'STAGE', help = 'rerun this stage even if its cached output is up to date')
+parser.add_argument('--workers', type = int, default = 1, metavar = 'N', help = 'build the master file from country shards on N processes')
+parser.add_argument('--plot-workers', type = int, default = 1, metavar = 'N', help = 'render the plots on N processes')
+parser.add_argument('--ensemble', type = int, default = 0, metavar = 'N', help = 'also draw N Monte Carlo samples and write percentile bands to data/ensemble_bands.csv')
+parser.add_argument('--primap', metavar = 'PATH', help = 'stream the scenarios from the full PRIMAP downscaled file instead of the subset')
+parser.add_argument('--entity', default = 'KYOTOGHGAR4', help = 'the gas basket to take from the PRIMAP file')
+parser.add_argument('--source', default = 'PMSSPBIE', help = 'the downscaling variant to take from the PRIMAP file')
+parser.add_argument('--steel', action = 'store_true', help = 'include the steel plants in the master file (their considered emissions in the considered total)')
+parser.add_argument('--sparse', action = 'store_true', help = 'keep the plant status x year pivots of the master file sparse until it is widened')
+parser.add_argument('--overwrite-lock-in-results', action = 'store_true', help = 'write the lock-in tables over those in data/processed and data/thesis_results_tables instead of to data/lock_in')
+parser.add_argument('--compact', action = 'store_true', help = 'hold the master file as float32 in one (row x metric x year) block, with the region and world sums as views')
+args, _ = parser.parse_known_args()
+force = set(args.force)
+
+# the files each stage reads from disk
+raw_files = ['data/tong_committed_emissions/tong_panel.csv', 'data/Guetschow_PMSSPBIE_KYOTOGHGAR4_subset.csv',
+             'data/GEM_coalplants_july2022.csv', 'data/GEM_gasplants_august2022.csv', 'data/GEM_steelplants_march2022.csv',
+             'data/accurate_cntry_name_mapping.csv']
+steel_weight_files = ['data/emit_int_weights.csv', 'data/utilization_rt_weights.csv']
+region_files = ['data/cntry_short_region_map.csv']
+credence_files = ['data/credences-venmans-carr.csv']
 
 
 # In[ ]:
 
 
-# remove the 8 remaining SSP 0 values 
-# don't remove cred_scen_match, this is necessary for calculating the expectation
-cntry_rgn_data = cntry_rgn_data.iloc[:-8,:]#.drop(columns = 'cred_scen_match')
-
-# make the rgn and world versions
-drop_cntry = cntry_rgn_data.drop(columns = 'country')
-rgn_data = drop_cntry.groupby(by = ['SSP', 'RCP', 'region']).sum().reset_index()
-world_totals = rgn_data.drop(columns = 'region').groupby(by = ['SSP', 'RCP']).sum().reset_index()
+(tong_cntry_fix, scen_cntry_fix, coal_cntry_fix, gas_cntry_fix, steel_cntry_fix), names_key = run_stage('countrynamefix', countrynamefix, files = raw_files, force = force)
+if args.primap:
+    # the full file is streamed in chunks with the country names resolved by the resolver countrynamefix saved
+    scen_clean, scen_key = run_stage('clean_scen_CO2', stream_scen_CO2, args = (args.primap,), params = {'entity': args.entity, 'source': args.source},
+                                     files = [args.primap], upstream = [names_key], force = force)
+else:
+    scen_clean, scen_key = run_stage('clean_scen_CO2', clean_scen_CO2, args = (scen_cntry_fix,), upstream = [names_key], force = force)
+tong_clean, tong_key = run_stage('clean_tong', clean_tong, args = (tong_cntry_fix,), upstream = [names_key], force = force)
+(coal_plants_clean, gas_plants_clean, steel_plants_clean), gem_key = run_stage('format_GEM', format_GEM, args = (coal_cntry_fix, gas_cntry_fix, steel_cntry_fix),
+                                                                               files = steel_weight_files, upstream = [names_key], force = force)
+# the number of workers doesn't change the master file, so it is passed as an argument rather than a parameter of the cache key
+master_tables, master_key = run_stage('aggregate_to_master', aggregate_to_master, args = (coal_plants_clean, gas_plants_clean, steel_plants_clean, tong_clean, scen_clean, args.workers),
+                                       params = {'include_steel': args.steel, 'sparse': args.sparse}, files = region_files, upstream = [scen_key, tong_key, gem_key], force = force)
 
-# aggregate the data by region and country respectively, forming 2 expectations
-expectation_rgn = make_expectation_over_data(cntry_rgn_data, 'region').drop(columns = ['credence', 'posterior', 'p'])
-expectation_cntry = make_expectation_over_data(cntry_rgn_data, 'country').drop(columns = ['credence', 'posterior', 'p'])
-expectation_world = make_expectation_over_data(cntry_rgn_data, ['SSP', 'RCP']).drop(columns = ['credence', 'posterior', 'p'])
+# the Monte Carlo ensemble over plant lifetimes, steel weights and credences, only run when asked for with --ensemble N
+if args.ensemble:
+    ensemble_bands, ensemble_key = run_stage('ensemble', make_ensemble, args = (coal_plants_clean, gas_plants_clean, steel_plants_clean, tong_clean, scen_clean),
+                                             params = {'n_samples': args.ensemble, 'include_steel': args.steel}, files = credence_files, upstream = [scen_key, tong_key, gem_key], force = force)
 
 
 # In[ ]:
 
 
-# make the "affectable" version of the emissions, and fix formatting 
-aff_emits = make_affectability_data(cntry_rgn_data)
+# the rgn and world versions of the data are Rollups (see rollup.py), only summed when a stage which isn't cached reads them
 
-# make the rgn and world versions
-aff_drop_cntry = aff_emits.drop(columns = 'country')
-aff_rgn_data = aff_drop_cntry.groupby(by = ['SSP', 'RCP', 'region']).sum().reset_index()
-aff_world_totals = aff_rgn_data.drop(columns = 'region').groupby(by = ['SSP', 'RCP']).sum().reset_index()
+# the compact version of the data: one float32 (row x metric x year) block with categorical keys, read through a wide df
+# which is a view of the block rather than a copy (its rollups stay float32 too)
+def make_compact(data):
+    return(compact_view(compact_frame(data)))
 
-# as before, aggregate the data by region and country respectively, forming 2 expectations
-aff_expectation_rgn = make_expectation_over_data(aff_emits, 'region')
-aff_expectation_cntry = make_expectation_over_data(aff_emits, 'country')
-aff_expectation_world = make_expectation_over_data(aff_emits, ['SSP', 'RCP']).drop(columns = ['credence', 'posterior', 'p'])
+# weight the data by the credences and sum it by country, region, and for the world, in one pass over the data
+def make_expectations(data, drop_cols = ['credence', 'posterior', 'p']):
+    expectations = make_expectations_over_levels(data, ['country', 'region', 'world'], ['Central'])['Central']
+    expectation_rgn = expectations['region'].drop(columns = drop_cols)
+    expectation_cntry = expectations['country'].drop(columns = drop_cols)
+    expectation_world = expectations['world'].drop(columns = ['credence', 'posterior', 'p'])
+    return(expectation_rgn, expectation_cntry, expectation_world)
 
 
 # In[ ]:
 
 
-cntry_rgn_data[['country','region','SSP','RCP']] = cntry_rgn_data[['country','region','SSP','RCP']].astype(str)
-rgn_data[['SSP','RCP','region']] = rgn_data[['SSP','RCP','region']].astype(str)
-world_totals[['SSP','RCP']] = world_totals[['SSP','RCP']].astype(str)
+# the master file is cached and written normalized (see aggregate.py), the stages below read its wide version
+cntry_rgn_data = widen_master(master_tables)
+
+# remove the 8 remaining SSP 0 values
+# don't remove cred_scen_match, this is necessary for calculating the expectation
+cntry_rgn_data = cntry_rgn_data.iloc[:-8,:]#.drop(columns = 'cred_scen_match')
+
+if args.compact:
+    # a stage of its own, so the stages downstream of it are cached apart from the float64 ones
+    cntry_rgn_data, master_key = run_stage('compact_master', make_compact, args = (cntry_rgn_data,), upstream = [master_key], force = force)
+
+cntry_rollup = Rollup(cntry_rgn_data)
+
+# the expectations only depend on the master data and the credences, so a credence tweak only reruns this and its plots
+(expectation_rgn, expectation_cntry, expectation_world), exp_key = run_stage('expectations', make_expectations, args = (cntry_rgn_data,),
+                                                                             files = credence_files, upstream = [master_key], force = force)
+
+# the lock-in metrics of the country, region and world rows under every scenario and in expectation, and the results tables made from them
+# (written to data/lock_in, or over the notebooks' tables in data/processed and data/thesis_results_tables with --overwrite-lock-in-results)
+lock_in, lock_in_key = run_stage('lock_in', make_lock_in, args = (cntry_rollup,), params = {'overwrite_results': args.overwrite_lock_in_results},
+                                 files = credence_files, upstream = [master_key], force = force)
 
 
 # In[ ]:
 
 
-aff_emits[['country','region','SSP','RCP']] = aff_emits[['country','region','SSP','RCP']].astype(str)
-aff_rgn_data[['SSP','RCP','region']] = aff_rgn_data[['SSP','RCP','region']].astype(str)
-aff_world_totals[['SSP','RCP']] = aff_world_totals[['SSP','RCP']].astype(str)
+# make the "affectable" version of the emissions, and fix formatting
+aff_emits, aff_key = run_stage('affectability', make_affectability_data, args = (cntry_rgn_data,), upstream = [master_key], force = force)
+
+if args.compact:
+    aff_emits = make_compact(aff_emits)
+
+aff_rollup = Rollup(aff_emits)
+
+# as before, aggregate the data by region and country respectively, forming 2 expectations (the affectable ones keep the credence columns)
+(aff_expectation_rgn, aff_expectation_cntry, aff_expectation_world), aff_exp_key = run_stage('aff_expectations', make_expectations, args = (aff_emits, []),
+                                                                                             files = credence_files, upstream = [aff_key], force = force)
 
 
 # In[ ]:
 
 
 # create plots of emissions trajectories in each of the corresponding folders
+# (the keys stay typed, the plots turn them into their labels)
+# the number of plotting processes doesn't change the plots, so it is passed as an argument rather than a parameter of the cache key
+def make_raw_plots(cntry_rollup, n_workers = 1):
+
+    # sum the region and world versions before plotting, the plots clip the data they are given in place
+    rgn_data, world_totals, cntry_rgn_data = cntry_rollup['region'], cntry_rollup['world'], cntry_rollup.data
+
+    # plot the raw country and region level data
+    plot_data(rgn_data, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/rgn_emissions_rcp_ssp_plots/', n_workers = n_workers)
+    plot_data(cntry_rgn_data, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/cntry_emissions_rcp_ssp_plots/', n_workers = n_workers)
+
+    # # plot the data aggregated over the entire world, still raw
+    plot_data(world_totals, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/world_ssp_rcp_emissions/', n_workers = n_workers)
 
-# plot the raw country and region level data
-plot_data(rgn_data, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/rgn_emissions_rcp_ssp_plots/')
-plot_data(cntry_rgn_data, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/cntry_emissions_rcp_ssp_plots/')
+def make_expectation_plots(expectation_rgn, expectation_cntry, n_workers = 1):
 
-# # plot the data aggregated over the entire world, still raw
-plot_data(world_totals, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/world_ssp_rcp_emissions/')
+    # # plot the expectation across countries and regions, respectively
+    plot_data(expectation_rgn, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/rgn_exp_plots/', n_workers = n_workers)
+    plot_data(expectation_cntry, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/cntry_exp_plots/', n_workers = n_workers)
 
-# # plot the expectation across countries and regions, respectively
-plot_data(expectation_rgn, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/rgn_exp_plots/')
-plot_data(expectation_cntry, 'raw', 'Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/cntry_exp_plots/')
+run_stage('raw_plots', make_raw_plots, args = (cntry_rollup, args.plot_workers), upstream = [master_key], force = force)
+run_stage('expectation_plots', make_expectation_plots, args = (expectation_rgn, expectation_cntry, args.plot_workers), upstream = [exp_key], force = force)
 
 
 # In[ ]:
 
 
-# # plot the raw country and region level data
-plot_data(aff_rgn_data, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/aff_rgn_emissions_rcp_ssp_plots/')
-plot_data(aff_emits, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/aff_cntry_emissions_rcp_ssp_plots/')
+def make_aff_raw_plots(aff_rollup, n_workers = 1):
 
-# plot the data aggregated over the entire world, still raw
-plot_data(aff_world_totals, 'affectable', 'Planned, Committed, and Considered Emissions till 2100 ', 'data/plots/aff_world_ssp_rcp_emissions/')
+    aff_rgn_data, aff_world_totals, aff_emits = aff_rollup['region'], aff_rollup['world'], aff_rollup.data
 
-# plot the expectation across countries and regions, respectively
-plot_data(aff_expectation_rgn, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/aff_rgn_exp_plots/')
-plot_data(aff_expectation_cntry, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/aff_cntry_exp_plots/')
+    # # plot the raw country and region level data
+    plot_data(aff_rgn_data, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/aff_rgn_emissions_rcp_ssp_plots/', n_workers = n_workers)
+    plot_data(aff_emits, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_', 'data/plots/aff_cntry_emissions_rcp_ssp_plots/', n_workers = n_workers)
+
+    # plot the data aggregated over the entire world, still raw
+    plot_data(aff_world_totals, 'affectable', 'Planned, Committed, and Considered Emissions till 2100 ', 'data/plots/aff_world_ssp_rcp_emissions/', n_workers = n_workers)
+
+def make_aff_expectation_plots(aff_expectation_rgn, aff_expectation_cntry, n_workers = 1):
+
+    # plot the expectation across countries and regions, respectively
+    plot_data(aff_expectation_rgn, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/aff_rgn_exp_plots/', n_workers = n_workers)
+    plot_data(aff_expectation_cntry, 'affectable', 'Affectable_Planned_Committed_and_Considered_Emissions_till_2100_in_expectation', 'data/plots/aff_cntry_exp_plots/', n_workers = n_workers)
+
+run_stage('aff_raw_plots', make_aff_raw_plots, args = (aff_rollup, args.plot_workers), upstream = [aff_key], force = force)
+run_stage('aff_expectation_plots', make_aff_expectation_plots, args = (aff_expectation_rgn, aff_expectation_cntry, args.plot_workers), upstream = [aff_exp_key], force = force)
 
 
 # In[ ]:
@@ -118,4 +197,3 @@ plot_data(aff_expectation_cntry, 'affectable', 'Affectable_Planned_Committed_and
 
 # from output_analysis import check_emits_in_yr
 # check_emits_in_yr(2021, coal_plants_clean, gas_plants_clean, steel_plants_clean, regions)
-
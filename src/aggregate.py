@@ -2,125 +2,372 @@
 # import libraries
 import pandas as pd
 import numpy as np
-from functools import reduce
+from storage import save_panel, load_panel
+from countrynamefix import CountryResolver
+from rcp_ssp import SSP_DTYPE, RCP_DTYPE, as_scen_keys
 
 # %%
-# return the data in plotting format
-def format_consid_commit(df, asset):
-    # get the unique countries in the dataset
-    countries = df['country'].unique()
+# the years every plotting column is built for
+YEARS = np.arange(2021, 2101)
 
-    # create a list of all possible column names for the pivot table
-    statuses = df['Status'].unique()
-    years = np.arange(2021, 2101)
-    col_names = [f"{asset}.{s}.{y}" for s in statuses for y in years]
+# %% [markdown]
+# ### The asset registry
+# Every sector of plants which can go into the master file is registered here, with the stati its committed emissions come from
+# (its other stati are considered) and the column of its cleaned plant table which holds the CO2 of a plant.
+# All the registered assets given to make_master_blocks go through one pass into the shared (asset x status x country x year) cube,
+# so an extra asset is one more slice of that array, and gets its pivot and consid/commit totals in the master file from it.
+# The considered emissions of the electricity assets make up the considered electricity, which the considered industry is scaled from,
+# those of the other assets are added to the considered total as they are.
 
-    # create an empty pivot table with the desired column names
-    pivot = pd.DataFrame(index = countries, columns = col_names)
+# %%
+ASSETS = {}
+
+# register an asset (or replace its entry), the master file lists the assets in the order they were registered
+def register_asset(name, committed = ['operating'], co2_col = 'CO2 (Mt/yr)', electricity = False):
+    ASSETS[name] = {'committed': list(committed), 'co2_col': co2_col, 'electricity': electricity}
+    return(ASSETS[name])
+
+register_asset('gas', electricity = True)
+register_asset('coal', electricity = True)
+register_asset('steel')
+
+# the plant tables going into the master file, in the order of the registry
+# steel is only included when asked for, extra_plants maps the names of other registered assets (e.g. cement) to their plant tables
+def master_plants(coal, gas, steel, include_steel = False, extra_plants = {}):
+
+    given = {'coal': coal, 'gas': gas, **({'steel': steel} if include_steel else {}), **extra_plants}
+
+    unknown = [name for name in given if name not in ASSETS]
+    if unknown:
+        raise ValueError(f'the assets {unknown} are not registered, add them with register_asset first')
+
+    return({name: given[name] for name in ASSETS if given.get(name) is not None})
+
+# %%
+# turn each plant's [Start year, Planned retire) interval into a +CO2 event in the year it starts operating
+# and a -CO2 event in the year it retires, then take a cumulative sum over the years to get the annual activity
+# this returns the unique values of each key column and a (key_1 x ... x key_n x year) array of the CO2 operating in each year
+# with sparse = True the cube is a scipy CSR matrix of (key combination x year) instead, the combinations flattened in C order
+# (row (k_1, ..., k_n) of the dense cube is row np.ravel_multi_index((k_1, ..., k_n), shape)), and only the combinations with plants
+# ever get a row of events, so the combinations without plants take no memory
+def make_activity_cube(df, keys = ['country', 'Status'], years = YEARS, sparse = False):
+
+    # encode each key column as integer codes, in the order the values first appear in the data
+    factorized = [pd.factorize(df[key]) for key in keys]
+    codes = [codes for codes, uniques in factorized]
+    uniques = [uniques for codes, uniques in factorized]
+
+    start = df['Start year'].to_numpy(dtype = float)
+    retire = df['Planned retire'].to_numpy(dtype = float)
+    co2 = np.nan_to_num(df['CO2 (Mt/yr)'].to_numpy(dtype = float))
+
+    # a plant is active in a year when start <= year < retire, so the first active year is the start rounded up,
+    # and the first inactive year is the retirement rounded up. Clip both to the modelled years, the last slot
+    # holds the events for plants retiring after the final year so they never get subtracted
+    first_yr = np.clip(np.ceil(start) - years[0], 0, len(years))
+    end_yr = np.clip(np.ceil(retire) - years[0], 0, len(years))
+
+    # plants without a start or retirement year, or which retire before they start, never operate
+    active = ~np.isnan(first_yr) & ~np.isnan(end_yr) & (first_yr < end_yr)
+    for key_codes in codes:
+        active &= key_codes >= 0
+
+    first_yr, end_yr, co2 = first_yr[active].astype(int), end_yr[active].astype(int), co2[active]
+    codes = tuple(key_codes[active] for key_codes in codes)
+
+    # the flat index of each plant's key combination, and the rows of events: every combination, or only those with plants
+    shape = tuple(len(key_uniques) for key_uniques in uniques)
+    flat = np.ravel_multi_index(codes, shape)
+    if sparse:
+        combos, rows = np.unique(flat, return_inverse = True)
+    else:
+        combos, rows = None, flat
+
+    # bin the start and retirement events of every plant by its keys and year
+    n_rows = len(combos) if sparse else int(np.prod(shape))
+    co2_events = np.zeros((n_rows, len(years) + 1))
+    plant_events = np.zeros((n_rows, len(years) + 1), dtype = np.int64)
+
+    np.add.at(co2_events, (rows, first_yr), co2)
+    np.add.at(co2_events, (rows, end_yr), -co2)
+    np.add.at(plant_events, (rows, first_yr), 1)
+    np.add.at(plant_events, (rows, end_yr), -1)
 
-    # loop through each country
-    for country in countries:
-        # loop through each year and status
-        for year in years:
-            for status in statuses:
-                # calculate the sum of CO2 for this combination of year and status
-                mask = (df['country'] == country) & (df['Status'] == status) & (df['Start year'] <= year) & (df['Planned retire'] > year)
-                co2_sum = df.loc[mask, 'CO2 (Mt/yr)'].sum()
-                # set the value of the pivot table to the CO2 sum
-                col_name = f"{asset}.{status}.{year}"
-                pivot.loc[country, col_name] = co2_sum
+    # the running sum of the events is the CO2 (and number of plants) operating in each year
+    cube = np.cumsum(co2_events, axis = -1)[..., :-1]
+    n_plants = np.cumsum(plant_events, axis = -1)[..., :-1]
 
-    # fill any missing values with 0
-    pivot = pivot.fillna(0).reset_index().rename(columns = {'index':'country'})
+    # the float cumsum can leave tiny residues once every plant in a group has retired, so set these to exactly 0
+    cube[n_plants == 0] = 0
+
+    if sparse:
+        from scipy import sparse as sp
+        nz_rows, nz_yrs = np.nonzero(cube)
+        cube = sp.csr_matrix((cube[nz_rows, nz_yrs], (combos[nz_rows], nz_yrs)), shape = (int(np.prod(shape)), len(years)))
+    else:
+        cube = cube.reshape(shape + (len(years),))
+
+    return(uniques, cube)
+
+# %%
+# the pivot table of a (country x column) matrix, sparse ones become columns of pandas' SparseDtype (0 is the fill value)
+def matrix_to_pivot(matrix, countries, col_names):
+
+    if isinstance(matrix, np.ndarray):
+        pivot = pd.DataFrame(matrix, columns = col_names)
+    else:
+        pivot = pd.DataFrame.sparse.from_spmatrix(matrix.tocsr(), columns = col_names)
+    pivot.insert(0, 'country', np.asarray(countries))
+
+    return(pivot)
+
+# %%
+# return the data in plotting format, one column per status and year named {asset}.{status}.{year}
+# sparse = True keeps the columns sparse (most countries have no plants of most stati, and every status runs out to 0s after its plants retire)
+def format_consid_commit(df, asset, sparse = False):
+
+    # build the country x status x year array of active CO2 in one pass over the plants
+    (countries, statuses), cube = make_activity_cube(df, keys = ['country', 'Status'], sparse = sparse)
+
+    # create a list of all possible column names for the pivot table, in the same status-major order as the cube
+    col_names = [f"{asset}.{s}.{y}" for s in statuses for y in YEARS]
+
+    # flatten the status and year axes of the cube into the columns of the pivot table
+    pivot = matrix_to_pivot(cube.reshape(len(countries), len(col_names)), countries, col_names)
     
     return(pivot)
 
 # %%
-# write a function that combines my dataframes however specified
-# fillna with 0 here so that in calculations we get negative values instead of more NAs
+# build a single (asset x status x country x year) array of active CO2 from all the plant tables at once
+# plants is a dict mapping the asset name (e.g. 'coal') to its cleaned plant table, the CO2 of each is read from its registered column
+# sparse = True holds the cube as a CSR matrix of (asset/status/country x year), see make_activity_cube
+def make_asset_cube(plants, sparse = False):
+
+    # stack the plant tables so every plant is scanned exactly once
+    cols = ['country', 'Status', 'Start year', 'Planned retire']
+    stacked = pd.concat([df[cols].assign(**{'CO2 (Mt/yr)': df[ASSETS.get(asset, {}).get('co2_col', 'CO2 (Mt/yr)')], 'asset': asset})
+                         for asset, df in plants.items()], ignore_index = True)
+
+    (assets, statuses, countries), cube = make_activity_cube(stacked, keys = ['asset', 'Status', 'country'], sparse = sparse)
+
+    # record the row where each asset/status/country combination first appears, even for plants which never operate
+    # the views below use this to list countries and stati in the same order the old per-subset pivots did
+    first_row = np.full((len(assets), len(statuses), len(countries)), np.inf)
+    codes = tuple(pd.factorize(stacked[key])[0] for key in ['asset', 'Status', 'country'])
+    np.minimum.at(first_row, codes, np.arange(len(stacked)))
+
+    return({'assets': list(assets), 'statuses': list(statuses), 'countries': np.asarray(countries), 'cube': cube, 'first_row': first_row})
+
+# %%
+# select the countries (and stati) of one asset which have plants with the given stati, in order of appearance
+# if several assets are given, the countries of the first asset come first and the others are appended, like an outer merge
+# statuses is one list of stati for every asset, or a dict of each asset's own stati; the stati are returned per asset
+def select_cube_keys(asset_cube, assets, statuses):
+
+    status_idx = {asset: [asset_cube['statuses'].index(s) for s in (statuses[asset] if isinstance(statuses, dict) else statuses)
+                          if s in asset_cube['statuses']] for asset in assets}
+
+    cntry_idx = []
+    for asset in assets:
+        first_row = asset_cube['first_row'][asset_cube['assets'].index(asset)][status_idx[asset]]
+
+        # countries with at least one plant of these stati, sorted by where they first appear
+        cntry_first = first_row.min(axis = 0, initial = np.inf)
+        present = np.flatnonzero(np.isfinite(cntry_first))
+        ordered = present[np.argsort(cntry_first[present], kind = 'stable')]
+        cntry_idx += [c for c in ordered if c not in cntry_idx]
+
+    return(status_idx, cntry_idx)
+
+# %%
+# the (country x status x year) rows of the cube of one asset, as a dense array or, for a sparse cube, a (country*status x year) CSR matrix
+def cube_rows(asset_cube, a, status_idx, cntry_idx):
+
+    cube = asset_cube['cube']
+    if isinstance(cube, np.ndarray):
+        return(cube[a][status_idx][:, cntry_idx].transpose(1, 0, 2))
+
+    shape = (len(asset_cube['assets']), len(asset_cube['statuses']), len(asset_cube['countries']))
+    flat = np.ravel_multi_index((a, np.asarray(status_idx, dtype = int)[None, :], np.asarray(cntry_idx, dtype = int)[:, None]), shape)
+
+    return(cube[flat.ravel()])
+
+# %%
+# view the cube as the {asset}.{status}.{year} pivot table format_consid_commit would have made for these stati
+def cube_to_pivot(asset_cube, asset, statuses):
+
+    status_idx, cntry_idx = select_cube_keys(asset_cube, [asset], statuses)
+    status_idx = status_idx[asset]
+    a = asset_cube['assets'].index(asset)
+
+    # keep only the stati this asset actually has, in the order they first appear
+    status_first = asset_cube['first_row'][a][status_idx].min(axis = 1, initial = np.inf)
+    status_idx = [s for s, first in sorted(zip(status_idx, status_first), key = lambda pair: pair[1]) if np.isfinite(first)]
+
+    # select the (country x status x year) block of this asset, then flatten the status and year axes into columns
+    block = cube_rows(asset_cube, a, status_idx, cntry_idx)
+    col_names = [f"{asset}.{asset_cube['statuses'][s]}.{y}" for s in status_idx for y in YEARS]
+
+    return(matrix_to_pivot(block.reshape(len(cntry_idx), len(col_names)), asset_cube['countries'][cntry_idx], col_names))
+
+# %%
+# reduce the cube over the given assets and stati to one total per country and year, named like make_yr_based_total's output
+# the totals are dense, a sparse cube is only summed into a dense array here
+def cube_to_total(asset_cube, assets, statuses, new_col_name):
+
+    status_idx, cntry_idx = select_cube_keys(asset_cube, assets, statuses)
+
+    # sum over the asset and status axes, leaving a (country x year) array
+    # the stati are added in name order, not in the order they appear in, so a country's total doesn't depend on the other plants in the data
+    totals = np.zeros((len(cntry_idx), len(YEARS)))
+    for asset in assets:
+        a = asset_cube['assets'].index(asset)
+        for s in sorted(status_idx[asset], key = lambda s: asset_cube['statuses'][s]):
+            rows = cube_rows(asset_cube, a, [s], cntry_idx)
+            totals += rows[:, 0] if isinstance(rows, np.ndarray) else rows.toarray()
+
+    total = pd.DataFrame(totals, columns = [new_col_name + str(year) for year in YEARS])
+    total['country'] = asset_cube['countries'][cntry_idx]
+
+    print('year totals made for ' + str(new_col_name))
+
+    return(total)
+
+# %%
+# list the unique values of several key columns in the order they first appear, like a chain of outer merges does
+def ordered_union(keys_list):
+    return(pd.unique(np.concatenate([np.asarray(keys, dtype = object) for keys in keys_list])))
+
+# %%
+# align every block on the shared row keys once and write them column-wise into a single preallocated array
+# keys is a df with one row per output row, each block is a df holding some of the key columns plus its data columns
+# blocks are matched on whichever key columns they hold (e.g. country only, or country/SSP/RCP)
+# fill missing values with 0 here so that in calculations we get negative values instead of more NAs
+def assemble_blocks(keys, blocks):
+
+    keys = keys.reset_index(drop = True)
+    block_keys = [[col for col in keys.columns if col in block.columns] for block in blocks]
+    col_names = [col for block, on in zip(blocks, block_keys) for col in block.columns if col not in on]
+
+    values = np.zeros((len(keys), len(col_names)))
+    pos = 0
+
+    for block, on in zip(blocks, block_keys):
+        data = block.drop(columns = on).to_numpy(dtype = float)
+
+        # find the row of the block matching each output row, -1 where the block has no data for it
+        if len(on) == 1:
+            rows = pd.Index(block[on[0]]).get_indexer(keys[on[0]])
+        else:
+            rows = pd.MultiIndex.from_frame(block[on]).get_indexer(pd.MultiIndex.from_frame(keys[on]))
+
+        found = rows >= 0
+        values[found, pos:pos + data.shape[1]] = data[rows[found]]
+        pos += data.shape[1]
+
+    values[np.isnan(values)] = 0
+
+    # build the df around the array without copying it, then put the keys at the front
+    assembled = pd.DataFrame(values, columns = col_names, copy = False)
+    for i, col in enumerate(keys.columns):
+        assembled.insert(i, col, keys[col].values)
+
+    return(assembled)
+
+# %%
+# the sparse counterpart of assemble_blocks for blocks whose data columns are all sparse (e.g. the sparse pivots), matched on the country
+# each block's rows are moved onto the output rows by a sparse (output row x block row) 0/1 matrix, so nothing is densified
+# returns the data columns only, as sparse columns
+def assemble_sparse_blocks(keys, blocks):
+    from scipy import sparse
+
+    matrices, col_names = [], []
+    for block in blocks:
+        data_cols = [col for col in block.columns if col != 'country']
+        rows = pd.Index(block['country']).get_indexer(keys['country'])
+        found = np.flatnonzero(rows >= 0)
+
+        mover = sparse.csr_matrix((np.ones(len(found)), (found, rows[found])), shape = (len(keys), len(block)))
+        matrices.append(mover @ block[data_cols].sparse.to_coo().tocsr())
+        col_names += data_cols
+
+    return(pd.DataFrame.sparse.from_spmatrix(sparse.hstack(matrices, format = 'csr'), columns = col_names))
+
+# is every data column of the block sparse
+def is_sparse_block(block):
+    data = block.drop(columns = 'country')
+    return(len(data.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in data.dtypes))
+
+# %%
+# write a function that combines my dataframes on their country column
 def merge_dataframes(dfs):
-    return reduce(lambda left, right: pd.merge(left, right, on='country', how='outer').fillna(0), dfs)
+    countries = ordered_union([df['country'] for df in dfs])
+    return(assemble_blocks(pd.DataFrame({'country': countries}), dfs))
 
 # %%
 def make_yr_based_total(df, new_col_name):
     
-    df_new = df.copy()
-    
-    # select the year range to bother totaling
-    for year in range(2021,2101):
-        # keep track of columns with the same year here
-        cols_to_total = []
+    # parse the year off the end of every column name once
+    # select the data columns by name, the country isn't always the first column (the totals made here put it last)
+    data = df.drop(columns = 'country')
+    values = data.to_numpy(dtype = float)
+    col_yrs = data.columns.astype(str).str[-4:]
 
-        for col_name in df_new.columns[1:]: 
-            # if the column of this iteration has the yr in it, add it to the list
-            if str(year) == str(col_name[-4:]):
-                cols_to_total.append(col_name)
-        
-        # for each year in the original data, create a column with the total of all data for that year
-        df_new[new_col_name + str(year)] = np.nansum(df_new[cols_to_total], axis = 1)
-    
-    # return the last 80 columns of the data, to get the totals, then add back the country retroactively
-    new_cols = df_new.iloc[:,-80:]
-    new_cols['country'] = df_new['country']
+    # sort the columns by year, then every yearly total is the sum of one run of adjacent columns
+    # each row is summed on its own, in column order, so a country's totals don't depend on which other rows are in the df
+    # (a matrix product can sum in a different order depending on the number of rows, see parallel.py)
+    # (columns of other years, or without a year, are left out)
+    col_yrs = np.asarray(col_yrs)
+    in_yrs = np.flatnonzero(np.isin(col_yrs, YEARS.astype(str)))
+    order = in_yrs[np.argsort(col_yrs[in_yrs], kind = 'stable')]
+    sorted_yrs = col_yrs[order]
+    starts = np.searchsorted(sorted_yrs, YEARS.astype(str))
+    has_cols = np.isin(YEARS.astype(str), sorted_yrs)
+
+    totals = np.zeros((len(df), len(YEARS)))
+    if len(order) and len(df):
+        totals[:, has_cols] = np.add.reduceat(np.nan_to_num(values[:, order]), starts[has_cols], axis = 1)
+
+    # return the totals, then add back the country retroactively
+    new_cols = pd.DataFrame(totals, index = df.index, columns = [new_col_name + str(year) for year in YEARS])
+    new_cols['country'] = df['country']
     
     print('year totals made for ' + str(new_col_name))
     
     return(new_cols)
 
 # %%
-def aggregate_to_master(coal, gas, steel, tong, scen):
+# create every block of data that makes up the master file
+# include_steel adds the steel pivot and totals, and the considered steel emissions to the considered total
+# extra_plants adds the plant tables of other registered assets the same way (see master_plants)
+# sparse = True builds the cube and the {asset}.{status}.{year} pivots sparse, the totals are dense either way
+def make_master_blocks(coal, gas, steel, tong, scen, include_steel = False, extra_plants = {}, sparse = False):
     
-    # could try to separate considered and committed emissions by operation status
-    #consid_steel_plants = steel[steel['Status'] != 'operating']
-    #commit_steel_plants = steel[steel['Status'] == 'operating']
+    # build one (asset x status x country x year) cube of active CO2, then take every view needed below from it
+    plants = master_plants(coal, gas, steel, include_steel, extra_plants)
+    asset_cube = make_asset_cube(plants, sparse)
 
-    consid_coal_plants = coal[coal['Status'] != 'operating']
-    commit_coal_plants = coal[coal['Status'] == 'operating']
-
-    consid_gas_plants = gas[gas['Status'] != 'operating']
-    commit_gas_plants = gas[gas['Status'] == 'operating']
-    
-    # create the plotting ready data frames (considered only)
-    coal_cons_pivot = format_consid_commit(consid_coal_plants, 'coal')
-    gas_cons_pivot = format_consid_commit(consid_gas_plants, 'gas')
-    #steel_cons_pivot = format_consid_commit(consid_steel_plants, 'steel')
+    # committed emissions come from the stati each asset registered (operating plants), considered ones from all the others
+    commit_stati = {asset: ASSETS[asset]['committed'] for asset in plants}
+    consid_stati = {asset: [s for s in asset_cube['statuses'] if s not in commit_stati[asset]] for asset in plants}
+    elec_assets = [asset for asset in plants if ASSETS[asset]['electricity']]
 
-    # create the plotting ready data frames (committed only)
-    coal_comm_pivot = format_consid_commit(commit_coal_plants, 'coal')
-    gas_comm_pivot = format_consid_commit(commit_gas_plants, 'gas')
-    #steel_comm_pivot = format_consid_commit(commit_steel_plants, 'steel')
-    
-    print('considered and committed data separated')
-    
     # create the plotting ready data frames (consid and commit)
-    coal_pivot = format_consid_commit(coal, 'coal')
-    gas_pivot = format_consid_commit(gas, 'gas')
-    #steel_pivot = format_consid_commit(steel, 'steel')
+    pivots = [cube_to_pivot(asset_cube, asset, asset_cube['statuses']) for asset in plants]
     
-    print('completed initial coal, gas, and steel formatting')
+    print('completed initial formatting of ' + ', '.join(plants))
     
     # make dfs with the cons and comms totals
-    coal_cons = make_yr_based_total(coal_cons_pivot,'coal.consid.total.')
-    gas_cons = make_yr_based_total(gas_cons_pivot,'gas.consid.total.')
-    #steel_cons = make_yr_based_total(steel_cons_pivot,'steel.consid.total.')
-
-    coal_comm = make_yr_based_total(coal_comm_pivot, 'coal.commit.total.')
-    gas_comm = make_yr_based_total(gas_comm_pivot, 'gas.commit.total.')
-    #steel_comm = make_yr_based_total(steel_comm_pivot, 'steel.commit.total.')
+    cons = {asset: cube_to_total(asset_cube, [asset], consid_stati, asset + '.consid.total.') for asset in plants}
+    comms = [cube_to_total(asset_cube, [asset], commit_stati, asset + '.commit.total.') for asset in plants]
     
-    print('created totals for coal/gas/steel')
+    print('created totals for ' + ', '.join(plants))
     
     # 1 Total
-    # created considered electricity
-    # (1) combine the gas and coal dfs (commit and consid respectively)
-    #gas_coal_comm = merge_dataframes([gas_comm_pivot, coal_comm_pivot])
-    gas_coal_cons = merge_dataframes([gas_cons_pivot, coal_cons_pivot])
-
-    # (2) add these together to create the considered electricity
-    #elec_commit = make_yr_based_total(gas_coal_comm, 'elec.commit.total.')
-    elec_cons = make_yr_based_total(gas_coal_cons, 'elec.consid.total.')
+    # created considered electricity by adding the considered electricity assets (gas and coal) together
+    elec_cons = cube_to_total(asset_cube, elec_assets, consid_stati, 'elec.consid.total.')
 
-    print('considered electricty metric created from gas and coal (GEM)')
+    print('considered electricty metric created from ' + ' and '.join(elec_assets) + ' (GEM)')
 
     # 1.5 Total
     # created committed electricity
@@ -143,17 +390,18 @@ def aggregate_to_master(coal, gas, steel, tong, scen):
     # create considered industry with a custom metric
     # made from: consid_elec, commit_elec.2021, and industry.commit.2021
     # first, combine all the input data 
-    pre_inds_cons = merge_dataframes([elec_cons, elec_commit, tong]).fillna(0)
+    pre_inds_cons = merge_dataframes([elec_cons, elec_commit, tong])
 
-    # create an empty df to propogate with considered emissions from industry
-    industry_cons = pd.DataFrame()
+    # for all the years in the data, propogate the considered emissions (elec consid / elec commit 2021 * industry 2021)
+    elec_cons_yrs = pre_inds_cons[['elec.consid.total.' + str(yr) for yr in YEARS]].to_numpy()
+    industry_ratio = pre_inds_cons['Industry.2021'].to_numpy()[:, None]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        industry_yrs = (elec_cons_yrs / pre_inds_cons['elec.commit.total.2021'].to_numpy()[:, None]) * industry_ratio
 
-    # make sure this has the same countries as the original data
-    industry_cons['country'] = pre_inds_cons['country']
+    industry_cons = pd.DataFrame(industry_yrs, columns = ['industry.consid.total.' + str(yr) for yr in YEARS])
 
-    # for all the years in the data, propogate the considered emissions df
-    for yr in np.arange(2021, 2101):
-        industry_cons['industry.consid.total.' + str(yr)] = (pre_inds_cons['elec.consid.total.' + str(yr)] / pre_inds_cons['elec.commit.total.2021']) * pre_inds_cons['Industry.2021']
+    # make sure this has the same countries as the original data
+    industry_cons.insert(0, 'country', pre_inds_cons['country'])
 
     # replace the inf and NaN values from dividing by 0 with 0s
     industry_cons = industry_cons.replace([np.inf, np.nan], 0)
@@ -168,9 +416,8 @@ def aggregate_to_master(coal, gas, steel, tong, scen):
     # make committed emissions total from tong data
     comm_total = make_yr_based_total(tong, 'commit.total.')
 
-    # make considered emissions total from industry and and gas and coal-- BUT NOT STEEL
-    # to include steel, add steel_cons to the list below
-    gas_coal_inds_cons = merge_dataframes([gas_cons, coal_cons, industry_cons])
+    # make considered emissions total from gas and coal and industry, then the other assets (steel if it is included)
+    gas_coal_inds_cons = merge_dataframes([cons[asset] for asset in elec_assets] + [industry_cons] + [cons[asset] for asset in plants if asset not in elec_assets])
     cons_total = make_yr_based_total(gas_coal_inds_cons, 'consid.total.')
     
     # 5
@@ -180,68 +427,171 @@ def aggregate_to_master(coal, gas, steel, tong, scen):
     
     # 6
     # Make "expectable" emissions from scenario - (consid + commit)
-    # this has to account for rcp and ssp, so can't use the regular merge functions
-    merged_df = scen.merge(comm_cons_total, on = 'country', how = 'left').fillna(0)
-    
-    # holding df to propogate with expectable values
-    expectable = pd.DataFrame({'country': merged_df['country'], 'SSP': merged_df['SSP'], 'RCP': merged_df['RCP']})
+    # this has to account for rcp and ssp, so broadcast the country totals onto the scenario rows of each country:
+    # one lookup of the row of each scenario row's country, countries without a total get the row of 0s at the end
+    scen_keys = scen[['country', 'SSP', 'RCP']].reset_index(drop = True)
+    cc_rows = pd.Index(comm_cons_total['country']).get_indexer(scen_keys['country'])
+
+    scen_yrs = np.nan_to_num(scen[[str(year) for year in YEARS]].to_numpy(dtype = float))
+    cc_totals = np.nan_to_num(comm_cons_total[['consid+commit.total.' + str(year) for year in YEARS]].to_numpy(dtype = float))
+    cc_yrs = np.vstack([cc_totals, np.zeros((1, len(YEARS)))])[cc_rows]
 
-    for year in range(2021, 2101):
-        ex_col_name = 'expectable.' + str(year)
-        sum_col_name = 'consid+commit+scen.' + str(year)
+    # interleave the expectable and consid+commit+scen columns year by year
+    expectable_yrs = np.stack([scen_yrs - cc_yrs, scen_yrs + cc_yrs], axis = 2).reshape(len(scen_keys), -1)
+    expectable_cols = [name + str(year) for year in YEARS for name in ['expectable.', 'consid+commit+scen.']]
 
-        expectable[ex_col_name] = merged_df[str(year)] - merged_df['consid+commit.total.' + str(year)]
-        expectable[sum_col_name] = merged_df[str(year)] + merged_df['consid+commit.total.' + str(year)]
+    expectable = pd.DataFrame(expectable_yrs, columns = expectable_cols)
+    for i, col in enumerate(scen_keys.columns):
+        expectable.insert(i, col, scen_keys[col])
         
     print('expectable emissions created')
     
     # 6  
     # This line removes the data from 1850-2020, which is introduced by the complete GEM datasets
-    scenario_CO2_2021_on = scen.iloc[:,:3].join(scen.iloc[:,175:])
+    # (the year columns are picked by name, the scenario table from the subset file has an extra index column before them)
+    scenario_CO2_2021_on = scen.iloc[:,:3].join(scen[[str(year) for year in YEARS]])
     
     # 7
-    master = pd.merge(scenario_CO2_2021_on, expectable, on = ['country','RCP','SSP'], how = 'outer').merge(gas_pivot, 
-                                                    on = 'country', how = 'outer').merge(coal_pivot, 
-                                                    on = 'country', how = 'outer').merge(gas_cons, 
-                                                    on = 'country', how = 'outer').merge(coal_cons, 
-                                                    on = 'country', how = 'outer').merge(industry_cons, 
-                                                    on = 'country', how = 'outer').merge(gas_comm, 
-                                                    on = 'country', how = 'outer').merge(coal_comm, 
-                                                    on = 'country', how = 'outer').merge(elec_commit,
-                                                    on = 'country', how = 'outer').merge(elec_cons, 
-                                                    on = 'country', how = 'outer').merge(industry_commit, 
-                                                    on = 'country', how = 'outer').merge(cons_total, 
-                                                    on = 'country', how = 'outer').merge(comm_total, 
-                                                    on = 'country', how = 'outer').merge(comm_cons_total, 
-                                                    on = 'country', how = 'outer').fillna(0)
-                                                    
-                                                    # not to self: include elec_cons
-                                                    # to incorporate the steel data back in to the master file, uncomment the lines below
-                                                    # you will also need to modify the value of the considered emissions total (line 4)
-                                                    #.merge(steel_pivot, on = 'country', how = 'outer')
-                                                    #.merge(steel_cons, on = 'country', how = 'outer')
-                                                    #.merge(steel_comm,#on = 'country', how = 'outer')
-    
+    # the blocks which only depend on the country, in the order they appear in the master file
+    # not to self: include elec_cons
+    # the blocks of each asset in the order of the registry, so the steel ones go after the coal ones
+    country_blocks = pivots + list(cons.values()) + [industry_cons] + comms + [elec_commit, elec_cons, industry_commit, cons_total, comm_total, comm_cons_total]
+
+    return(scenario_CO2_2021_on, expectable, country_blocks)
+
+# %% [markdown]
+# ### The normalized master file
+# Some blocks of the master file only depend on the country (the plant pivots and the consid/commit totals), the others on the scenario
+# (the scenario emissions, expectable and consid+commit+scen). The wide master file repeats the country blocks on every SSP x RCP row
+# of the country, the normalized one holds each kind once:
+# - country: one row per country, with its region and the country blocks
+# - scenario: one row per (country, SSP, RCP), with the scenario blocks
+# widen_master broadcasts the country rows onto the scenario rows (one lookup of each row's country, no merge) when the wide df is needed.
+# With the sparse pivots (make_master_blocks(sparse = True)) the country table holds them as sparse columns, the wide df is dense.
+
+# %%
+# line up the blocks of each kind on their own rows, each table is made in a single allocation (see assemble_blocks)
+def normalize_master(scenario_CO2_2021_on, expectable, country_blocks):
+
+    # the SSP and RCP stay typed keys
+    scen_keys = as_scen_keys(scenario_CO2_2021_on[['country', 'SSP', 'RCP']])
+    scenario = assemble_blocks(scen_keys, [scenario_CO2_2021_on, expectable])
+
+    # every country with scenarios or plant/Tong data, the ones without any of the blocks get 0s
+    countries = pd.DataFrame({'country': ordered_union([scen_keys['country']] + [block['country'] for block in country_blocks])})
+    country = assemble_blocks(countries, [block for block in country_blocks if not is_sparse_block(block)])
+
+    # sparse blocks (the sparse pivots) stay sparse, their columns go back in their place among the others
+    sparse_blocks = [block for block in country_blocks if is_sparse_block(block)]
+    if sparse_blocks:
+        cols = ['country'] + [col for block in country_blocks for col in block.columns if col != 'country']
+        country = pd.concat([country, assemble_sparse_blocks(countries, sparse_blocks)], axis = 1)[cols]
+
+    return({'country': country, 'scenario': scenario})
+
+# %%
+# the wide master file of the normalized tables, with its rows and columns in the order of the old chain of outer merges:
+# the scenario rows, followed by the countries without scenarios (these get 0 for their SSP and RCP, and for the scenario blocks)
+def widen_master(tables):
+
+    country, scenario = tables['country'], tables['scenario']
+
+    cntry_keys = [col for col in ['country', 'region'] if col in country.columns]
+    scen_cols = [col for col in scenario.columns if col not in ['country', 'SSP', 'RCP']]
+    cntry_cols = [col for col in country.columns if col not in cntry_keys]
+
+    # the row of the country table every wide row takes its country blocks from
+    has_scen = country['country'].isin(set(scenario['country'])).to_numpy()
+    rows = np.concatenate([pd.Index(country['country']).get_indexer(scenario['country']), np.flatnonzero(~has_scen)])
+
+    # write both kinds of blocks into a single preallocated array
+    values = np.zeros((len(rows), len(scen_cols) + len(cntry_cols)))
+    values[:len(scenario), :len(scen_cols)] = scenario[scen_cols].to_numpy(dtype = float)
+    values[:, len(scen_cols):] = np.vstack([country[cntry_cols].to_numpy(dtype = float), np.zeros((1, len(cntry_cols)))])[rows]
+
+    n_extra = len(rows) - len(scenario)
+    keys = {col: country[col].to_numpy()[rows] for col in cntry_keys}
+    for col, dtype in [('SSP', SSP_DTYPE), ('RCP', RCP_DTYPE)]:
+        keys[col] = pd.concat([scenario[col].reset_index(drop = True), pd.Series(pd.Categorical([0] * n_extra, dtype = dtype))], ignore_index = True).values
+
+    # build the df around the array without copying it, then put the keys at the front
+    master = pd.DataFrame(values, columns = scen_cols + cntry_cols, copy = False)
+    for i, col in enumerate(cntry_keys + ['SSP', 'RCP']):
+        master.insert(i, col, keys[col])
+
+    return(master)
+
+# %%
+# line up all the blocks on one set of rows and concatenate them into the wide master file
+def assemble_master(scenario_CO2_2021_on, expectable, country_blocks):
+
+    master = widen_master(normalize_master(scenario_CO2_2021_on, expectable, country_blocks))
+
     print('master file merge successful')
     
+    return(master)
+
+# %%
+# look the region of each country up by its country code and put it at the front of the df
+# names which are spelled differently in the region mapping still match, as long as the resolver knows both spellings
+# countries missing from the mapping (e.g. N. Korea) get no region
+def add_regions(master):
+
     # parse the region mapping
     regions = pd.read_csv('data/cntry_short_region_map.csv').drop(columns = 'short')
     
-    # this is what makes the master file not have lines for the countries in the not-working code below (e.g. N. Korea)
-    region_merge = pd.merge(master, regions, how = 'left', on = 'country')
+    resolver = CountryResolver.load().add_names(master['country'])
+    region_of = resolver.by_code(regions['country'], regions['region'])
+    master.insert(1, 'region', region_of[resolver.codes(master['country'])])
+
+    return(master)
+
+# %%
+# the normalized master file is written as a csv and a panel (see storage.py) per table, data/master_country and data/master_scenario
+def save_master(tables, path = 'data/master'):
+
+    for kind, table in tables.items():
+        table.to_csv(f'{path}_{kind}.csv')
+        save_panel(table, f'{path}_{kind}')
+
+    return(path)
+
+# read the normalized master file back, widened unless wide = False
+def load_master(path = 'data/master', wide = True):
+
+    tables = {kind: load_panel(f'{path}_{kind}') for kind in ['country', 'scenario']}
+
+    return(widen_master(tables) if wide else tables)
+
+# %%
+# n_workers > 1 builds the master file from country shards on a process pool (see parallel.py), which gives the same output
+# include_steel adds the steel plants to the master file, extra_plants those of other registered assets (see make_master_blocks)
+# this returns the normalized master file, widen_master makes the wide df of it
+# sparse = True keeps the plant pivots sparse in the country table (see make_master_blocks)
+def aggregate_to_master(coal, gas, steel, tong, scen, n_workers = 1, include_steel = False, extra_plants = {}, sparse = False):
+
+    if n_workers > 1:
+        from parallel import parallel_master
+        tables = parallel_master(coal, gas, steel, tong, scen, n_workers = n_workers, include_steel = include_steel, extra_plants = extra_plants,
+                                 sparse = sparse)
+    else:
+        scenario_CO2_2021_on, expectable, country_blocks = make_master_blocks(coal, gas, steel, tong, scen, include_steel, extra_plants, sparse)
+        tables = normalize_master(scenario_CO2_2021_on, expectable, country_blocks)
 
-    # put region column at the front of the df
-    reg = region_merge.pop('region')
-    region_merge.insert(1, reg.name, reg)
-    region_merge.to_csv('data/master.csv')
+    # the regions only depend on the country
+    tables['country'] = add_regions(tables['country'])
+    save_master(tables)
     
     print('master file merged with regions')
     
-    return(region_merge)
+    return(tables)
 
 # %%
 if __name__ == "__main__":
     aggregate_to_master
+    widen_master
+    load_master
+    register_asset
     make_yr_based_total
 
 
@@ -2,7 +2,9 @@
 import pandas as pd
 import numpy as np
 import warnings
-import random
+import re
+from storage import save_panel
+from countrynamefix import CountryResolver
 warnings.filterwarnings('ignore')
 
 # %% [markdown]
@@ -32,58 +34,112 @@ def filter_stati(df, valid_statuses):
     return df[df['Status'].isin(valid_statuses)]
 
 # %%
-# define a functiont to weigh the steel data
+# define a function to weigh the steel data
+# every plant's CO2 is its capacity on each production route weighted by its country's emissions intensity and utilization rate
+# of the route, see steel.py. Plants in countries without weights get the mean weights, which is reported.
 def weight_steel(steel_plants_filtered, steel):
-    
-    # First parse the files with the emissions intensities and capacity utilization rates for each type of steel production in each country
-    # if the columns of these files are renamed, you may need to modify this code to clean the files slightly differently
-    # These files were originally created by Tom, and are in the FP drive here https://docs.google.com/spreadsheets/d/1TOH_Xq8rIaLiOM_cr0IwZuX5jw6KlRkpv2sJQSciHoc/edit#gid=515274497
-    emit_int_weight = pd.read_csv('data/emit_int_weights.csv', index_col = 0).astype(float).reset_index().rename(columns = {'Units: Tonnes of CO2 per tonne of steel': 'country'})
-    utr_rate_weight = pd.read_csv('data/utilization_rt_weights.csv', index_col = 0).astype(float).reset_index().rename(columns = {'index': 'country'})
+    from steel import SteelEmissions
 
-    # Specify the relevant columns from the raw steel data (those which actually measure output), and turn these into a list
-    # Then, clean up the values in these columns to make them numeric and non-zero (since we will be multiplying them by other values)
-    production_cols = [col for col in steel.columns if 'capacity' in col]
-    steel_plants_filtered[production_cols] = steel[production_cols].replace([' ','unknown','>0', np.nan], value = 1).replace('10,000',10000).astype(float)
+    # The files with the emissions intensities and capacity utilization rates for each type of steel production in each country
+    # were originally created by Tom, and are in the FP drive here https://docs.google.com/spreadsheets/d/1TOH_Xq8rIaLiOM_cr0IwZuX5jw6KlRkpv2sJQSciHoc/edit#gid=515274497
+    # if the columns of these files are renamed, the route keywords in steel.py may need to match them differently
+    engine = SteelEmissions.from_files(steel.columns)
 
-    # Merge the three datasets based on their country columns, which may not contain all the same values
-    rates_df = pd.merge(emit_int_weight, utr_rate_weight, on = 'country', how = 'outer').merge(steel_plants_filtered, on = 'country', how = 'outer') 
+    # Initialize a DataFrame to store the weighted emissions, which already contains the metadata items we want in the final steel output
+    result_df = pd.DataFrame(steel_plants_filtered[['country', 'Status', 'Start year', 'Planned retire', 'Plant age (years)']])
 
-    # Because some countries aren't in the weighting factors, replace NaN values created by the merge (where steel data exists, but not weighting factors, or vice versa) with the mean value of the respective column
-    # This means countries not included in the emissions intensity and capacity utilization rate datasets will be assigned the mean production, capacity, or emit. int. for that type of steel production
-    # Again replace 0 values with 1, so that any emissions intensity or capacity utilization rate of 0 will not result in a 0 value for the weighted steel production
-    rates_df = rates_df.fillna(rates_df.mean()).replace(0, 1)
+    # one dot product per plant of its route capacities with its country's weights, in Mt/yr
+    # (the capacities are read from the rows of the raw data the filtered plants came from)
+    result_df['CO2 (Mt/yr)'], n_fallback = engine.plant_co2(steel.loc[steel_plants_filtered.index], steel_plants_filtered['country'])
 
-    # Give a list of keywords that can identify the type of steel production
-    key = ['crude', 'BOF', 'EAF', 'OHF', 'Iron', 'BF', 'DRI', 'Ferronickel', 'Sinter plant', 'Coking plant', 'Pelletizing']
+    print(f'steel emissions weighted over {len(engine.routes)} production routes, {n_fallback} of {len(result_df)} plants are in countries without weights and got the mean weights')
 
-    # Initialize a DataFrame to store the the product of the three datasets, which already contains the metadata items we want in the final steel output
-    result_df = pd.DataFrame(steel_plants_filtered[['country', 'Status', 'Start year', 'Planned retire', 'Plant age (years)']])
+    return result_df
 
-    # Iterate over the list of keywords
-    for k in key:
-        # Find the columns containing the same keyword for emissions intensity and capacity
-        intensity_col = [col for col in rates_df.columns if k in col and 'emissions intensity' in col]
-        capacity_col = [col for col in rates_df.columns if k in col and 'capacity' in col and 'per annum' in col]
-        prod_col = [col for col in rates_df.columns if k in col and '(ttpa)' in col]                                      
+# %% [markdown]
+# #### Parsing the year fields
+# The GEM start and retirement year fields hold plain years mixed with ranges ('2000-2005'), planning windows ('2021-30'),
+# decades ('2030s'), comma separated unit years ('2000, 2040'), plan names ('13th plan') and junk ('TBD', '0:00', 'unknown', ...).
+# Every distinct raw value is parsed once by one compiled pattern, and the parses are cached, since the files repeat the same few hundred values.
+# Values mixing the formats (e.g. '2000-2005, 2010') are junk, the old [-4:] slice took their last year as the start.
 
-        # Check if all columns are found
-        if intensity_col and capacity_col and prod_col:
-            # Multiply the the production capacity, emissions intensity, and steel production in ttpa together and store the result in a new column
-            # emit int = tonnes CO2 / tonnes steel, production capacity = a fraction, and steel production = 1000 tonnes / year
-            # to result in emissions units of Mt/yr, first multiply by 1000 to get tonnes CO2/yr, then divide by 1,000,000 again to get MtCO2/yr
-            result_df[f'{k}_emissions'] = rates_df[intensity_col[0]] * rates_df[capacity_col[0]] * rates_df[prod_col[0]] * 1000 / 1000000
+# %%
+# 1800 to 2199, so retirement years past the modelled years (2100, 2105, ...) are still years
+YEAR = r'(?:1[89]|2[01])\d{2}'
+
+YEAR_FIELD = re.compile(rf"""^\s*(?:
+    (?P<year>{YEAR})(?:\.0+)?                                        # 2005, or 2005.0 when the column was read as floats
+  | (?P<range_start>{YEAR})\s*[-–]\s*(?P<range_end>{YEAR})           # 2000-2005
+  | (?P<window_start>{YEAR})\s*[-–]\s*(?P<window_end>\d{{2}})         # 2021-30
+  | (?P<decade>\d{{3}}0)s                                            # 2030s
+  | (?P<list_first>{YEAR})\s*,\s*(?P<list_second>{YEAR})(?:\s*,\s*{YEAR})*  # 2000, 2040 (, ...)
+  | (?P<plan>.*plan.*)                                               # 13th plan
+)\s*$""", re.VERBOSE | re.IGNORECASE)
 
-    # Filter the columns with '_emissions' in their name
-    emissions_columns = result_df.filter(like='_emissions', axis=1)
+# the parse of every raw value seen so far, as (start, end, parse_rule)
+YEAR_PARSES = {}
 
-    # Sum the emissions columns along the rows (axis=1)
-    result_df['CO2 (Mt/yr)'] = emissions_columns.sum(axis=1)
+# %%
+# parse the distinct raw values which haven't been seen yet into (start, end, parse_rule) and add them to the cache
+def parse_year_values(values):
 
-    # Return only the metadata columns and the newly created CO2 emissions column
-    result_df = result_df.drop(emissions_columns.columns, axis=1)
+    raw = pd.Series([v for v in values if v not in YEAR_PARSES], dtype = object)
+    if len(raw) == 0:
+        return
 
-    return result_df
+    parts = raw.str.extract(YEAR_FIELD)
+    num = parts.drop(columns = 'plan').astype(float)
+
+    # the end of a planning window only gives the last 2 digits of its year
+    window_end = num['window_start'] - num['window_start'] % 100 + num['window_end']
+    window_end = window_end.where(window_end >= num['window_start'], window_end + 100)
+
+    rules = ['year', 'range', 'window', 'decade', 'list', 'plan']
+    conds = [num['year'].notna(), num['range_start'].notna(), num['window_start'].notna(), num['decade'].notna(), 
+             num['list_first'].notna(), parts['plan'].notna()]
+
+    start = np.select(conds, [num['year'], num['range_start'], num['window_start'], num['decade'], num['list_first'], np.nan], default = np.nan)
+    # the end of a list is its second year, the closing year of the gas plants' lists (later unit years are ignored)
+    end = np.select(conds, [num['year'], num['range_end'], window_end, num['decade'] + 9, num['list_second'], np.nan], default = np.nan)
+    
+    # missing values are left missing, every other value no pattern matched is junk
+    missing = raw.isna() | raw.astype(str).str.strip().isin(['', 'nan', 'None'])
+    parse_rule = np.where(missing, 'missing', np.select(conds, rules, default = 'junk'))
+
+    YEAR_PARSES.update(zip(raw, zip(start, end, parse_rule)))
+
+# %%
+# parse a year field into a df of its (start, end, parse_rule), with the same index
+# every distinct value is only parsed once, and only the first time any dataset contains it
+def parse_year_field(series):
+
+    codes, uniques = pd.factorize(series.astype(str))
+    parse_year_values(uniques)
+
+    parsed = pd.DataFrame([YEAR_PARSES[v] for v in uniques], columns = ['start', 'end', 'parse_rule'])
+    if len(parsed) == 0:
+        parsed = pd.DataFrame({'start': pd.Series(dtype = float), 'end': pd.Series(dtype = float), 'parse_rule': pd.Series(dtype = object)})
+
+    result = parsed.iloc[codes].reset_index(drop = True)
+    result.index = series.index
+    result[['start', 'end']] = result[['start', 'end']].astype(float)
+
+    return(result)
+
+# %%
+# pick the year to use from a parsed field
+# start years: the later year of a range, the (rounded up) middle of a planning window or a decade, the first of a list of unit years
+# retirement years: only plain years, anything vaguer is filled later like a missing year
+def resolve_year(parsed, field):
+
+    rule = parsed['parse_rule'].to_numpy()
+    middle = np.floor((parsed['start'] + parsed['end']) / 2 + 0.5)
+
+    if field == 'start':
+        conds = [rule == 'year', rule == 'range', np.isin(rule, ['window', 'decade']), rule == 'list']
+        return(np.select(conds, [parsed['start'], parsed['end'], middle, parsed['start']], default = np.nan))
+
+    return(np.where(rule == 'year', parsed['start'], np.nan))
 
 # %%
 def clean_gas_starts(filtered_gas):
@@ -91,110 +147,99 @@ def clean_gas_starts(filtered_gas):
     # Repare the misspecified start years in the filtered_gas data
     # it seems that the gas start years list some massive ranges separated by commas in the start year column
     # based on the wikis, these seem to generally be the first opening of the first unit and the planned closing
-    filtered_gas['Start year'] = filtered_gas['Start year'].replace('0',np.nan).astype(str)
-
-    for i, row in filtered_gas.iterrows():
+    parsed = parse_year_field(filtered_gas['Start year'])
+    is_list = (parsed['parse_rule'] == 'list').to_numpy()
 
-        if isinstance(row['Start year'], str) and ',' in row['Start year']:
-            start_year_parts = row['Start year'].split(',')
+    planned = resolve_year(parse_year_field(filtered_gas['Planned retire']), 'retire')
 
-            start_year = start_year_parts[0].strip()
-            retire_year = start_year_parts[1].strip()
-
-            filtered_gas.at[i, 'Start year'] = start_year
-            filtered_gas.at[i, 'Planned retire'] = max(float(row['Planned retire']), float(retire_year))
+    filtered_gas['Start year'] = filtered_gas['Start year'].astype(object).where(~is_list, parsed['start'])
+    # a missing planned retirement year stays missing, like max(nan, year) did
+    filtered_gas['Planned retire'] = filtered_gas['Planned retire'].astype(object).where(~is_list, np.maximum(planned, parsed['end']))
     
     return filtered_gas
 
 # %%
-# define a function to clean the gem plant start years up
-def clean_GEM(coal_plants, gas_plants, steel_plants):
+# fill the missing start and retirement years of one asset's plants, with every rule applied to the whole table at once
+# the rules, in order of precedence:
+#   start year: the plant age back-calculated from 2022 (steel only), the listed start year, the average start year of the plant's status
+#   retirement year: the RETIRED year (coal only), the planned retirement year, 
+#                    start + age + 1 to 15 random years (steel plants operating for over 40 years), start + 40
+# returns the number of plants each rule filled
+def impute_plant_years(dataset, is_steel, rng):
 
-    # write a function that calculate sthe average start year for each assest type by status and country
-    gem_data = [coal_plants, gas_plants, steel_plants]
+    start = dataset['Start year'].to_numpy(dtype = float)
 
-    for dataset in gem_data:
+    # the average start year for each status in the dataset, excluding NaN values
+    avg_start_years = np.round(dataset.groupby('Status')['Start year'].transform('mean').to_numpy(dtype = float), 0)
 
-        # Replace all the weird year values with nans
-        dataset['Start year'] = dataset['Start year'].replace(['unclear','',' ','Unclear','NA', 'TBD','lear',
-                                                                'tbd','13th plan','unknown', 0, 'not found', 
-                                                                'Not found', '0:00', 'nan', '>0'], 
-                                                                value = np.nan).replace('2021-30','2026')
+    age = dataset['Plant age (years)'].to_numpy(dtype = float) if is_steel else np.full(len(dataset), np.nan)
+    has_age = ~np.isnan(age)
+    has_start = ~np.isnan(start)
 
-        dataset['Planned retire'] = dataset['Planned retire'].replace(['2030s', '2021-2025'], value = np.nan)
+    start_rules = ['plant age', 'start year', 'status average']
+    start_conds = [has_age, has_start, np.ones(len(dataset), dtype = bool)]
+    start_yrs = np.select(start_conds, [2022 - age, start, avg_start_years], default = np.nan)
 
-        steel_plants['Plant age (years)'] = steel_plants['Plant age (years)'].replace(['unknown'], value = np.nan)
-        
-        # For plants with multiple years listed (separated by a dash, e.g. "2000-2005"), take the later year
-        start_yr_slice = []
+    # retirement year conditions
+    retired = dataset['RETIRED'].to_numpy(dtype = float) if 'RETIRED' in dataset.columns else np.full(len(dataset), np.nan)
+    planned = dataset['Planned retire'].to_numpy(dtype = float)
+    old_steel = is_steel & (dataset['Status'].to_numpy() == 'operating') & (start_yrs + 40 < 2022)
 
-        for yr in dataset['Start year']:
-            start_yr_slice.append((str(yr))[-4:])
+    # draw the random extensions for every plant, so the draws for one plant don't depend on which others are old steel plants
+    extension = rng.integers(1, 16, size = len(dataset))
 
-        #print(start_yr_slice)
-        # make everything a float so it can be added
-        dataset['Start year'] = start_yr_slice
-        dataset['Start year'] = dataset['Start year'].astype(float)
-        dataset['Planned retire'] = dataset['Planned retire'].astype(float)
-        steel_plants['Plant age (years)'] = steel_plants['Plant age (years)'].astype(float)
+    retire_rules = ['RETIRED', 'planned retire', 'steel age extension', 'start + 40']
+    retire_conds = [~np.isnan(retired), ~np.isnan(planned), old_steel, np.ones(len(dataset), dtype = bool)]
+    retire_yrs = np.select(retire_conds, [retired, planned, start_yrs + age + extension, start_yrs + 40], default = np.nan)
 
-        # Calculate average start years for each status in the dataset, excluding NaN values
-        avg_start_years = np.round(dataset.groupby('Status')['Start year'].mean(), 0)
-        #print(np.round(avg_start_years,0))
-
-        # fill missing data in start and retirement years
-        # initialize the lists of clean start and retirement years
-        start_yrs = []
+    dataset['Start year'] = start_yrs
+    dataset['Planned retire'] = retire_yrs
 
-        # enumerate the #i of rows in the dataset
-        for i, row in dataset.iterrows():
-            
-            # for the steel data, if there is a plant age listed, use that to badck-calculate the start yr
-            if dataset.equals(steel_plants) == True and not pd.isna(row['Plant age (years)']):
-                # if there is a plant age listed, use that to calculate the start yr
-                start_yrs.append(2022 - row['Plant age (years)'])
+    # keep the rule each retirement year came from, the ensemble resamples the lifetimes which were assumed rather than listed
+    dataset['Retire rule'] = np.array(retire_rules)[np.argmax(np.vstack(retire_conds), axis = 0)]
 
-            # start year conditions
-            else:
-                if not pd.isna(row['Start year']):
-                    start_yrs.append(row['Start year'])
+    # count the plants filled by each rule, i.e. the first of the conditions which holds for them
+    counts = {}
+    for prefix, rules, conds in [('start', start_rules, start_conds), ('retire', retire_rules, retire_conds)]:
+        first = np.argmax(np.vstack(conds), axis = 0)
+        for i, rule in enumerate(rules):
+            counts[f'{prefix}: {rule}'] = int(np.sum(first == i))
 
-                elif pd.isna(row['Start year']):
+    # plants whose status has no start years at all still have no start (and so no retirement) year
+    counts['start: unfilled'] = int(np.isnan(start_yrs).sum())
 
-                    # Get the average start year for the current status, if available
-                    avg_start_year = avg_start_years.get(row['Status'])
+    return(counts)
 
-                    if avg_start_year is not None:
-                        start_yrs.append(avg_start_year)
+# %%
+# define a function to clean the gem plant start years up
+# the random lifetime extensions of old steel plants are drawn from a generator seeded with seed, so reruns give the same plants
+# returns the cleaned plants and a df with the number of plants of each asset filled by each imputation rule
+def clean_GEM(coal_plants, gas_plants, steel_plants, seed = 0):
 
-                    else:
-                        # Fallback value in case the average start year for the current status is not available
-                        print('error')
+    rng = np.random.default_rng(seed)
+    counts, parse_counts = {}, {}
 
-        dataset['Start year'] = list(map(float, start_yrs))
+    steel_plants['Plant age (years)'] = steel_plants['Plant age (years)'].replace(['unknown'], value = np.nan).astype(float)
 
-        # Calculate average retirement years for each status in the dataset
-        retirement_yrs = []
+    for asset, dataset in [('coal', coal_plants), ('gas', gas_plants), ('steel', steel_plants)]:
 
-        for i, row in dataset.iterrows():
-            if 'RETIRED' in dataset.columns and not pd.isna(row['RETIRED']):
-                retirement_yrs.append(row['RETIRED'])
+        # parse the messy year fields, see parse_year_field for the formats it understands
+        start_parsed = parse_year_field(dataset['Start year'])
+        retire_parsed = parse_year_field(dataset['Planned retire'])
 
-            elif not pd.isna(row['Planned retire']):
-                retirement_yrs.append(row['Planned retire'])
+        dataset['Start year'] = resolve_year(start_parsed, 'start')
+        dataset['Planned retire'] = resolve_year(retire_parsed, 'retire')
 
-            elif pd.isna(row['Planned retire']):
-                if row['Status'] == 'operating' and (row['Start year'] + 40) < 2022 and dataset.equals(steel_plants):
-                    retirement_yrs.append(row['Start year'] + row['Plant age (years)'] + random.randint(1,15))
-                else:
-                    retirement_yrs.append(row['Start year'] + 40)
+        parse_counts[asset] = pd.concat([start_parsed['parse_rule'].value_counts().rename(lambda rule: f'parse start: {rule}'), 
+                                         retire_parsed['parse_rule'].value_counts().rename(lambda rule: f'parse retire: {rule}')])
 
-            else: 
-                print('error')
+        # fill missing data in start and retirement years
+        counts[asset] = impute_plant_years(dataset, asset == 'steel', rng)
 
-        dataset['Planned retire'] = list(map(float, retirement_yrs))
+    imputation_counts = pd.concat([pd.DataFrame(parse_counts).fillna(0).astype(int), pd.DataFrame(counts)]).rename_axis('rule').reset_index()
+    print(imputation_counts.to_string(index = False))
 
-    return coal_plants, gas_plants, steel_plants
+    return coal_plants, gas_plants, steel_plants, imputation_counts
 
 # %%
 def make_gas_co2(gas_data):
@@ -238,7 +283,7 @@ def format_GEM(coal, gas, steel):
     # resolve the misspecified gas data
     gas_plants_yr_fix = clean_gas_starts(gas_plants_filtered)
     
-    coal_plants_clean, gas_plants_clean, steel_plants_clean = clean_GEM(coal_plants_filtered, gas_plants_yr_fix, steel_plants_weighted)
+    coal_plants_clean, gas_plants_clean, steel_plants_clean, imputation_counts = clean_GEM(coal_plants_filtered, gas_plants_yr_fix, steel_plants_weighted)
     
     # add CO2 to the gas data using the MW to CO2 conversion estimate
     gas_CO2 = make_gas_co2(gas_plants_clean)
@@ -246,6 +291,12 @@ def format_GEM(coal, gas, steel):
     steel_plants_clean.to_csv('data/steel_panel.csv')
     coal_plants_clean.to_csv('data/coal_panel.csv')
     gas_CO2.to_csv('data/gas_panel.csv')
+    imputation_counts.to_csv('data/gem_imputation_counts.csv', index = False)
+
+    # the same tables in the binary panel format, with categorical countries and stati
+    save_panel(steel_plants_clean, 'data/steel_panel')
+    save_panel(coal_plants_clean, 'data/coal_panel')
+    save_panel(gas_CO2, 'data/gas_panel')
     
     return(coal_plants_clean, gas_CO2, steel_plants_clean)
 
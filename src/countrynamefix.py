@@ -1,6 +1,113 @@
 # %%
 import pandas as pd
 import numpy as np
+import json
+import os
+
+# %%
+RESOLVER_FILE = 'data/country_resolver.json'
+
+# %% [markdown]
+# ### Resolving country names
+# The mapping file lists every alternative spelling of a country ('country.name.alt') next to its accurate name ('country.name.en').
+# The resolver loads it once into a dict from each alternative (and accurate) name to an interned integer code of its accurate name,
+# so the country column of a dataset is mapped by looking up its distinct names, without joining on strings or duplicating rows.
+# It is saved to data/country_resolver.json by countrynamefix, so later stages can share the same country codes.
+
+# %%
+class CountryResolver:
+
+    def __init__(self, names, alt_codes):
+        # the accurate names, a name's code is its position in this list
+        self.names = list(names)
+        # every known spelling of a country -> the code of its accurate name
+        self.alt_codes = dict(alt_codes)
+
+    # build the resolver from the rows of the mapping file
+    # an alternative name listed for two countries resolves to the first one, the conflicts are kept to be reported
+    @classmethod
+    def from_mapping(cls, mapping, name_col = 'country.name.en', alt_col = 'country.name.alt'):
+
+        mapping = mapping.dropna(subset = [name_col, alt_col])
+        names = list(dict.fromkeys(mapping[name_col]))
+        code_of = {name: code for code, name in enumerate(names)}
+
+        alt_codes = {}
+        conflicts = []
+        for name, alt in zip(mapping[name_col], mapping[alt_col]):
+            if alt not in alt_codes:
+                alt_codes[alt] = code_of[name]
+            elif names[alt_codes[alt]] != name:
+                conflicts.append((alt, names[alt_codes[alt]], name))
+
+        # the accurate names always resolve to themselves
+        for name, code in code_of.items():
+            alt_codes.setdefault(name, code)
+
+        resolver = cls(names, alt_codes)
+        resolver.conflicts = conflicts
+        return(resolver)
+
+    @classmethod
+    def from_csv(cls, path = 'data/accurate_cntry_name_mapping.csv'):
+        return(cls.from_mapping(pd.read_csv(path, usecols = ['country.name.en', 'country.name.alt'], dtype = str)))
+
+    def save(self, path = RESOLVER_FILE):
+        with open(path, 'w') as f:
+            json.dump({'names': self.names, 'alt_codes': self.alt_codes}, f)
+        return(path)
+
+    # load a saved resolver, or if there is none yet, start an empty one (see add_names)
+    @classmethod
+    def load(cls, path = RESOLVER_FILE):
+        if not os.path.exists(path):
+            return(cls([], {}))
+        with open(path) as f:
+            saved = json.load(f)
+        return(cls(saved['names'], saved['alt_codes']))
+
+    # intern names the resolver doesn't know yet as accurate names of their own, e.g. to key tables which weren't in the mapping file
+    def add_names(self, values):
+        for value in pd.unique(pd.Series(values, dtype = object).dropna()):
+            if value not in self.alt_codes:
+                self.alt_codes[value] = len(self.names)
+                self.names.append(value)
+        return(self)
+
+    # the codes of the accurate names of a country column, -1 where a name isn't known
+    # only the distinct names are looked up, and every row is mapped by its position among them
+    def codes(self, values):
+        row_codes, uniques = pd.factorize(pd.Series(values, dtype = object))
+        unique_codes = np.array([self.alt_codes.get(name, -1) for name in uniques] + [-1], dtype = np.int32)
+        # factorize gives missing values the code -1, which picks the -1 appended above
+        return(unique_codes[row_codes])
+
+    # the accurate names of a country column, NaN where a name isn't known
+    def resolve(self, values):
+        row_codes = self.codes(values)
+        names = np.array(self.names + [np.nan], dtype = object)
+        return(pd.Series(names[row_codes], index = values.index if isinstance(values, pd.Series) else None, dtype = object))
+
+    # the accurate names as a categorical over every accurate name, so all the datasets share the same categories
+    def categorical(self, values):
+        return(pd.Categorical.from_codes(self.codes(values), categories = self.names))
+
+    # the names in any of the country columns which aren't known, with the number of rows each appears in
+    def unmapped(self, *columns):
+        values = pd.concat([pd.Series(col, dtype = object) for col in columns], ignore_index = True)
+        missing = values[(self.codes(values) == -1) & values.notna()]
+        return(missing.value_counts().rename_axis('name').rename('rows'))
+
+    # look a table keyed by country names up by code: returns an array where entry code holds the value of that country
+    # (the first row of the table for it, fill for countries the table doesn't have)
+    def by_code(self, keys, values, fill = np.nan):
+        table = np.full(len(self.names) + 1, fill, dtype = object)
+        key_codes = self.codes(keys)
+        values = np.asarray(values, dtype = object)
+        # assigning in reverse lets the first row of a country win
+        table[key_codes[::-1]] = values[::-1]
+        table[-1] = fill
+        return(table)
 
 # %%
 def parse_raw_data():
@@ -32,36 +139,54 @@ def gen_and_check_missing_names_list(tong_ctry, scen_ctry, coal_ctry, gas_ctry,
     # Read the file with a two column list mapping the correct country names to all alternative specifications
     # if any of the country names in the original data inputs have been changed, it's possible they aren't included in this file
     # this function will throw an error if this is the case
-    alt_names_file = pd.read_csv('data/accurate_cntry_name_mapping.csv', usecols = ['country.name.en', 'country.name.alt'], dtype = str)
+    resolver = CountryResolver.from_csv('data/accurate_cntry_name_mapping.csv')
 
-    # combine all these country names into a seires, and remove the repeats
-    countries_in_data = pd.concat([tong_ctry['Country']] + [scen_ctry['country']] + [coal_ctry['Country']] + [gas_ctry['Country']] + [steel_ctry['Country']]).drop_duplicates(keep='first')
+    for alt, first, other in getattr(resolver, 'conflicts', []):
+        print(f'<{alt}> is listed as an alternative name for both <{first}> and <{other}>, it will be resolved to <{first}>')
 
     # check what values from the countries in the data are not in the alt names file, and add these to a file cataloging these discrepancies
-    missing_name_specifications = pd.DataFrame(countries_in_data[countries_in_data.isin(alt_names_file['country.name.alt']) == False].values)
+    # (with the number of rows each one appears in)
+    missing_name_specifications = resolver.unmapped(tong_ctry['Country'], scen_ctry['country'], coal_ctry['Country'], gas_ctry['Country'], steel_ctry['Country'])
 
     # write this file to a csv
-    missing_name_specifications.to_csv('data/missing_alt_names.csv', index = False)
+    missing_name_specifications.reset_index().to_csv('data/missing_alt_names.csv', index = False)
     print('any country names in the data which missing from the country name mapping file <accurate_cntry_name_mapping.csv> have been written to <missing_alt_names.csv>')
 
     # check that the length of this file is 0, because if not, that means that there are some unmapped countries or regions in the data
-    if len(missing_name_specifications.values) != 0:
+    if len(missing_name_specifications) != 0:
         raise Exception('All countries in the data are not accounted for in the alt names file, revise the file locally and run again')
 
     print('country name mapping file <accurate_cntry_name_mapping.csv> parsed, no missing country names were found')
+
+    # save the resolver so the later stages use the same country codes
+    resolver.save()
     
     # return the clean country mapping (if there are no country names unspecified by the alt names file)
-    return(alt_names_file)
+    return(resolver)
+
+# %%
+# replace the country column of a dataset with the accurate names, as the first column named 'country.name.en'
+# rows are grouped by country in the order of the mapping file, like joining on the mapping file grouped them, but never duplicated
+def fix_cntry_col(resolver, df, col):
+
+    codes = resolver.codes(df[col])
+    df = df[codes != -1]
+    codes = codes[codes != -1]
+
+    fixed = df.drop(columns = col)
+    fixed.insert(0, 'country.name.en', np.array(resolver.names, dtype = object)[codes])
+
+    return(fixed.iloc[np.argsort(codes, kind = 'stable')].reset_index(drop = True))
 
 # %%
-def export_cntry_data_fix(clean_country_mapping, tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry):
+def export_cntry_data_fix(resolver, tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry):
 
-    # try to replace the country names in each dataset with the country names suggested by the mapping
-    tong_cntry_fix = clean_country_mapping.merge(tong_ctry, left_on = 'country.name.alt', right_on = 'Country', how = 'inner').drop(columns = ['country.name.alt', 'Country'])
-    scen_cntry_fix = clean_country_mapping.merge(scen_ctry, left_on = 'country.name.alt', right_on = 'country', how = 'inner').drop(columns = ['country.name.alt', 'country'])
-    coal_cntry_fix = clean_country_mapping.merge(coal_ctry, left_on = 'country.name.alt', right_on = 'Country', how = 'inner').drop(columns = ['country.name.alt', 'Country'])
-    gas_cntry_fix = clean_country_mapping.merge(gas_ctry, left_on = 'country.name.alt', right_on = 'Country', how = 'inner').drop(columns = ['country.name.alt', 'Country'])
-    steel_cntry_fix = clean_country_mapping.merge(steel_ctry, left_on = 'country.name.alt', right_on = 'Country', how = 'inner').drop(columns = ['country.name.alt', 'Country'])
+    # replace the country names in each dataset with the country names suggested by the mapping
+    tong_cntry_fix = fix_cntry_col(resolver, tong_ctry, 'Country')
+    scen_cntry_fix = fix_cntry_col(resolver, scen_ctry, 'country')
+    coal_cntry_fix = fix_cntry_col(resolver, coal_ctry, 'Country')
+    gas_cntry_fix = fix_cntry_col(resolver, gas_ctry, 'Country')
+    steel_cntry_fix = fix_cntry_col(resolver, steel_ctry, 'Country')
 
     # write the data with cleaned country names to the appropriate file
     tong_cntry_fix.to_csv('data/tong_cntry_fix.csv')
@@ -79,13 +204,14 @@ def countrynamefix():
    
     # execute component functions in order
     tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry = parse_raw_data()
-    clean_country_mapping = gen_and_check_missing_names_list(tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry)
-    tong_cntry_fix, scen_cntry_fix, coal_cntry_fix, gas_cntry_fix, steel_cntry_fix = export_cntry_data_fix(clean_country_mapping, tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry)
+    resolver = gen_and_check_missing_names_list(tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry)
+    tong_cntry_fix, scen_cntry_fix, coal_cntry_fix, gas_cntry_fix, steel_cntry_fix = export_cntry_data_fix(resolver, tong_ctry, scen_ctry, coal_ctry, gas_ctry, steel_ctry)
     
     return(tong_cntry_fix, scen_cntry_fix, coal_cntry_fix, gas_cntry_fix, steel_cntry_fix)
 
 # %%
 if __name__ == "__main__":
     countrynamefix
+    CountryResolver
 
 
@@ -0,0 +1,230 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+from aggregate import YEARS, ASSETS, ordered_union, make_yr_based_total, master_plants
+from expectations import load_credences
+from rcp_ssp import as_scen_keys, scen_rows
+from storage import save_panel
+
+# %% [markdown]
+# ### Monte Carlo ensemble of the emissions trajectories
+# The master file holds one trajectory per country and scenario. The ensemble draws N samples of the uncertain inputs:
+# - the lifetimes of the plants whose retirement year was assumed (start + 40, or the random extension of old steel plants)
+# - a utilization and an emissions intensity multiplier per country for the steel plants (when they are included, like in the master file)
+# - the credences of the scenarios, from a Dirichlet distribution centred on the Central credences
+#   (the raw Central weights, not renormalized, so the mean sample weights the scenarios like make_expectations_over_levels does)
+# and pushes all of them through the same definitions the master file uses, as a (sample x country x year) array:
+# - committed: the Tong committed emissions, which are the same in every sample
+# - considered: coal and gas plants which aren't operating, scaled up by the country's industry/electricity ratio, plus steel plants which aren't operating if included
+# - expectable: the credence weighted scenario emissions, minus the committed and considered ones
+# Countries are processed in blocks small enough to hold every sample of the block in memory at once,
+# and every random draw is made per country, so the results don't depend on the block sizes.
+
+# %%
+METRICS = ['commit', 'consid', 'expectable']
+
+# %%
+# the (country x year) arrays which are the same in every sample: committed emissions and the industry/electricity ratio
+def make_country_constants(tong, countries):
+
+    comm_total = make_yr_based_total(tong, 'commit.total.')
+    elec_commit = make_yr_based_total(tong[['country'] + [col for col in tong.columns if 'Electricity' in col]], 'elec.commit.total.')
+
+    rows = pd.Index(tong['country']).get_indexer(countries)
+    found = rows >= 0
+
+    commit = np.zeros((len(countries), len(YEARS)))
+    commit[found] = comm_total[['commit.total.' + str(year) for year in YEARS]].to_numpy(dtype = float)[rows[found]]
+
+    # considered industry emissions are the considered electricity emissions times industry 2021 / committed electricity 2021
+    industry_ratio = np.zeros(len(countries))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratio = tong['Industry.2021'].to_numpy(dtype = float) / elec_commit['elec.commit.total.2021'].to_numpy(dtype = float)
+    industry_ratio[found] = ratio[rows[found]]
+    industry_ratio[~np.isfinite(industry_ratio)] = 0
+
+    return(np.nan_to_num(commit), industry_ratio)
+
+# %%
+# the (country x scenario x year) scenario emissions, for the scenarios which have a credence
+def make_scenario_array(scen, countries, credence):
+
+    # the scenarios are matched on the integer codes of their typed SSP and RCP keys
+    scen_keys = ['SSP', 'RCP']
+    credence, scen = as_scen_keys(credence), as_scen_keys(scen)
+    scenarios = credence[credence['Central'].fillna(0) > 0][scen_keys].drop_duplicates().dropna().reset_index(drop = True)
+    central = credence['Central'].to_numpy(dtype = float)[scen_rows(credence, scenarios)]
+
+    scen_arr = np.zeros((len(countries), len(scenarios), len(YEARS)))
+    cntry_idx = pd.Index(countries).get_indexer(scen['country'])
+    scen_idx = scen_rows(scenarios, scen)
+    keep = (cntry_idx >= 0) & (scen_idx >= 0)
+
+    scen_arr[cntry_idx[keep], scen_idx[keep]] = np.nan_to_num(scen[[str(year) for year in YEARS]].to_numpy(dtype = float)[keep])
+
+    return(scenarios, central, scen_arr)
+
+# %%
+# the plants which aren't committed (operating, or whichever stati their asset registered), stacked into arrays, with which samples they need
+# kind: 0 if the retirement year is fixed, 1 if it is start + a sampled lifetime, 2 if it is start + age + a sampled extension
+def make_consid_plants(plants):
+
+    cols = ['country', 'Status', 'Start year', 'Planned retire']
+    stacked = pd.concat([df[cols].assign(**{'CO2 (Mt/yr)': df[ASSETS[asset]['co2_col']]},
+                                         steel = asset == 'steel', committed = df['Status'].isin(ASSETS[asset]['committed']),
+                                         rule = df['Retire rule'] if 'Retire rule' in df.columns else 'fixed',
+                                         age = df['Plant age (years)'] if 'Plant age (years)' in df.columns else np.nan)
+                         for asset, df in plants.items()], ignore_index = True)
+    stacked = stacked[~stacked['committed']]
+
+    kind = np.select([stacked['rule'] == 'start + 40', stacked['rule'] == 'steel age extension'], [1, 2], default = 0)
+
+    return({'country': stacked['country'].to_numpy(), 'start': stacked['Start year'].to_numpy(dtype = float),
+            'retire': stacked['Planned retire'].to_numpy(dtype = float), 'co2': np.nan_to_num(stacked['CO2 (Mt/yr)'].to_numpy(dtype = float)),
+            'steel': stacked['steel'].to_numpy(dtype = bool), 'age': stacked['age'].to_numpy(dtype = float), 'kind': kind})
+
+# %%
+# the CO2 operating in each year of each sample, for plants starting in first_yr and retiring in end_yr (both sample x plant or plant)
+# the plants' events are binned by sample and year with one bincount, and the running sum over the years is the active CO2
+def sample_activity(first_yr, end_yr, co2, n_samples):
+
+    n_yrs = len(YEARS)
+    first_yr, end_yr = np.broadcast_to(first_yr, (n_samples, len(co2))), np.broadcast_to(end_yr, (n_samples, len(co2)))
+    co2 = np.broadcast_to(co2, (n_samples, len(co2)))
+
+    active = first_yr < end_yr
+    sample = np.broadcast_to(np.arange(n_samples)[:, None], first_yr.shape)
+
+    size = n_samples * (n_yrs + 1)
+    events = np.bincount((sample * (n_yrs + 1) + first_yr)[active], co2[active], minlength = size)
+    events -= np.bincount((sample * (n_yrs + 1) + end_yr)[active], co2[active], minlength = size)
+
+    return(np.cumsum(events.reshape(n_samples, n_yrs + 1), axis = 1)[:, :-1])
+
+# %%
+# the first (or first inactive) year of plants as indices into YEARS, like make_activity_cube counts them
+# missing years get the index missing, so that plants without a start or retirement year never operate
+def year_index(yr, missing):
+    return(np.clip(np.nan_to_num(np.ceil(yr) - YEARS[0], nan = missing), 0, len(YEARS)).astype(np.int64))
+
+# %%
+# the considered electricity and steel emissions of one country in every sample, as (sample x year) arrays
+# the lifetimes are drawn chunk_size samples at a time, so the memory used doesn't grow with the number of plants times samples
+def sample_country_consid(plants, rng, n_samples, lifetime_range, chunk_size):
+
+    elec, steel = np.zeros((n_samples, len(YEARS))), np.zeros((n_samples, len(YEARS)))
+
+    first_yr = year_index(plants['start'], len(YEARS))
+
+    for is_steel, out in [(False, elec), (True, steel)]:
+        fixed = (plants['steel'] == is_steel) & (plants['kind'] == 0)
+        out += sample_activity(first_yr[fixed], year_index(plants['retire'][fixed], 0), plants['co2'][fixed], 1)
+
+    sampled = np.flatnonzero(plants['kind'] > 0)
+    if len(sampled) == 0:
+        return(elec, steel)
+
+    # lifetimes for the plants assumed to run for 40 years, and 1 to 15 extra years for old steel plants past their age
+    base = np.where(plants['kind'][sampled] == 1, plants['start'][sampled], plants['start'][sampled] + plants['age'][sampled])
+    low, high = np.where(plants['kind'][sampled] == 1, lifetime_range[0], 1), np.where(plants['kind'][sampled] == 1, lifetime_range[1], 15)
+    is_steel = plants['steel'][sampled]
+
+    for lo in range(0, n_samples, chunk_size):
+        hi = min(lo + chunk_size, n_samples)
+        lifetimes = rng.integers(low, high + 1, size = (hi - lo, len(sampled)))
+        end_yr = year_index(base + lifetimes, 0)
+
+        for steel_plants, out in [(False, elec), (True, steel)]:
+            sel = is_steel == steel_plants
+            if sel.any():
+                out[lo:hi] += sample_activity(first_yr[sampled][sel], end_yr[:, sel], plants['co2'][sampled][sel], hi - lo)
+
+    return(elec, steel)
+
+# %%
+# draw the credences of every sample from a Dirichlet distribution with the Central credences as its mean
+# the Dirichlet draws shares summing to 1, they are scaled back to the total of the Central credences, which needn't be 1
+# a larger concentration keeps the samples closer to the Central credences
+def sample_credences(central, n_samples, concentration, seed):
+    rng = np.random.default_rng([seed, 0])
+    total = central.sum()
+    return(total * rng.dirichlet(concentration * central / total, size = n_samples))
+
+# %%
+# the percentile bands of the committed, considered, and expectable emissions of every country
+# plants is a dict of the cleaned plant tables (e.g. {'coal': coal, 'gas': gas, 'steel': steel}), tong and scen are the cleaned Tong and scenario data
+# returns one row per country, with the columns {metric}.total.p{percentile}.{year} and {metric}.total.mean.{year}
+def run_ensemble(plants, tong, scen, n_samples = 1000, percentiles = [5, 50, 95], seed = 0, lifetime_range = (30, 50),
+                 steel_sigma = (0.1, 0.1), concentration = 20, max_bytes = 1 << 29, credence = None):
+
+    credence = load_credences() if credence is None else credence
+
+    consid_plants = make_consid_plants(plants)
+    countries = ordered_union([consid_plants['country'], tong['country'], scen['country']])
+    countries = np.array([c for c in countries if not pd.isna(c)], dtype = object)
+
+    commit, industry_ratio = make_country_constants(tong, countries)
+    scenarios, central, scen_arr = make_scenario_array(scen, countries, credence)
+    weights = sample_credences(central, n_samples, concentration, seed)
+
+    # the rows of each country's plants
+    plant_rows = pd.Series(np.arange(len(consid_plants['country']))).groupby(consid_plants['country']).indices
+
+    # the countries of a block have all their samples held in three (sample x country x year) float32 arrays at once
+    block_size = max(1, int(max_bytes // (len(METRICS) * n_samples * len(YEARS) * 4)))
+    chunk_size = max(1, int(2e6 // max(1, max(len(rows) for rows in plant_rows.values()) if plant_rows else 1)))
+
+    bands = {metric: np.zeros((len(countries), len(percentiles) + 1, len(YEARS))) for metric in METRICS}
+
+    for lo in range(0, len(countries), block_size):
+        block = range(lo, min(lo + block_size, len(countries)))
+        samples = {metric: np.zeros((n_samples, len(block), len(YEARS)), dtype = np.float32) for metric in METRICS}
+
+        for b, c in enumerate(block):
+            # each country draws from its own stream, so its samples don't depend on which block it is in
+            rng = np.random.default_rng([seed, 1, c])
+            steel_mult = np.exp(rng.normal(0, steel_sigma[0], n_samples) + rng.normal(0, steel_sigma[1], n_samples))
+
+            rows = plant_rows.get(countries[c], np.array([], dtype = int))
+            elec, steel = sample_country_consid({k: v[rows] for k, v in consid_plants.items()}, rng, n_samples, lifetime_range, chunk_size)
+
+            consid = elec * (1 + industry_ratio[c]) + steel * steel_mult[:, None]
+            expected_scen = weights @ scen_arr[c]
+
+            samples['commit'][:, b] = commit[c]
+            samples['consid'][:, b] = consid
+            samples['expectable'][:, b] = expected_scen - commit[c] - consid
+
+        for metric in METRICS:
+            bands[metric][block.start:block.stop, :-1] = np.percentile(samples[metric], percentiles, axis = 0).transpose(1, 0, 2)
+            bands[metric][block.start:block.stop, -1] = samples[metric].mean(axis = 0, dtype = np.float64)
+
+        print(f'ensemble of {n_samples} samples drawn for countries {block.start + 1}-{block.stop} of {len(countries)}')
+
+    # one wide row per country, in the year column format the rest of the pipeline uses
+    labels = [f'p{q:02g}' for q in percentiles] + ['mean']
+    col_names = [f'{metric}.total.{label}.{year}' for metric in METRICS for label in labels for year in YEARS]
+
+    result = pd.DataFrame(np.concatenate([bands[metric].reshape(len(countries), -1) for metric in METRICS], axis = 1), columns = col_names)
+    result.insert(0, 'country', countries)
+
+    return(result)
+
+# %%
+# run the ensemble and write the bands next to the master file
+# include_steel adds the steel plants, like it does to the master file (see aggregate_to_master)
+def make_ensemble(coal, gas, steel, tong, scen, n_samples = 1000, seed = 0, include_steel = False):
+
+    plants = master_plants(coal, gas, steel, include_steel)
+    bands = run_ensemble(plants, tong, scen, n_samples = n_samples, seed = seed)
+
+    bands.to_csv('data/ensemble_bands.csv', index = False)
+    save_panel(bands, 'data/ensemble_bands')
+
+    return(bands)
+
+# %%
+if __name__ == "__main__":
+    run_ensemble
+    make_ensemble
@@ -1,36 +1,112 @@
 # %%
 import pandas as pd
 import numpy as np
+import os
+from rcp_ssp import as_scen_keys, scen_rows
+
+# %% [markdown]
+# ### Weighting the scenarios by their credences
+# Every row of the data (a country under one SSP/RCP scenario) is weighted by the credence of its scenario.
+# The credences are read once, every weight vector (Central, Optimistic, Pessimistic) is applied in one broadcast multiply
+# over the numeric block, and the weighted rows are summed into each level (country, region, world) from one grouped reduction.
 
 # %%
-def make_expectation_over_data(data, area):
-    
-    credence = pd.read_csv('data/credences-venmans-carr.csv')
+CREDENCE_FILE = 'data/credences-venmans-carr.csv'
+
+# the weight vectors in the credence file, some of its column names are spaced or capitalised differently
+WEIGHTS = ['Central', 'Optimistic', 'Pessimistic']
 
-    scen_and_prob = data.merge(credence, on = ['RCP', 'SSP'], how = 'inner').fillna(0)
+# the columns each level keeps, besides the scenario
+LEVELS = {'country': ['country', 'region'], 'region': ['region'], 'world': []}
 
-    # make a copy of the merged data in order to weight it
-    scen_and_prob_weighted = scen_and_prob.copy()
+# %%
+# read the credences, only again once the file changes, with their SSP and RCP as typed keys
+CREDENCES = {}
 
-    # make active cols which should be weighted separate variable, matters b/c prob vars shouldn't be included
-    # in final output or get weighted by the following calculation
-    prob_cols_to_ignore = ['country', 'region', 'SSP', 'RCP', 'Central', 'Pessimistic', ' optimistic']
+def load_credences(path = CREDENCE_FILE):
 
-    # multiply each row of emissions in the merged dataset of global emissions by the central probability of it's scenario 
-    # by its data's central estimate of the likelyhood
-    for col in scen_and_prob_weighted:
-        if col not in prob_cols_to_ignore:
-            scen_and_prob_weighted[col] = scen_and_prob_weighted[col] * scen_and_prob_weighted['Central']
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
 
-    columns_to_drop = ['Central', ' optimistic', 'Pessimistic']
-    existing_columns_to_drop = [col for col in columns_to_drop if col in scen_and_prob_weighted.columns]
+    if memo_key not in CREDENCES:
+        credence = as_scen_keys(pd.read_csv(path))
+        credence.columns = [col.strip().capitalize() if col.strip().lower() in [w.lower() for w in WEIGHTS] else col for col in credence.columns]
+        CREDENCES.clear()
+        CREDENCES[memo_key] = credence
 
-    expectation = scen_and_prob_weighted.groupby(['country', 'region', 'SSP', 'RCP']).sum().drop(columns=existing_columns_to_drop).reset_index()
-    
-    return(expectation)
+    return(CREDENCES[memo_key])
 
 # %%
-if __name__ == "__main__":
-    make_expectation_over_data
+# sum the rows of a (weights x rows x cols) array by group, for groups of the key columns (sorted like groupby sorts them)
+def grouped_sum(keys, values):
+
+    group = keys.groupby(list(keys.columns), sort = True, observed = True).ngroup().to_numpy()
+    order = np.argsort(group, kind = 'stable')
+    starts = np.flatnonzero(np.diff(np.concatenate([[-1], group[order]])))
+
+    summed = np.add.reduceat(values[:, order], starts, axis = 1) if len(order) else values[:, :0]
+    group_keys = keys.iloc[order[starts]].reset_index(drop = True)
+
+    return(group_keys, summed)
+
+# %%
+# weight the data by the credence of each row's scenario and sum it into each level
+# returns {weight: {level: df}}, where each df has the level's columns, SSP and RCP, and the weighted data
+def make_expectations_over_levels(data, levels = ['country', 'region', 'world'], weights = ['Central'], credence = None):
+
+    credence = load_credences() if credence is None else as_scen_keys(credence)
+    data = as_scen_keys(data)
+
+    # match each row to its scenario's credences on the integer codes of the typed keys,
+    # dropping the rows of scenarios without any (like the inner merge did)
+    scen_keys = ['RCP', 'SSP']
+    cred_row = scen_rows(credence, data)
+    data = data[cred_row != -1].reset_index(drop = True)
+    cred_row = cred_row[cred_row != -1]
+
+    # the other columns of the credence file are carried along (and weighted) like the data's columns were after the merge
+    cred_extra = credence.drop(columns = scen_keys + [w for w in WEIGHTS if w in credence.columns]).iloc[cred_row].reset_index(drop = True)
 
+    key_cols = [col for col in ['country', 'region', 'SSP', 'RCP'] if col in data.columns]
+    value_data = pd.concat([data.drop(columns = key_cols), cred_extra], axis = 1)
+    value_cols = [col for col in value_data.columns if pd.api.types.is_numeric_dtype(value_data[col])]
 
+    # one multiply of the (rows x cols) block by every (weights x rows) credence vector
+    # (in float32 when the data is all float32, like the compact master, so the weighted block stays half the size)
+    dtype = np.float32 if all(value_data[col].dtype == np.float32 for col in value_cols) else np.float64
+    block = value_data[value_cols].to_numpy(dtype = dtype)
+    block[np.isnan(block)] = 0
+    weight_rows = credence[weights].to_numpy(dtype = dtype)[cred_row].T
+    weight_rows[np.isnan(weight_rows)] = 0
+    weighted = weight_rows[:, :, None] * block[None, :, :]
+
+    # reduce the rows once to the finest level asked for, the coarser levels are sums of its (far fewer) rows
+    # (a categorical key, like those of the compact master, gets 0 as a category first)
+    keys = pd.DataFrame({col: (data[col].cat.add_categories([0]) if isinstance(data[col].dtype, pd.CategoricalDtype) and 0 not in data[col].cat.categories
+                               else data[col]).fillna(0) for col in key_cols})
+    finest = [level for level in LEVELS if level in levels][0]
+    fine_keys, fine_sum = grouped_sum(keys[[col for col in key_cols if col in LEVELS[finest] + ['SSP', 'RCP']]], weighted)
+
+    expectations = {weight: {} for weight in weights}
+    for level in levels:
+        level_cols = [col for col in LEVELS[level] + ['SSP', 'RCP'] if col in fine_keys.columns]
+        level_keys, level_sum = (fine_keys, fine_sum) if level == finest else grouped_sum(fine_keys[level_cols], fine_sum)
+
+        for w, weight in enumerate(weights):
+            expectation = pd.DataFrame(level_sum[w], columns = value_cols)
+            expectations[weight][level] = pd.concat([level_keys, expectation], axis = 1)
+
+    return(expectations)
+
+# %%
+# the expectation at one level: area is 'country', 'region', or the scenario columns ['SSP', 'RCP'] for the world
+def make_expectation_over_data(data, area, weight = 'Central'):
+
+    level = area if isinstance(area, str) else 'world'
+
+    return(make_expectations_over_levels(data, [level], [weight])[weight][level])
+
+# %%
+if __name__ == "__main__":
+    make_expectation_over_data
+    make_expectations_over_levels
@@ -0,0 +1,225 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+import os
+from storage import year_cols
+from scen_match import rank_within_groups
+from expectations import load_credences, grouped_sum
+from rcp_ssp import as_scen_keys, scen_rows, scen_codes
+
+# %% [markdown]
+# ### Carbon lock-in metrics
+# The lock-in of a row (a country, a region or the world under one SSP/RCP scenario) is the share of the scenario's emissions
+# taken up by the committed and considered emissions of long-lived assets:
+# - lock_in: consid+commit / scenario emissions in each year, and its commit_ and consid_ parts
+# - cum_lock_in: the same for the emissions summed from 2021 through each year (the cumulative long-lived fraction of the maps)
+# - lock_in_year: the first year in which the summed committed and considered emissions reach the scenario's, NaN if they never do
+# - rank: where the row's cumulative lock-in ranks among the rows of its level under the same scenario in each year (1 is the most locked in)
+# A region's (and the world's) lock-in is the ratio of its summed emissions, and the lock-in in expectation is the ratio of the
+# credence weighted sums over the scenarios, not a sum of ratios. A year whose (summed) scenario emissions are 0 or negative has no lock-in.
+# Every metric of every row and year comes out of a few operations on the (row x year) blocks of the master file, this replaces
+# the loops of notebooks calculate_lock-in_metric.ipynb and lock-in_metric_analysis.ipynb.
+
+# %%
+YEARS = np.arange(2021, 2101)
+
+# the metric of the master file each part of the lock-in is the share of
+PARTS = {'lock_in': 'consid+commit.total', 'commit_lock_in': 'commit.total', 'consid_lock_in': 'consid.total'}
+
+# the key columns of each level, and the columns of its areas (the expectation sums the scenarios of each area)
+LEVELS = {'country': (['country', 'region', 'SSP', 'RCP'], ['country', 'region']), 'region': (['region', 'SSP', 'RCP'], ['region']),
+          'world': (['SSP', 'RCP'], [])}
+
+# the scenarios the thesis tables single out, and the years of its cumulative lock-in columns
+HIGHLIGHTS = [('SSP1', 1.9), ('SSP2', 4.5), ('SSP5', 6.0)]
+TABLE_YEARS = [2030, 2050, 2070, 2100]
+
+# where the lock-in tables and the results tables are written (processed, results)
+# by default to data/lock_in, the committed tables made by the notebooks are only overwritten when asked for, as the formulas here
+# haven't been checked against those of calculate_lock-in_metric.ipynb yet
+OUTPUT_DIRS = ('data/lock_in/', 'data/lock_in/results_tables/')
+NOTEBOOK_DIRS = ('data/processed/', 'data/thesis_results_tables/')
+
+# %%
+# a / b where b > 0, NaN elsewhere
+def share(a, b):
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return(np.where(b > 0, a / b, np.nan))
+
+# the year each row's cumulative lock-in first reaches 1, NaN if it never does
+def lock_in_year(cum_lock_in):
+
+    reached = cum_lock_in >= 1
+    return(np.where(reached.any(axis = 1), YEARS[reached.argmax(axis = 1)], np.nan))
+
+# %%
+# the lock-in metrics of every row at once
+# parts is a dict of the (row x year) emission blocks named in PARTS, scen the (row x year) block of the scenario emissions,
+# groups is the scenario (or any group) each row is ranked within
+def lock_in_block(parts, scen, groups):
+
+    cum_scen = np.cumsum(scen, axis = 1)
+
+    metrics = {}
+    for name, part in parts.items():
+        metrics[name] = share(part, scen)
+        metrics['cum_' + name] = share(np.cumsum(part, axis = 1), cum_scen)
+
+    # rank the rows from the most locked in down, the rows without a cumulative lock-in in a year get no rank
+    cum = metrics['cum_lock_in']
+    ranks = rank_within_groups(np.where(np.isnan(cum), np.inf, -cum), groups) + 1.0
+    ranks[np.isnan(cum)] = np.nan
+    metrics['rank'] = ranks
+
+    return(metrics, lock_in_year(cum))
+
+# %%
+# the (row x year) blocks of the parts of the lock-in and of the scenario emissions of a wide df
+def emission_blocks(data):
+
+    parts = {name: data[year_cols(data.columns, metric, YEARS)].to_numpy(dtype = float) for name, metric in PARTS.items()}
+    scen = data[year_cols(data.columns, '', YEARS)].to_numpy(dtype = float)
+
+    return(parts, scen)
+
+# the lock-in table of the keys and metric blocks, one column per metric and year named {metric}.{year}, then the lock-in year
+def lock_in_table(keys, metrics, year):
+
+    # write every metric into one preallocated array, then build the df around it
+    values = np.empty((len(keys), len(metrics) * len(YEARS)))
+    for m, block in enumerate(metrics.values()):
+        values[:, m * len(YEARS):(m + 1) * len(YEARS)] = block
+
+    table = pd.DataFrame(values, columns = [f'{metric}.{yr}' for metric in metrics for yr in YEARS], copy = False)
+    table.insert(0, 'lock_in_year', year)
+    for i, col in enumerate(keys.columns):
+        table.insert(i, col, keys[col].values)
+
+    return(table)
+
+# %%
+# the lock-in of every row of one level of the data under each scenario (the rows without a scenario are left out)
+def lock_in_by_scenario(data, level):
+
+    keys = [col for col in LEVELS[level][0] if col in data.columns]
+    data = as_scen_keys(data)
+    data = data[(data['SSP'].astype(str) != '0') & (data['RCP'].astype(str) != '0')].reset_index(drop = True)
+
+    parts, scen = emission_blocks(data)
+    metrics, year = lock_in_block(parts, np.nan_to_num(scen), scen_codes(data))
+
+    return(lock_in_table(data[keys], metrics, year))
+
+# the lock-in in expectation of every area of one level: the emissions of its scenarios are weighted by their credences and summed first
+def lock_in_in_expectation(data, level, weight = 'Central', credence = None):
+
+    credence = load_credences() if credence is None else as_scen_keys(credence)
+    data = as_scen_keys(data)
+
+    # the rows of scenarios without a credence are left out, like in the expectations
+    cred_row = scen_rows(credence, data)
+    data = data[cred_row != -1].reset_index(drop = True)
+    weights = np.nan_to_num(credence[weight].to_numpy(dtype = float)[cred_row[cred_row != -1]])
+
+    # weight the parts and the scenario emissions at once, as one (row x part/scenario x year) block
+    parts, scen = emission_blocks(data)
+    block = np.nan_to_num(np.stack(list(parts.values()) + [scen], axis = 1)) * weights[:, None, None]
+
+    # sum the scenarios of each area, the world is one area
+    # (missing keys, e.g. the region of a country without one, are grouped as 0 like in the expectations)
+    area_cols = [col for col in LEVELS[level][1] if col in data.columns]
+    if area_cols:
+        keys = pd.DataFrame({col: (data[col].cat.add_categories([0]) if isinstance(data[col].dtype, pd.CategoricalDtype) and 0 not in data[col].cat.categories
+                                   else data[col]).fillna(0) for col in area_cols})
+        area_keys, summed = grouped_sum(keys, block.reshape(len(data), -1)[None])
+        summed = summed[0].reshape(len(area_keys), -1, len(YEARS))
+    else:
+        area_keys, summed = pd.DataFrame(index = [0]), block.sum(axis = 0, keepdims = True)
+
+    # the areas are ranked against each other
+    metrics, year = lock_in_block(dict(zip(parts, summed[:, :-1].transpose(1, 0, 2))), summed[:, -1], np.zeros(len(area_keys), dtype = int))
+
+    return(lock_in_table(area_keys.reset_index(drop = True), metrics, year))
+
+# %%
+# the file name label of a scenario, e.g. ssp2_rcp45
+def scen_label(ssp, rcp):
+    return(f"{ssp.lower()}_rcp{str(rcp).replace('.', '')}")
+
+# the rows of a lock-in table under one scenario
+def scenario_slice(table, ssp, rcp):
+    return(table[(table['SSP'].astype(str) == ssp) & (table['RCP'].astype(str) == str(rcp))].reset_index(drop = True))
+
+# %%
+# the thesis results tables, made from the lock-in tables
+# - lock-in by scenario: the cumulative lock-in of the world under every scenario in the table years, and its lock-in year
+# - lock-in values in expectation: the cumulative lock-in in expectation of the world and every region in the table years
+# - a time series of the cumulative lock-in of each region under each highlighted scenario
+def make_results_tables(lock_in):
+
+    table_cols = ['cum_lock_in.' + str(yr) for yr in TABLE_YEARS]
+
+    by_scenario = lock_in['world'][['SSP', 'RCP'] + table_cols + ['lock_in_year']]
+
+    world_exp = lock_in['world_exp'].assign(region = 'World')
+    values_exp = pd.concat([world_exp, lock_in['region_exp']], ignore_index = True)[['region'] + table_cols + ['lock_in_year']]
+
+    tables = {'lock-in_by_scenario': by_scenario, 'lock-in_values_exp': values_exp}
+    for ssp, rcp in HIGHLIGHTS:
+        rgn = scenario_slice(lock_in['region'], ssp, rcp)
+        series = rgn[['region'] + year_cols(rgn.columns, 'cum_lock_in')]
+        series.columns = ['region'] + [str(yr) for yr in YEARS]
+        tables[f'rgn_lock-in_time_series_{ssp}-RC'] = series
+
+    return(tables)
+
+# %%
+# write the lock-in tables and the results tables, to OUTPUT_DIRS, or over the notebooks' files with overwrite_results = True
+def write_lock_in(lock_in, tables, overwrite_results = False):
+
+    processed, results = NOTEBOOK_DIRS if overwrite_results else OUTPUT_DIRS
+    os.makedirs(processed, exist_ok = True)
+    os.makedirs(results, exist_ok = True)
+
+    short = {'country': 'cntry', 'region': 'rgn', 'world': 'world'}
+    for level in LEVELS:
+        lock_in[level].to_csv(f'{processed}{short[level]}_lock_in_raw.csv')
+        lock_in[level + '_exp'].to_csv(f'{processed}{short[level]}_lock_in_exp.csv')
+
+    # the highlighted scenarios on their own, and the lock-in years of the regions under them
+    for ssp, rcp in HIGHLIGHTS:
+        label = scen_label(ssp, rcp)
+        for level in ['region', 'world']:
+            scenario_slice(lock_in[level], ssp, rcp).to_csv(f'{processed}{short[level]}_lock_in_{label}.csv')
+        scenario_slice(lock_in['region'], ssp, rcp)[['region', 'lock_in_year']].to_csv(f'{processed}rgn_yrs_lock_in_{label}.csv')
+
+    for name, table in tables.items():
+        table.to_csv(f'{results}{name}-Table 1.csv', index = False)
+
+# %%
+# every lock-in metric of the country, region and world rows under each scenario, and in expectation
+# cntry_rollup is the Rollup of the master file (see rollup.py), its region and world sums are the region and world rows
+# returns a dict of the lock-in tables, {level} and {level}_exp, and writes them and the results tables (see write_lock_in)
+def make_lock_in(cntry_rollup, weight = 'Central', write = True, overwrite_results = False):
+
+    data = {'country': cntry_rollup.data, 'region': cntry_rollup['region'], 'world': cntry_rollup['world']}
+
+    lock_in = {}
+    for level, level_data in data.items():
+        lock_in[level] = lock_in_by_scenario(level_data, level)
+        lock_in[level + '_exp'] = lock_in_in_expectation(level_data, level, weight)
+
+    print('lock-in metrics made for ' + ', '.join(data))
+
+    if write:
+        write_lock_in(lock_in, make_results_tables(lock_in), overwrite_results)
+
+    return(lock_in)
+
+# %%
+if __name__ == "__main__":
+    make_lock_in
+    lock_in_by_scenario
+    lock_in_in_expectation
@@ -0,0 +1,217 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+import contextlib
+import io
+import os
+from aggregate import make_master_blocks, normalize_master, ordered_union, master_plants
+
+# %% [markdown]
+# ### Building the master file from country shards on a process pool
+# Every value in the master file only depends on the data of its own country, so the countries are split into shards
+# (balanced by how many plants and scenario rows they have, and optionally keeping regions together), and each shard is
+# run through make_master_blocks and normalize_master on a worker process. The cleaned inputs are put into shared memory once,
+# as a float block and a block of categorical codes per table, so the workers only receive the row numbers of their shard.
+# The country and scenario tables of the shards are then merged back into the rows and columns the serial code produces,
+# and check = True compares the two.
+
+# %%
+# put the columns of a df into shared memory: numeric columns in one float64 block, the others as codes into their categories
+# returns the handle the workers rebuild it from, and the shared memory blocks (which the caller has to close and unlink)
+def share_frame(df):
+    from multiprocessing import shared_memory
+
+    num_cols = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    cat_cols = [col for col in df.columns if col not in num_cols]
+
+    blocks, handle = [], {'columns': list(df.columns), 'num_cols': num_cols, 'cat_cols': cat_cols, 'n_rows': len(df),
+                          'dtypes': {col: str(df[col].dtype) for col in num_cols}, 'categories': {},
+                          'cat_dtypes': {col: df[col].dtype for col in cat_cols if isinstance(df[col].dtype, pd.CategoricalDtype)}}
+
+    for part, cols, dtype in [('values', num_cols, np.float64), ('codes', cat_cols, np.int32)]:
+        shm = shared_memory.SharedMemory(create = True, size = max(1, len(df) * len(cols) * np.dtype(dtype).itemsize))
+        block = np.ndarray((len(df), len(cols)), dtype = dtype, buffer = shm.buf)
+
+        for i, col in enumerate(cols):
+            if part == 'values':
+                block[:, i] = df[col].to_numpy(dtype = np.float64)
+            else:
+                block[:, i], handle['categories'][col] = pd.factorize(df[col])
+
+        handle[part] = shm.name
+        blocks.append(shm)
+
+    return(handle, blocks)
+
+# %%
+# the shared memory blocks a worker has attached to, by name
+ATTACHED = {}
+
+def attach(name):
+    from multiprocessing import shared_memory
+
+    if name not in ATTACHED:
+        ATTACHED[name] = shared_memory.SharedMemory(name = name)
+    return(ATTACHED[name])
+
+# %%
+# rebuild the given rows of a shared df, with its original column order and dtypes
+def load_frame(handle, rows):
+
+    values = np.ndarray((handle['n_rows'], len(handle['num_cols'])), dtype = np.float64, buffer = attach(handle['values']).buf)
+    codes = np.ndarray((handle['n_rows'], len(handle['cat_cols'])), dtype = np.int32, buffer = attach(handle['codes']).buf)
+
+    cols = {}
+    for i, col in enumerate(handle['num_cols']):
+        cols[col] = values[rows, i].astype(handle['dtypes'][col])
+    for i, col in enumerate(handle['cat_cols']):
+        categories = np.append(np.asarray(handle['categories'][col], dtype = object), np.nan)
+        # code -1 (a missing value) picks the NaN appended to the categories
+        cols[col] = categories[codes[rows, i]]
+        # typed keys (e.g. SSP and RCP) get their categorical dtype back
+        if col in handle['cat_dtypes']:
+            cols[col] = pd.Categorical(cols[col], dtype = handle['cat_dtypes'][col])
+
+    return(pd.DataFrame({col: cols[col] for col in handle['columns']}))
+
+# %%
+# split the countries into n_shards groups with about the same amount of work, the largest countries (or regions) first
+# regions is an optional series mapping each country to its region, whose countries are then kept in the same shard
+def partition_countries(weights, n_shards, regions = None):
+
+    # countries without a region are a group of their own
+    labels = pd.Series(weights.index, index = weights.index)
+    if regions is not None:
+        labels = regions.reindex(weights.index).fillna(labels)
+
+    groups = weights.groupby(labels)
+    group_weights = groups.sum().sort_values(ascending = False, kind = 'stable')
+
+    shard_weights = np.zeros(n_shards)
+    shards = [[] for _ in range(n_shards)]
+
+    for group, weight in group_weights.items():
+        s = int(np.argmin(shard_weights))
+        shards[s] += list(groups.get_group(group).index)
+        shard_weights[s] += weight
+
+    return([shard for shard in shards if shard])
+
+# %%
+# the worker: rebuild the shard's inputs from shared memory and make its part of the (normalized) master file
+# extra is the names of the other registered assets among the inputs
+def run_shard(handles, rows, include_steel = False, extra = [], sparse = False):
+
+    inputs = {name: (load_frame(handle, rows[name]) if handle is not None else None) for name, handle in handles.items()}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        tables = normalize_master(*make_master_blocks(inputs['coal'], inputs['gas'], inputs['steel'], inputs['tong'], inputs['scen'], include_steel,
+                                                      {name: inputs[name] for name in extra}, sparse))
+
+    return(tables)
+
+# %%
+# the columns of the country and scenario tables the serial code makes for these inputs
+# the plant stati become columns in the order they first appear, so a run on the first plant of each status gives the same columns
+def master_columns(coal, gas, steel, tong, scen, include_steel = False, extra_plants = {}, sparse = False):
+
+    def first_of_each(df, key):
+        return(df.loc[df[[key, 'country']].dropna().drop_duplicates(key).index] if df is not None else None)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        schema = normalize_master(*make_master_blocks(first_of_each(coal, 'Status'), first_of_each(gas, 'Status'), first_of_each(steel, 'Status'),
+                                                      tong.iloc[:1], scen.iloc[:1], include_steel,
+                                                      {name: first_of_each(df, 'Status') for name, df in extra_plants.items()}, sparse))
+
+    return({kind: list(table.columns) for kind, table in schema.items()})
+
+# %%
+# put the rows of a merged table in the given order and its columns in the serial order
+# a status one shard has no plants of is a column of 0s there, like the serial code fills it
+def order_table(table, pos, columns, keys):
+
+    table = table.iloc[np.argsort(pos, kind = 'stable')].reset_index(drop = True)
+    table = table.reindex(columns = columns)
+    data_cols = [col for col in columns if col not in keys]
+    table[data_cols] = table[data_cols].fillna(0)
+
+    return(table)
+
+# merge the shard tables back into the serial row and column order
+def merge_shards(shard_tables, columns, coal, gas, tong, scen, steel = None, extra_plants = {}):
+
+    # the scenario rows are in the order of the scenario data
+    scenario = pd.concat([tables['scenario'] for tables in shard_tables], ignore_index = True)
+    scen_pos = pd.MultiIndex.from_frame(scen[['country', 'SSP', 'RCP']]).get_indexer(pd.MultiIndex.from_frame(scenario[['country', 'SSP', 'RCP']]))
+
+    # the countries are in the order they first appear in the scenario data, then the plant tables (gas, coal, and steel when it is included,
+    # in the order of the registry) and the Tong data
+    country = pd.concat([tables['country'] for tables in shard_tables], ignore_index = True)
+    plants = master_plants(coal, gas, steel, steel is not None, extra_plants)
+    cntry_order = pd.Index(ordered_union([scen['country']] + [df['country'] for df in plants.values()] + [tong['country']]))
+
+    return({'country': order_table(country, cntry_order.get_indexer(country['country']), columns['country'], ['country']),
+            'scenario': order_table(scenario, scen_pos, columns['scenario'], ['country', 'SSP', 'RCP'])})
+
+# %%
+# build the normalized master file (without regions) from country shards on n_workers processes
+# by = 'region' keeps the countries of each region of data/cntry_short_region_map.csv in the same shard
+# check = True also runs the serial code and raises if the outputs differ in any value, dtype, row or column
+def parallel_master(coal, gas, steel, tong, scen, n_workers = None, n_shards = None, by = 'country', check = False, include_steel = False, extra_plants = {},
+                    sparse = False):
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_workers = n_workers or os.cpu_count() or 1
+    n_shards = n_shards or n_workers
+
+    # the work of a country grows with its plants and scenario rows
+    inputs = {'coal': coal, 'gas': gas, 'steel': steel, **extra_plants, 'tong': tong, 'scen': scen}
+    weights = pd.concat([df['country'] for df in inputs.values() if df is not None]).dropna().value_counts() + 1
+
+    regions = None
+    if by == 'region':
+        regions = pd.read_csv('data/cntry_short_region_map.csv').drop_duplicates('country').set_index('country')['region']
+
+    shards = partition_countries(weights, n_shards, regions)
+
+    handles, blocks = {}, []
+    try:
+        for name, df in inputs.items():
+            handles[name] = None
+            if df is not None:
+                handles[name], df_blocks = share_frame(df)
+                blocks += df_blocks
+
+        # each shard gets the row numbers of its countries in every input
+        shard_rows = [{name: np.flatnonzero(df['country'].isin(shard).to_numpy()) for name, df in inputs.items() if df is not None} for shard in shards]
+
+        # fork where the platform has it, master.py has no __main__ guard so spawned workers would rerun the pipeline on import
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = ctx) as pool:
+            shard_tables = list(pool.map(run_shard, [handles] * len(shard_rows), shard_rows, [include_steel] * len(shard_rows),
+                                          [list(extra_plants)] * len(shard_rows), [sparse] * len(shard_rows)))
+
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    tables = merge_shards(shard_tables, master_columns(coal, gas, steel, tong, scen, include_steel, extra_plants, sparse), coal, gas, tong, scen,
+                          steel if include_steel else None, extra_plants)
+
+    print(f'master file assembled from {len(shards)} country shards on {n_workers} workers')
+
+    if check:
+        serial = normalize_master(*make_master_blocks(coal, gas, steel, tong, scen, include_steel, extra_plants, sparse))
+        for kind in serial:
+            pd.testing.assert_frame_equal(tables[kind], serial[kind], check_exact = True)
+        print('sharded master file matches the serial one exactly')
+
+    return(tables)
+
+# %%
+if __name__ == "__main__":
+    parallel_master
+    partition_countries
@@ -4,6 +4,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import warnings
+import contextlib
+from storage import year_cols
 #from expectations import make_expectation_over_data
 warnings.filterwarnings('ignore')
 
@@ -11,30 +13,16 @@ warnings.filterwarnings('ignore')
 #for each dataset, define a function which groups their columns by the plotting variables needed
 def make_plot_vars(dataset, affectability_status):
     
-    # decide on the plotting variables to creats
-    commit_total_cols = []
-    consid_total_cols = []
-    comm_cons_cols = []
-    consid_commit_scen_total_cols = []
-    expectable = []
-    yr_cols = []
-
+    # group the columns in the dataset by their metric, using the year parsed off the end of their names
     X = np.arange(2021, 2101)
-    # append columns in the dataset to the appropriate group based on their name
-    for col in dataset.columns:
-        for yr in X:
-            if 'commit.total.' + str(yr) == str(col):
-                commit_total_cols.append(col)
-            if 'consid.total.' + str(yr) == str(col):
-                consid_total_cols.append(col)
-            if 'consid+commit.total.' + str(yr) == str(col):
-                comm_cons_cols.append(col)
-            if 'consid+commit+scen.' + str(yr) == str(col):
-                consid_commit_scen_total_cols.append(col)
-            if 'expectable.' + str(yr) == str(col):
-                expectable.append(col)
-        if len(col) == 4:
-            yr_cols.append(col)
+    commit_total_cols = year_cols(dataset.columns, 'commit.total', X)
+    consid_total_cols = year_cols(dataset.columns, 'consid.total', X)
+    comm_cons_cols = year_cols(dataset.columns, 'consid+commit.total', X)
+    consid_commit_scen_total_cols = year_cols(dataset.columns, 'consid+commit+scen', X)
+    expectable = year_cols(dataset.columns, 'expectable', X)
+
+    # the scenario columns are named by their year alone
+    yr_cols = year_cols(dataset.columns, '')
             
     # set expectable emissions >= 0 in all cases
     for col in dataset[expectable].columns:
@@ -51,81 +39,306 @@ def make_plot_vars(dataset, affectability_status):
     return(commit_total_cols, consid_total_cols, comm_cons_cols, consid_commit_scen_total_cols, expectable, yr_cols)
 
 # %%
-# Specify the name of the file to operate on, a base title string which will name the figures and the plot files,
-# and a filepath pointing to where the files should be saved.
-def plot_data(dataset, affectability_status, title_str, sub_folder):
-    
-    # make the plotting variables for a dataset by calling the function defined above
-    commit_total_cols, consid_total_cols, comm_cons_cols, consid_commit_scen_total_cols, expectable, yr_cols = make_plot_vars(dataset, affectability_status)
-    
-    X = np.arange(2021, 2101)
-    
-    for row in range(len(dataset)):
-                
-        plt.figure(figsize=(10,3))
-        plt.tight_layout()
-        plt.stackplot(X, 
-                      dataset[commit_total_cols].loc[row],
-                      dataset[consid_total_cols].loc[row], 
-                      dataset[expectable].loc[row], 
-                      labels=['Committed Emissions','Considered Emissions','Expectable'],
-                      colors = ['firebrick', 'darksalmon', 'navajowhite'])
-        
-        plt.plot(X, dataset[commit_total_cols].loc[row], color = 'firebrick', linestyle = 'dashed')
-        plt.plot(X, dataset[comm_cons_cols].loc[row], color = 'darksalmon', linestyle = 'dashed')
-        
-        if affectability_status == 'raw':
-            plt.plot(X, dataset[yr_cols].loc[row], color = 'black', label = 'Scenario Emissions')
-            
-            for col in dataset[expectable].columns:
-                plt.fill_between(X, dataset[yr_cols].loc[row], 0, 
-                     where = dataset[yr_cols].loc[row] < 0, color = 'navajowhite')
+# name each figure (and its file) for both expectation aggregated and singular scenario datasets
+# (the keys are turned into their labels here, the SSP and RCP are typed keys, e.g. RCP 1.9 -> '1.9', and the countries can be categorical)
+def make_fig_names(dataset, title_str):
+
+    fig_names = []
+    titles = []
 
-        # specify the plot name to work for both expectation aggregated and singular scenario datasets
+    for row in range(len(dataset)):
         if 'SSP' and 'RCP' in dataset.columns:
             if 'country' in dataset.columns:
-                fig_name = str(dataset['country'].loc[row] + '_' 
-                               + dataset['SSP'].loc[row] + 'RCP' 
-                               + dataset['RCP'].loc[row] + title_str)
-                plt.title(title_str + dataset['country'].loc[row] 
-                          + ' _' + dataset['SSP'].loc[row] 
-                          + 'RCP ' + dataset['RCP'].loc[row])
+                fig_name = str(str(dataset['country'].loc[row]) + '_' 
+                               + str(dataset['SSP'].loc[row]) + 'RCP' 
+                               + str(dataset['RCP'].loc[row]) + title_str)
+                title = (title_str + str(dataset['country'].loc[row]) 
+                         + ' _' + str(dataset['SSP'].loc[row]) 
+                         + 'RCP ' + str(dataset['RCP'].loc[row]))
             elif 'country' not in dataset.columns and 'region' in dataset.columns:
-                fig_name = str(dataset['region'].loc[row] + '_' 
-                               + dataset['SSP'].loc[row] + 'RCP' 
-                               + dataset['RCP'].loc[row] + title_str)
-                plt.title(title_str + dataset['region'].loc[row] 
-                          + '_' + dataset['SSP'].loc[row] 
-                          + 'RCP ' + dataset['RCP'].loc[row])
+                fig_name = str(str(dataset['region'].loc[row]) + '_' 
+                               + str(dataset['SSP'].loc[row]) + 'RCP' 
+                               + str(dataset['RCP'].loc[row]) + title_str)
+                title = (title_str + str(dataset['region'].loc[row]) 
+                         + '_' + str(dataset['SSP'].loc[row]) 
+                         + 'RCP ' + str(dataset['RCP'].loc[row]))
             elif 'country' not in dataset.columns and 'region' not in dataset.columns:
                 fig_name = str('world' + '_' 
-                           + dataset['SSP'].loc[row] + 'RCP' 
-                           + dataset['RCP'].loc[row] + title_str)
-                plt.title(title_str + 'world' 
-                      + '_' + dataset['SSP'].loc[row] 
-                      + 'RCP' + dataset['RCP'].loc[row])
+                           + str(dataset['SSP'].loc[row]) + 'RCP' 
+                           + str(dataset['RCP'].loc[row]) + title_str)
+                title = (title_str + 'world' 
+                         + '_' + str(dataset['SSP'].loc[row]) 
+                         + 'RCP' + str(dataset['RCP'].loc[row]))
                 
         elif 'SSP' and 'RCP' not in dataset.columns:
             if 'country' in dataset.columns:
-                fig_name = str(dataset['country'].loc[row] + title_str)
-                plt.title(title_str + dataset['country'].loc[row])
+                fig_name = str(str(dataset['country'].loc[row]) + title_str)
+                title = title_str + str(dataset['country'].loc[row])
             elif 'country' not in dataset.columns and 'region' in dataset.columns:
-                fig_name = str(dataset['region'].loc[row] + title_str)
-                plt.title(title_str + dataset['region'].loc[row])
+                fig_name = str(str(dataset['region'].loc[row]) + title_str)
+                title = title_str + str(dataset['region'].loc[row])
             elif 'country' not in dataset.columns and 'region' not in dataset.columns:
                 fig_name = str('world' + title_str)
-                plt.title(title_str + 'world')
+                title = title_str + 'world'
         
         else:
             print('broken plotting & title function!')
 
-        plt.legend(loc='center left', bbox_to_anchor=(1, .8), fancybox=True, ncol=1)
-        plt.xlabel('Year')
-        plt.ylabel('CO2 Emissions (Mt)')
-        plt.xlim(2022,2100)
-        
-        plt.savefig(sub_folder + str.replace(fig_name, ' ','') + '.jpeg', bbox_inches='tight')
-        plt.close()
+        fig_names.append(str.replace(fig_name, ' ',''))
+        titles.append(title)
+
+    return(fig_names, titles)
+
+# %%
+# the vertices of the polygons fill_between would draw between y1 and y2, one per run of x where `where` is True
+def fill_verts(X, y1, y2, where = None):
+
+    where = np.ones(len(X), dtype = bool) if where is None else np.asarray(where)
+
+    # find the start and end of each run of True values
+    edges = np.diff(np.concatenate([[0], where.astype(int), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    verts = []
+    for lo, hi in zip(starts, ends):
+        x = X[lo:hi]
+        verts.append(np.concatenate([np.column_stack([x, y1[lo:hi]]), np.column_stack([x[::-1], y2[lo:hi][::-1]])]))
+
+    return(verts)
+
+# %%
+# build the figure, axes, artists, legend and styling once, drawn straight onto an Agg canvas outside of pyplot
+# every row is then drawn by swapping the data of these artists (see update_template) instead of drawing a new figure
+# with fixed_layout the axes leave a fixed margin for the legend, so every figure has the same size (used for sprite sheets)
+def make_template(affectability_status, fixed_layout = False, dpi = 100):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(10,3), dpi = dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    if fixed_layout:
+        fig.subplots_adjust(left = 0.07, right = 0.76, bottom = 0.17, top = 0.88)
+
+    X = np.arange(2021, 2101)
+    zeros = np.zeros(len(X))
+
+    template = {'fig': fig, 'ax': ax, 'affectability_status': affectability_status}
+
+    template['layers'] = ax.stackplot(X, zeros, zeros, zeros, 
+                                      labels=['Committed Emissions','Considered Emissions','Expectable'],
+                                      colors = ['firebrick', 'darksalmon', 'navajowhite'])
+    
+    template['commit_line'], = ax.plot(X, zeros, color = 'firebrick', linestyle = 'dashed')
+    template['comm_cons_line'], = ax.plot(X, zeros, color = 'darksalmon', linestyle = 'dashed')
+    
+    if affectability_status == 'raw':
+        template['scen_line'], = ax.plot(X, zeros, color = 'black', label = 'Scenario Emissions')
+        template['scen_fill'] = ax.fill_between(X, zeros, 0, where = zeros < 0, color = 'navajowhite')
+
+    template['title'] = ax.set_title('')
+    ax.legend(loc='center left', bbox_to_anchor=(1, .8), fancybox=True, ncol=1)
+    ax.set_xlabel('Year')
+    ax.set_ylabel('CO2 Emissions (Mt)')
+    ax.set_xlim(2022,2100)
+
+    return(template)
+
+# %%
+# swap one row's trajectories into the template's artists
+def update_template(template, X, commit, consid, expectable, comm_cons, scen, title):
+
+    # the stackplot layers are the running totals of the committed, considered and expectable emissions
+    stack = np.cumsum(np.vstack([commit, consid, expectable]), axis = 0)
+    lower = np.vstack([np.zeros(len(X)), stack[:-1]])
+
+    for layer, y1, y2 in zip(template['layers'], lower, stack):
+        layer.set_verts(fill_verts(X, y1, y2))
+
+    template['commit_line'].set_ydata(commit)
+    template['comm_cons_line'].set_ydata(comm_cons)
+    y_data = [stack, lower, comm_cons]
+
+    if template['affectability_status'] == 'raw':
+        template['scen_line'].set_ydata(scen)
+        template['scen_fill'].set_verts(fill_verts(X, scen, np.zeros(len(X)), where = scen < 0))
+        y_data.append(scen)
+
+    template['title'].set_text(title)
+
+    # rescale the y axis to the new data, with the same 5% margins matplotlib's autoscaling adds
+    y_min = min(0, np.nanmin([np.nanmin(y) for y in y_data]))
+    y_max = max(0, np.nanmax([np.nanmax(y) for y in y_data]))
+    pad = 0.05 * (y_max - y_min) if y_max > y_min else 0.5
+    template['ax'].set_ylim(y_min - pad, y_max + pad)
+
+# %%
+# each rendering process keeps its templates and draws every row it is given into them, instead of creating a figure per row
+WORKER_TEMPLATES = {}
+
+def init_render_worker():
+
+    # preload the non-interactive backend, the workers only ever write files
+    import matplotlib
+    matplotlib.use('Agg')
+
+# %%
+# the start method of the rendering processes: fork on linux, the platform's default elsewhere
+# (spawn on macOS, where a forked process which has loaded matplotlib's system libraries can crash)
+def render_context():
+    import sys
+    import multiprocessing as mp
+    return(mp.get_context('fork' if sys.platform.startswith('linux') else None))
+
+# spawned workers import the main script again before they start, and master.py has no __main__ guard, so they would rerun the pipeline
+# the workers only need the src modules, so the main script is hidden from them while the pool is up
+@contextlib.contextmanager
+def main_script_hidden(ctx):
+    import sys
+
+    if ctx.get_start_method() == 'fork':
+        yield
+        return
+
+    main = sys.modules['__main__']
+    saved = {attr: main.__dict__[attr] for attr in ['__file__', '__spec__'] if attr in main.__dict__}
+    main.__dict__.pop('__file__', None)
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        main.__dict__.pop('__spec__', None)
+        main.__dict__.update(saved)
+
+# %%
+def get_template(affectability_status, fixed_layout, dpi):
+
+    key = (affectability_status, fixed_layout, dpi)
+    if key not in WORKER_TEMPLATES:
+        WORKER_TEMPLATES[key] = make_template(affectability_status, fixed_layout, dpi)
+
+    return(WORKER_TEMPLATES[key])
+
+# %%
+# render a shard of rows with a template, the shard holds the plotting arrays of its rows and where they go
+# 'jpeg' saves one file per row, 'sprite' tiles the rows into the shard's sprite sheet (a shard is one sheet), writes it,
+# and returns the sheet's rows of the sprite index, so only the index rows and not the pixels go back to the caller
+def render_shard(shard):
+
+    output = shard['output']
+    template = get_template(shard['affectability_status'], output == 'sprite', shard['dpi'])
+    fig = template['fig']
+    sheet, index = None, []
+
+    for i in range(len(shard['titles'])):
+        update_template(template, shard['X'], shard['commit'][i], shard['consid'][i], shard['expectable'][i], shard['comm_cons'][i], 
+                        shard['scen'][i] if shard['scen'] is not None else None, shard['titles'][i])
+
+        if output == 'sprite':
+            fig.canvas.draw()
+            tile = np.asarray(fig.canvas.buffer_rgba())[:, :, :3]
+            if sheet is None:
+                sheet = new_sheet(tile, shard['sprite_shape'])
+            index.append(place_tile(sheet, tile, i, shard))
+        else:
+            fig.savefig(shard['paths'][i], bbox_inches='tight')
+
+    if output == 'sprite':
+        import matplotlib.image
+        matplotlib.image.imsave(shard['sheet_path'], sheet)
+        return(index)
+
+    return(len(shard['titles']))
+
+# %%
+# a blank sprite sheet of sprite_shape (rows, cols) tiles of the size of tile
+def new_sheet(tile, sprite_shape):
+    return(np.full((sprite_shape[0] * tile.shape[0], sprite_shape[1] * tile.shape[1], 3), 255, dtype = np.uint8))
+
+# copy the i-th tile of a shard into its place on the sheet, and return its row of the sprite index
+def place_tile(sheet, tile, i, shard):
+
+    tile_h, tile_w = tile.shape[:2]
+    r, c = divmod(i, shard['sprite_shape'][1])
+    sheet[r * tile_h:(r + 1) * tile_h, c * tile_w:(c + 1) * tile_w] = tile
+
+    return({'figure': shard['fig_names'][i], 'sheet': shard['sheet_path'], 'row': r, 'col': c, 
+            'x': c * tile_w, 'y': r * tile_h, 'width': tile_w, 'height': tile_h})
+
+# %%
+# Specify the name of the file to operate on, a base title string which will name the figures and the plot files,
+# and a filepath pointing to where the files should be saved.
+# The rows are split into shards and rendered on a pool of n_workers processes (1, the default, renders in this process, None uses all cores).
+# output chooses what gets written:
+#   'jpeg': one file per row (the default)
+#   'pdf': every row as a page of a single multi-page pdf, rendered in this process
+#   'sprite': the rows tiled into png sprite sheets of sprite_shape (rows, cols) figures, with a csv index of the tiles
+def plot_data(dataset, affectability_status, title_str, sub_folder, n_workers = 1, output = 'jpeg', sprite_shape = (10, 10), dpi = 100):
+
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    
+    # make the plotting variables for a dataset by calling the function defined above
+    commit_total_cols, consid_total_cols, comm_cons_cols, consid_commit_scen_total_cols, expectable, yr_cols = make_plot_vars(dataset, affectability_status)
+    
+    X = np.arange(2021, 2101)
+
+    # the file name of every figure only depends on its row, so the output doesn't depend on how the rows are sharded
+    fig_names, titles = make_fig_names(dataset, title_str)
+    paths = [sub_folder + fig_name + '.jpeg' for fig_name in fig_names]
+
+    # pull every row's plotting data out of the df once, as arrays the workers can be sent
+    data = {'commit': dataset[commit_total_cols].to_numpy(dtype = float), 'consid': dataset[consid_total_cols].to_numpy(dtype = float), 
+            'expectable': dataset[expectable].to_numpy(dtype = float), 'comm_cons': dataset[comm_cons_cols].to_numpy(dtype = float), 
+            'scen': dataset[yr_cols].to_numpy(dtype = float) if affectability_status == 'raw' else None}
+
+    start = time.perf_counter()
+
+    # a multi-page pdf has to be written by one process, in row order
+    if output == 'pdf':
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        template = make_template(affectability_status, dpi = dpi)
+        with PdfPages(sub_folder + str.replace(title_str, ' ', '') + '.pdf') as pdf:
+            for row in range(len(dataset)):
+                update_template(template, X, *(data[k][row] if data[k] is not None else None for k in ['commit', 'consid', 'expectable', 'comm_cons', 'scen']), titles[row])
+                pdf.savefig(template['fig'], bbox_inches='tight')
+
+        n_workers, n_figs = 1, len(dataset)
+
+    else:
+        n_workers = n_workers or os.cpu_count() or 1
+        n_workers = max(1, min(n_workers, len(dataset)))
+
+        # several small shards per worker, so the workers finish at about the same time, or one shard per sprite sheet
+        if output == 'sprite':
+            per_sheet = sprite_shape[0] * sprite_shape[1]
+            bounds = np.append(np.arange(0, len(dataset), per_sheet), len(dataset))
+        else:
+            bounds = np.linspace(0, len(dataset), min(len(dataset), n_workers * 4) + 1).astype(int)
+        shards = [{'X': X, 'titles': titles[lo:hi], 'paths': paths[lo:hi], 'affectability_status': affectability_status, 'output': output, 'dpi': dpi, 
+                   'fig_names': fig_names[lo:hi], 'sprite_shape': sprite_shape, 'sheet_path': sub_folder + str.replace(title_str, ' ', '') + f'sheet{sheet_no:03d}.png',
+                   **{k: (v[lo:hi] if v is not None else None) for k, v in data.items()}} for sheet_no, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+        if n_workers == 1:
+            results = [render_shard(shard) for shard in shards]
+        else:
+            ctx = render_context()
+            with main_script_hidden(ctx), ProcessPoolExecutor(max_workers = n_workers, mp_context = ctx, initializer = init_render_worker) as pool:
+                results = list(pool.map(render_shard, shards))
+
+        if output == 'sprite':
+            # the sheets were written by the workers, only the index of where each figure is is left to write
+            index = pd.DataFrame([row for rows in results for row in rows])
+            index.to_csv(sub_folder + str.replace(title_str, ' ', '') + 'sprite_index.csv', index = False)
+            n_figs = len(index)
+        else:
+            n_figs = sum(results)
+
+    seconds = time.perf_counter() - start
+    print(f'{n_figs} figures written to {sub_folder} in {seconds:.1f} s ({n_figs / max(seconds, 1e-9):.1f} figures/second, {n_workers} workers)')
 
 # %%
 if __name__ == "__main__":
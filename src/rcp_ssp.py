@@ -5,6 +5,104 @@
 
 
 import pandas as pd
+import numpy as np
+import re
+from storage import save_panel
+
+
+# In[ ]:
+
+
+# Typed scenario keys
+# The SSPs and RCPs are stored as ordered categoricals everywhere downstream, so grouping and joining on them works on small integer
+# codes, and they sort in their natural order (SSP1-SSP5, the RCPs by forcing with the baseline last, like the raw codes sorted).
+# 0 is the SSP and RCP the master file gives the countries without scenario data, it sorts first.
+SSP_DTYPE = pd.CategoricalDtype([0, 'SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5'], ordered = True)
+RCP_DTYPE = pd.CategoricalDtype([0, 1.9, 2.6, 3.4, 4.5, 6.0, 'BL'], ordered = True)
+
+# every way the data files spell a key (e.g. 1.9, '1.9', or '19' in the scenario names) -> its category
+def key_spellings(dtype):
+
+    spellings = {}
+    for cat in dtype.categories:
+        spellings[str(cat)] = cat
+        if isinstance(cat, (int, float)):
+            spellings[f'{cat:g}'] = cat
+            spellings[f'{cat * 10:02.0f}'] = cat
+
+    return(spellings)
+
+SPELLINGS = {'SSP': key_spellings(SSP_DTYPE), 'RCP': key_spellings(RCP_DTYPE)}
+
+
+# In[ ]:
+
+
+# the SSP and RCP columns of a df as the typed keys, each distinct value is only looked up once (unknown values become NaN)
+def as_scen_keys(df):
+
+    # a df whose keys are already typed is returned as it is, without a copy
+    untyped = [(col, dtype) for col, dtype in [('SSP', SSP_DTYPE), ('RCP', RCP_DTYPE)] if col in df.columns and df[col].dtype != dtype]
+    if untyped:
+        df = df.copy()
+
+    for col, dtype in untyped:
+        codes, uniques = pd.factorize(df[col])
+        cats = [SPELLINGS[col].get(str(value), np.nan) for value in uniques] + [np.nan]
+        df[col] = pd.Categorical(np.array(cats, dtype = object)[codes], dtype = dtype)
+
+    return(df)
+
+
+# In[ ]:
+
+
+# one integer per (SSP, RCP) pair of a df with typed keys, -1 where either is missing, to join scenarios on
+def scen_codes(df):
+
+    ssp, rcp = df['SSP'].cat.codes.to_numpy(dtype = np.int64), df['RCP'].cat.codes.to_numpy(dtype = np.int64)
+
+    return(np.where((ssp < 0) | (rcp < 0), -1, ssp * len(RCP_DTYPE.categories) + rcp))
+
+# the row of table with the scenario of each row of df, -1 where table has none (the first row wins if table repeats a scenario)
+def scen_rows(table, df):
+
+    table_codes, df_codes = scen_codes(table), scen_codes(df)
+
+    lookup = np.full(len(SSP_DTYPE.categories) * len(RCP_DTYPE.categories) + 1, -1)
+    found = np.flatnonzero(table_codes >= 0)[::-1]
+    lookup[table_codes[found]] = found
+    # code -1 (a missing key) picks the -1 at the end of the lookup
+
+    return(lookup[df_codes])
+
+
+# In[ ]:
+
+
+# split scenario names like 'SSP119IMAGE' into their SSP, RCP and model, parsing each distinct name once
+# returns a df aligned with the names, with typed SSP and RCP, NaN for the names which aren't scenarios (e.g. history)
+# an RCP code which isn't one of RCP_DTYPE's (e.g. '70' or '85') is NaN too, with the SSP still parsed (see unknown_rcp)
+SCEN_NAME = re.compile('(?P<ssp>.{4})(?P<rcp>.{2})(?P<model>.{5,})')
+
+def parse_scenarios(names):
+
+    codes, uniques = pd.factorize(pd.Series(names))
+    table = pd.Series(uniques, dtype = object).str.extract(SCEN_NAME).rename(columns = {'ssp': 'SSP', 'rcp': 'RCP'})
+    table = as_scen_keys(table)
+
+    # the code -1 of a missing name picks the empty row appended to the table
+    table = pd.concat([table, table.iloc[:0].reindex([len(table)])])
+
+    return(table.iloc[codes].reset_index(drop = True))
+
+# the rows of parsed scenario names whose RCP code isn't known, they are dropped (with a count printed) rather than relabelled
+def unknown_rcp(parsed):
+    return((parsed['SSP'].notna() & parsed['RCP'].isna()).to_numpy())
+
+def report_unknown_rcps(dropped):
+    if dropped:
+        print(f'{sum(dropped.values())} rows of scenarios with an unknown RCP code were dropped: {dropped}')
 
 
 # In[ ]:
@@ -29,23 +127,35 @@ def clean_scen_CO2(scenario):
 
     # To simplify the data calculate the cross-model mean for each country/RCP/SSP by averaging the 5 model values given
     # First separate the "scenario" column into it's component SSP, RCP, and model values
-    scen_subset[['SSP','RCP','model']] = scen_subset.scenario.str.extract('(?P<ssp>.{4})(?P<rcp>.{2})(?P<model>.{5,})')
+    # (each distinct scenario name is parsed once, the SSP and RCP come out as typed keys, e.g. RCP "19" is 1.9)
+    scen_subset = scen_subset.reset_index(drop = True)
+    scen_subset[['SSP','RCP','model']] = parse_scenarios(scen_subset['scenario'])
+
+    # the scenarios whose RCP isn't known are dropped and counted, rather than averaged into another RCP
+    unknown = unknown_rcp(scen_subset)
+    report_unknown_rcps(scen_subset.loc[unknown, 'scenario'].value_counts().to_dict())
+    scen_subset = scen_subset[~unknown]
 
     # Then group the data by country/SSP/RCP values and calculate the mean for each of these groups across the models
     # & reset the index to convert the multi-index object to a regular df
-    scen_model_means = scen_subset.groupby(by = ['country.name.en', 'SSP', 'RCP']).mean().reset_index()
+    scen_model_means = scen_subset.groupby(by = ['country.name.en', 'SSP', 'RCP'], observed = True).mean(numeric_only = True).reset_index()
     
+    return(format_scen_means(scen_model_means))
+
+
+# In[ ]:
+
+
+def format_scen_means(scen_model_means):
+
     # Convert the data from GgCO2eq to MtCO2eq, (Megatonnes == Mt == million metric tons)
     scen_model_means.iloc[:,3:] = scen_model_means.iloc[:,3:] * .001
 
-    # Put the correct decimal place in the RCP values (e.g. change from "19" to "1.9")
-    scen_model_means["RCP"] = pd.to_numeric(scen_model_means["RCP"], errors='coerce') / 10
-    scen_model_means["RCP"] = scen_model_means["RCP"].fillna('BL')
-    
     # renaming the first col to country
     scen_model_means = scen_model_means.rename(columns={'country.name.en':'country'})
     
     scen_model_means.to_csv('data/scen_CO2_cntry.csv')
+    save_panel(scen_model_means, 'data/scen_CO2_cntry')
     
     return(scen_model_means)
 
@@ -53,6 +163,93 @@ def clean_scen_CO2(scenario):
 # In[ ]:
 
 
+# Streaming the full PRIMAP file
+# The downscaled file on zenodo holds every entity (gas basket), source (downscaling variant) and model, far too much to read whole.
+# It is read in chunks of only the key and year columns, each chunk is filtered to one entity and source and its country names are
+# resolved with the saved CountryResolver, and the per (country, SSP, RCP) sums and counts of the model values are accumulated,
+# so memory stays bounded by the chunk size and the number of groups, whatever the size of the file.
+# The model mean is then the accumulated sum over the count of models with a value, like the groupby mean of clean_scen_CO2.
+
+# the key columns the scenario data needs, every other text column (unit, category, ...) is never parsed
+SCEN_KEYS = ['source', 'scenario', 'country', 'entity']
+
+
+# In[ ]:
+
+
+# stream the raw PRIMAP file at path into the table clean_scen_CO2 makes from the subset of it
+# entity and source pick the gas basket and downscaling variant (see clean_scen_CO2), chunksize is the number of rows read at a time
+def stream_scen_CO2(path, entity = 'KYOTOGHGAR4', source = 'PMSSPBIE', resolver = None, chunksize = 100000):
+    from countrynamefix import CountryResolver
+
+    resolver = CountryResolver.load() if resolver is None else resolver
+
+    # only the key and year columns are read, the keys as categoricals and the years as floats
+    header = pd.read_csv(path, nrows = 0, encoding = 'latin1').columns
+    year_cols = [col for col in header if re.fullmatch(r'\d{4}', str(col))]
+    dtypes = {**{col: 'category' for col in SCEN_KEYS}, **{col: 'float64' for col in year_cols}}
+
+    sums, counts = None, None
+    unmapped, unknown_rcps = {}, {}
+    n_rows = 0
+
+    for chunk in pd.read_csv(path, usecols = SCEN_KEYS + year_cols, dtype = dtypes, chunksize = chunksize, encoding = 'latin1'):
+        n_rows += len(chunk)
+        chunk = chunk[(chunk['entity'] == entity) & (chunk['source'] == source)]
+
+        # the countries the mapping file doesn't know (regions, groups of countries) are dropped, like fix_cntry_col drops them
+        codes = resolver.codes(chunk['country'])
+        for name, count in chunk['country'][codes == -1].value_counts().items():
+            if count:
+                unmapped[name] = unmapped.get(name, 0) + count
+
+        # parse the chunk's scenario names once each and group on the integer codes of the keys
+        # the rows without an SSP and RCP (e.g. history) are dropped like groupby drops them
+        parsed = parse_scenarios(chunk['scenario'].cat.categories)
+        ssp = parsed['SSP'].cat.codes.to_numpy()[chunk['scenario'].cat.codes]
+        rcp = parsed['RCP'].cat.codes.to_numpy()[chunk['scenario'].cat.codes]
+
+        # the scenarios whose RCP isn't known are dropped with them, and counted
+        name_codes = chunk['scenario'].cat.codes.to_numpy()
+        unknown = unknown_rcp(parsed)[name_codes] & (name_codes >= 0) & (codes != -1)
+        for name, count in chunk['scenario'][unknown].value_counts().items():
+            if count:
+                unknown_rcps[name] = unknown_rcps.get(name, 0) + count
+
+        keep = (codes != -1) & (ssp >= 0) & (rcp >= 0)
+        keys = [codes[keep], ssp[keep], rcp[keep]]
+        grouped = chunk.loc[keep, year_cols].groupby(keys)
+
+        # add this chunk's sums and counts of model values into the running ones
+        chunk_sums, chunk_counts = grouped.sum(), grouped.count()
+        sums = chunk_sums if sums is None else sums.add(chunk_sums, fill_value = 0)
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value = 0)
+
+    print(f'{n_rows} rows of {path} streamed, {0 if sums is None else len(sums)} country/SSP/RCP groups of {entity} {source} kept')
+    if unmapped:
+        print(f'{len(unmapped)} areas which aren\'t countries in the country name mapping file were dropped, e.g. {list(unmapped)[:5]}')
+    report_unknown_rcps(unknown_rcps)
+
+    if sums is None:
+        raise Exception(f'no rows of {path} have entity {entity} and source {source}')
+
+    # the model mean of each group, NaN where no model has a value (like the groupby mean)
+    scen_model_means = (sums / counts.where(counts > 0)).reset_index(names = ['code', 'SSP', 'RCP'])
+
+    # sort the groups by country name, SSP and RCP, like grouping on the names sorts them
+    scen_model_means.insert(0, 'country.name.en', np.array(resolver.names, dtype = object)[scen_model_means.pop('code').to_numpy()])
+    scen_model_means = scen_model_means.sort_values(['country.name.en', 'SSP', 'RCP'], kind = 'stable').reset_index(drop = True)
+    scen_model_means['SSP'] = pd.Categorical.from_codes(scen_model_means['SSP'], dtype = SSP_DTYPE)
+    scen_model_means['RCP'] = pd.Categorical.from_codes(scen_model_means['RCP'], dtype = RCP_DTYPE)
+
+    return(format_scen_means(scen_model_means))
+
+
+# In[ ]:
+
+
 if __name__ == "__main__":
     clean_scen_CO2()
+    stream_scen_CO2
+    as_scen_keys
 
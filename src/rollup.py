@@ -0,0 +1,135 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+import hashlib
+
+# %% [markdown]
+# ### Lazy region and world rollups
+# The region and world versions of a country level table are only summed when something asks for them, and then kept.
+# Each level is a sparse (group x row) 0/1 indicator matrix times the numeric metric block of the level below it,
+# so a rollup is one sparse product (the world is summed from the regions, so countries without a region are left out of both,
+# like the groupby on the regions dropped them). The text columns which aren't keys of a level are never summed.
+# The rollups are dropped when the country data changes: its shape, columns, keys or values (checked on every access by a digest
+# of the bytes of every metric column and of the hashes of the key rows, in order, so any edit in place or reordering of rows shows up).
+# invalidate() drops them by hand, e.g. to free their memory.
+
+# %%
+# each level: the key columns its rows are grouped by, and the level it is summed from (None for the country data itself)
+LEVELS = {'region': (['SSP', 'RCP', 'region'], None), 'world': (['SSP', 'RCP'], 'region')}
+
+# %%
+# the (group x row) indicator matrix of the rows' groups, and the keys of each group, sorted like groupby sorts them
+# rows with a missing key are in no group
+def indicator_matrix(keys):
+    from scipy import sparse
+
+    group = keys.groupby(list(keys.columns), sort = True, observed = True).ngroup().fillna(-1).to_numpy(dtype = np.int64)
+    rows = np.flatnonzero(group >= 0)
+    n_groups = int(group.max()) + 1 if len(rows) else 0
+
+    indicator = sparse.csr_matrix((np.ones(len(rows)), (group[rows], rows)), shape = (n_groups, len(keys)))
+
+    # the keys of each group are those of its first row
+    first = np.zeros(n_groups, dtype = np.int64)
+    first[group[rows][::-1]] = rows[::-1]
+
+    return(indicator, keys.iloc[first].reset_index(drop = True))
+
+# %%
+# the numeric columns of a df which aren't keys of any level, in their order
+def metric_cols(df):
+
+    key_cols = set(col for keys, parent in LEVELS.values() for col in keys) | {'country'}
+
+    # (checked once per dtype, a master file has thousands of columns but only a few dtypes)
+    dtypes = df.dtypes
+    numeric = {dtype: pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in set(dtypes)}
+
+    return([col for col, dtype in zip(df.columns, dtypes) if col not in key_cols and numeric[dtype]])
+
+# %%
+# a digest of the data: the bytes of every metric column, and the hash of every key row in the order of the rows
+# the columns are hashed one at a time, a column of the float block of a df is contiguous, so nothing is copied
+def data_digest(data, metrics):
+
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(repr((data.shape, [str(col) for col in data.columns])).encode())
+
+    for col in metrics:
+        values = data[col].to_numpy()
+        digest.update(str(values.dtype).encode())
+        digest.update(memoryview(np.ascontiguousarray(values)).cast('B'))
+
+    is_metric = set(metrics)
+    key_cols = [col for col in data.columns if col not in is_metric]
+    if key_cols:
+        digest.update(pd.util.hash_pandas_object(data[key_cols].astype(str), index = False).to_numpy().tobytes())
+
+    return(digest.hexdigest())
+
+# %%
+class Rollup:
+
+    def __init__(self, data):
+        # the country level table, e.g. the master file
+        self.data = data
+        # level -> summed df, and level -> (indicator matrix, group keys), for the data with the fingerprint in self.version
+        self.sums = {}
+        self.indicators = {}
+        self.version = None
+
+    # the fingerprint of the country data's shape, columns, keys (in row order) and metric values
+    # the cached rollups are only valid for one fingerprint
+    def fingerprint(self):
+        return(data_digest(self.data, metric_cols(self.data)))
+
+    # drop the cached rollups, e.g. after replacing the data
+    def invalidate(self):
+        self.sums.clear()
+        self.indicators.clear()
+        self.version = None
+
+    # the rollup at a level, summed on first access (or the first access after the country data changed)
+    def __getitem__(self, level):
+
+        version = self.fingerprint()
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+        if level not in self.sums:
+            self.sums[level] = self.rollup(level)
+
+        return(self.sums[level])
+
+    # sum a level from the level below it
+    def rollup(self, level):
+
+        keys, parent = LEVELS[level]
+        if parent is None:
+            source = self.data
+        else:
+            if parent not in self.sums:
+                self.sums[parent] = self.rollup(parent)
+            source = self.sums[parent]
+
+        # the indicator only depends on the keys of the level below
+        if level not in self.indicators:
+            self.indicators[level] = indicator_matrix(source[keys])
+        indicator, group_keys = self.indicators[level]
+
+        # one sparse product of the (group x row) indicator and the (row x metric) block, accumulated in float64
+        metrics = metric_cols(source)
+        block = source[metrics].to_numpy()
+        summed = indicator @ block.astype(np.float64, copy = False)
+
+        summed = pd.DataFrame(summed.astype(block.dtype, copy = False), columns = metrics, copy = False)
+        for i, col in enumerate(group_keys.columns):
+            summed.insert(i, col, group_keys[col].values)
+
+        return(summed)
+
+# %%
+if __name__ == "__main__":
+    Rollup
@@ -4,11 +4,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.collections import PathCollection
 from matplotlib.lines import Line2D
+from scen_match import discount_kernels, kernel_distances, rank_within_groups
+from storage import year_cols
+from aggregate import load_master
 
 # %%
 # import plottable version of the data
-master = pd.read_csv('../data/master.csv', index_col= 0)
-master = master[(master['RCP'] != str(0)) & (master['SSP'] != str(0))]
+# (the master file is saved normalized, load_master widens it)
+master = load_master('../data/master')
+master = master[(master['RCP'].astype(str) != str(0)) & (master['SSP'].astype(str) != str(0))]
 
 years = np.arange(2021, 2101)
 
@@ -17,34 +21,25 @@ years = np.arange(2021, 2101)
 # discount this distance by the discount rate
 # make a column w one value per row that holds the "average distance" between the scenario and the consid+commit lines
 
-def find_closest_scen(df):
-    def calc_scen_distance(row):
-        differences = []
+# the discounted distance of every row is one product of its |expectable| emissions with the cached discount vector (see scen_match.py)
+# norm can also be 'L2' or 'max', and step > 1 makes the discount stepwise (flat for step years at a time)
+def find_closest_scen(df, rho = 0.99, norm = 'L1', step = 1):
 
-        for yr in range(2021,2101):
-            expectable = row[f"expectable.{yr}"]
-            differences.append(np.abs(expectable))
-
-        # may want to adapt discount array to be stepwise
-        rho = 0.99
-        discount_arr = np.array([rho**i for i in np.arange(80)])
-        # print(discount_arr)
-        distance = np.sum(discount_arr * np.sqrt(np.array(differences) ** 2))
-        # print(distance)
-        return distance
+    expectable = df[year_cols(df.columns, 'expectable', years = years)].to_numpy(dtype = float)
 
     # Calculate the distance for the current year and store it in a new column
-    df['distance'] = df.apply(calc_scen_distance, axis=1)
+    df['distance'] = kernel_distances(expectable, discount_kernels([rho], len(years), step), norm)[:, 0]
 
     return df
 
 # %%
-def select_min_rtp_distance_rows(df):
-    # Find the index of the row with the smallest avg.rtp.distance for each country
-    min_rtp_distance_idx = df.groupby('country')['distance'].idxmin()
+# select the k closest scenarios of each country (by default only the closest), ranked in a new column
+def select_min_rtp_distance_rows(df, k = 1):
+
+    ranks = rank_within_groups(df[['distance']].to_numpy(), df['country'].to_numpy())[:, 0]
 
     # Select the rows with the smallest avg.rtp.distance for each country
-    min_rtp_distance_df = df.loc[min_rtp_distance_idx]
+    min_rtp_distance_df = df.assign(rank = ranks)[ranks < k].sort_values(['country', 'rank'], kind = 'stable')
 
     return min_rtp_distance_df
 
@@ -0,0 +1,213 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+from storage import year_cols
+
+# %% [markdown]
+# ### Matching each country to its closest scenarios
+# The distance between a scenario and a country's committed and considered emissions is the discounted size of its expectable
+# emissions over 2021-2100: sum_i rho**i * |expectable_i| for the L1 norm (the one the thesis used, with rho = 0.99).
+# The discount vectors are cached, and the distances of every country x SSP x RCP row for every discount rate come out of
+# a single matrix product of the (row x year) |expectable| block with the (year x rate) discount kernels.
+# The scenarios are then ranked within each country for every rate at once, giving the top k closest scenarios per country.
+
+# %%
+N_YEARS = 80
+
+# %%
+# the discount vector of a rate over n_years, rho**i, or with step > 1 a stepwise one which stays flat for step years at a time
+# (e.g. step = 10 discounts every year of a decade like its first year)
+DISCOUNTS = {}
+
+def discount_vector(rho, n_years = N_YEARS, step = 1):
+
+    key = (float(rho), n_years, step)
+    if key not in DISCOUNTS:
+        years = np.arange(n_years)
+        DISCOUNTS[key] = float(rho) ** (years // step * step)
+
+    return(DISCOUNTS[key])
+
+# %%
+# stack the discount vectors of several rates into a (rate x year) kernel matrix
+def discount_kernels(rates, n_years = N_YEARS, step = 1):
+    return(np.vstack([discount_vector(rho, n_years, step) for rho in np.atleast_1d(rates)]))
+
+# %%
+# the (row x kernel) distances of every row of expectable emissions for every discount kernel
+# norm: 'L1' sum of discounted |expectable|, 'L2' the root of the sum of discounted squares, 'max' the largest discounted |expectable|
+def kernel_distances(expectable, kernels, norm = 'L1', max_bytes = 1 << 28):
+
+    if norm == 'L1':
+        return(np.abs(expectable) @ kernels.T)
+
+    if norm == 'L2':
+        return(np.sqrt((expectable ** 2) @ kernels.T))
+
+    if norm == 'max':
+        # there is no product for the max, so broadcast a chunk of kernels at a time
+        distances = np.empty((len(expectable), len(kernels)))
+        chunk = max(1, int(max_bytes // max(1, expectable.size * 8)))
+        for lo in range(0, len(kernels), chunk):
+            distances[:, lo:lo + chunk] = (np.abs(expectable)[:, None, :] * kernels[None, lo:lo + chunk, :]).max(axis = 2)
+        return(distances)
+
+    raise ValueError(f'unknown norm <{norm}>, use L1, L2 or max')
+
+# %%
+# the (row x year) block of expectable emissions of the scenario rows of a master df
+# rows with SSP or RCP 0 are the countries without any scenario data, so they are left out
+def scenario_rows(master):
+
+    rows = master[(master['SSP'].astype(str) != '0') & (master['RCP'].astype(str) != '0')].reset_index(drop = True)
+    expectable = rows[year_cols(rows.columns, 'expectable', years = range(2021, 2021 + N_YEARS))].to_numpy(dtype = float)
+
+    return(rows, expectable)
+
+# %%
+# rank the rows within each group for every column of distances at once (0 is the closest), ties go to the earlier row
+# and missing distances last, like idxmin picked them
+def rank_within_groups(distances, groups):
+
+    group_codes = pd.factorize(groups)[0]
+
+    # sort every column by distance, then (stably) by group, so each group's rows come out in distance order
+    by_distance = np.argsort(distances, axis = 0, kind = 'stable')
+    by_group = np.argsort(group_codes[by_distance], axis = 0, kind = 'stable')
+    order = np.take_along_axis(by_distance, by_group, axis = 0)
+
+    # a row's rank is its position in the sorted column, minus where its group starts
+    group_start = np.concatenate([[0], np.cumsum(np.bincount(group_codes))])[:-1]
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(len(order))[:, None] - group_start[group_codes[order]], axis = 0)
+
+    return(ranks)
+
+# %%
+# the discounted distance of every scenario row for every rate, as a (row x rate) array, along with the scenario rows
+def scenario_distances(master, rates = [0.99], norm = 'L1', step = 1):
+
+    rows, expectable = scenario_rows(master)
+    distances = kernel_distances(expectable, discount_kernels(rates, expectable.shape[1], step), norm)
+
+    return(rows, distances)
+
+# %%
+# the k closest scenarios of each country for every discount rate
+# returns one row per country, rate and rank, with the scenario's keys (country, region, SSP, RCP) and its distance
+def closest_scenarios(master, rates = [0.99], k = 1, norm = 'L1', step = 1):
+
+    rows, distances = scenario_distances(master, rates, norm, step)
+    ranks = rank_within_groups(distances, rows['country'])
+
+    row_idx, rate_idx = np.nonzero(ranks < k)
+    key_cols = [col for col in ['country', 'region', 'SSP', 'RCP'] if col in rows.columns]
+
+    closest = rows.loc[row_idx, key_cols].reset_index(drop = True)
+    closest['rho'] = np.atleast_1d(rates)[rate_idx]
+    closest['rank'] = ranks[row_idx, rate_idx]
+    closest['distance'] = distances[row_idx, rate_idx]
+
+    # order by rate, then country in order of appearance, then rank
+    cntry_order = pd.factorize(rows['country'])[0][row_idx]
+    closest = closest.iloc[np.lexsort((closest['rank'], cntry_order, rate_idx))].reset_index(drop = True)
+
+    return(closest)
+
+# %% [markdown]
+# ### Sweeping the discount rate
+# How sensitive is the closest scenario (and the ranking of the countries) to the discount rate? The sweep evaluates a grid of
+# rates, for geometric and stepwise discount schedules, as one (rate x year) kernel matrix in one product, and summarises:
+# - assignments: the closest scenario of each country over each run of rates where it doesn't change
+# - flips: the rates between which a country's closest scenario changes
+# - scenario_ranks: the rank of each scenario within its country at the reference rate, and the range it moves in over the sweep
+# - country_ranks: the same for the ranking of the countries by the distance of their closest scenario
+
+# %%
+# the rate and discount step of each kernel of the sweep, and the (kernel x year) matrix of them, every step's rates in ascending order
+def sweep_kernels(rates, steps = [1], n_years = N_YEARS):
+
+    rates = np.unique(np.asarray(rates, dtype = float))
+    kernels = pd.DataFrame({'step': np.repeat(steps, len(rates)), 'rho': np.tile(rates, len(steps))})
+    matrix = np.vstack([discount_kernels(rates, n_years, step) for step in steps])
+
+    return(kernels, matrix)
+
+# %%
+# summarise how a (thing x kernel) array of ranks changes over the rates of each step
+# returns the rank at the reference rate, the lowest and highest rank over the sweep, and how many times the rank changes
+def summarise_ranks(ranks, kernels, reference):
+
+    summaries = []
+    for step, kernel_idx in kernels.groupby('step').indices.items():
+        step_ranks = ranks[:, kernel_idx]
+        ref = kernel_idx[np.argmin(np.abs(kernels['rho'].to_numpy()[kernel_idx] - reference))]
+
+        summaries.append(pd.DataFrame({'step': step, 'rho_ref': kernels['rho'][ref], 'rank_ref': ranks[:, ref],
+                                       'rank_min': step_ranks.min(axis = 1), 'rank_max': step_ranks.max(axis = 1),
+                                       'n_changes': (np.diff(step_ranks, axis = 1) != 0).sum(axis = 1)}))
+
+    return(summaries)
+
+# %%
+# sweep the discount rate over a grid of rates, for each discount step (1 = geometric, 10 = flat for each decade, ...)
+# reference is the rate the rank changes are measured against (the thesis used 0.99)
+# returns a dict of dfs: kernels, assignments, flips, scenario_ranks, country_ranks (see above)
+def sweep_discount_rates(master, rates, steps = [1], norm = 'L1', reference = 0.99):
+
+    rows, expectable = scenario_rows(master)
+    kernels, matrix = sweep_kernels(rates, steps, expectable.shape[1])
+
+    # every distance for every rate, in one product
+    distances = kernel_distances(expectable, matrix, norm)
+    ranks = rank_within_groups(distances, rows['country'])
+
+    cntry_codes, countries = pd.factorize(rows['country'])
+    key_cols = [col for col in ['country', 'region', 'SSP', 'RCP'] if col in rows.columns]
+
+    # the closest scenario row of each country for each kernel
+    closest_row, closest_kernel = np.nonzero(ranks == 0)
+    assigned = np.empty((len(countries), len(kernels)), dtype = np.int64)
+    assigned[cntry_codes[closest_row], closest_kernel] = closest_row
+
+    # runs of rates over which a country's closest scenario stays the same, every step starts a new run
+    new_run = np.ones(assigned.shape, dtype = bool)
+    same_step = kernels['step'].to_numpy()[1:] == kernels['step'].to_numpy()[:-1]
+    new_run[:, 1:] = (assigned[:, 1:] != assigned[:, :-1]) | ~same_step
+    # a run ends just before the next one of its country starts, or at the last kernel
+    run_cntry, run_start = np.nonzero(new_run)
+    run_end = np.append(run_start[1:], 0) - 1
+    run_end[np.append(run_cntry[1:] != run_cntry[:-1], True)] = len(kernels) - 1
+
+    assignments = rows.loc[assigned[run_cntry, run_start], key_cols].reset_index(drop = True)
+    assignments.insert(len(key_cols), 'step', kernels['step'].to_numpy()[run_start])
+    assignments.insert(len(key_cols) + 1, 'rho_low', kernels['rho'].to_numpy()[run_start])
+    assignments.insert(len(key_cols) + 2, 'rho_high', kernels['rho'].to_numpy()[run_end])
+
+    # a flip is the start of every run which isn't the first of its country and step
+    flip_cntry, flip_kernel = np.nonzero(new_run[:, 1:] & same_step)
+    flip_kernel += 1
+    flips = pd.DataFrame({'country': countries[flip_cntry], 'step': kernels['step'].to_numpy()[flip_kernel],
+                          'rho_from': kernels['rho'].to_numpy()[flip_kernel - 1], 'rho_to': kernels['rho'].to_numpy()[flip_kernel]})
+    for when, kernel_idx in [('from', flip_kernel - 1), ('to', flip_kernel)]:
+        for col in ['SSP', 'RCP']:
+            flips[f'{col}_{when}'] = rows[col].to_numpy()[assigned[flip_cntry, kernel_idx]]
+
+    # the ranks of the scenarios within their country
+    scenario_ranks = pd.concat([pd.concat([rows[key_cols], summary], axis = 1) for summary in summarise_ranks(ranks, kernels, reference)], ignore_index = True)
+
+    # the ranks of the countries by the distance of their closest scenario, 0 for the country whose emissions match a scenario best
+    closest_dist = distances[assigned, np.arange(len(kernels))[None, :]]
+    country_order = np.argsort(closest_dist, axis = 0, kind = 'stable')
+    cntry_ranks = np.empty_like(country_order)
+    np.put_along_axis(cntry_ranks, country_order, np.arange(len(countries))[:, None], axis = 0)
+    country_ranks = pd.concat([pd.concat([pd.DataFrame({'country': countries}), summary], axis = 1) for summary in summarise_ranks(cntry_ranks, kernels, reference)], ignore_index = True)
+
+    return({'kernels': kernels, 'assignments': assignments, 'flips': flips, 'scenario_ranks': scenario_ranks, 'country_ranks': country_ranks})
+
+# %%
+if __name__ == "__main__":
+    closest_scenarios
+    scenario_distances
+    sweep_discount_rates
@@ -0,0 +1,120 @@
+# %%
+# import libraries
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+
+# %% [markdown]
+# ### Stage cache for the pipeline in master.py
+# Each stage's output is pickled under data/.stage_cache, keyed on a hash of:
+# - the contents of the files the stage reads
+# - its parameters
+# - the source code of the module its function lives in and of every module in src/ (a stage calls into any of them)
+# - the keys of the upstream stages whose outputs it takes as arguments
+# so a stage only re-executes when something it depends on changed, and everything downstream of it follows.
+# A forced stage forces the stages downstream of it the same way, through the keys they take in their upstream list.
+
+# %%
+CACHE_DIR = 'data/.stage_cache'
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# %%
+def hash_bytes(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return(digest.hexdigest())
+
+# %%
+# hash the contents of a file, remembering the hash for as long as the file's size and modification time don't change
+FILE_HASHES = {}
+
+def file_hash(path):
+
+    if not os.path.exists(path):
+        return('missing')
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    if memo_key not in FILE_HASHES:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        FILE_HASHES[memo_key] = digest.hexdigest()
+
+    return(FILE_HASHES[memo_key])
+
+# %%
+# the code version of a stage is the source of the module defining its function, of every module in src/ and of any extra modules it names
+# (all of src/ rather than the modules the stage imports, an edit to any helper a stage reaches reruns it)
+def code_hash(func, modules = []):
+
+    sources = []
+    for module in [inspect.getmodule(func)] + [sys.modules[m] if isinstance(m, str) else m for m in modules]:
+        try:
+            sources.append(inspect.getsource(module))
+        except (OSError, TypeError):
+            # functions defined in a notebook or the interpreter have no source file, fall back to the function itself
+            sources.append(getattr(func, '__qualname__', repr(func)))
+
+    src_files = sorted(f for f in os.listdir(SRC_DIR) if f.endswith('.py'))
+    sources += [f'{f}={file_hash(os.path.join(SRC_DIR, f))}' for f in src_files]
+
+    return(hash_bytes(*sources))
+
+# %%
+def stage_key(name, func, files = [], params = {}, upstream = [], modules = []):
+
+    file_part = [f'{path}={file_hash(path)}' for path in files]
+    param_part = [f'{k}={params[k]!r}' for k in sorted(params)]
+
+    return(hash_bytes(name, code_hash(func, modules), *file_part, *param_part, *upstream)[:16])
+
+# %%
+# run a stage, or load its output from the cache if nothing it depends on changed since it last ran
+# args are the (upstream) inputs passed to the function, upstream are the keys of the stages which produced them
+# force is a collection of stage names to re-execute regardless of the cache ('all' reruns every stage), a stage taking the
+# output of a forced stage (one of its upstream keys is in FORCED_KEYS) is forced too, since it was built from the old output
+# returns the stage output and its key, which downstream stages pass on in their upstream list
+FORCED_KEYS = set()
+
+def run_stage(name, func, args = (), files = [], params = {}, upstream = [], modules = [], force = ()):
+
+    key = stage_key(name, func, files, params, upstream, modules)
+    path = os.path.join(CACHE_DIR, f'{name}-{key}.pkl')
+
+    forced = name in force or 'all' in force or any(k in FORCED_KEYS for k in upstream)
+    if forced:
+        FORCED_KEYS.add(key)
+
+    if not forced and os.path.exists(path):
+        with open(path, 'rb') as f:
+            output = pickle.load(f)
+        print(f'stage <{name}> unchanged, loaded from the cache')
+        return(output, key)
+
+    output = func(*args, **params)
+
+    # write to a temporary file first so an interrupted run can't leave a broken cache entry behind
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(output, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+    # only keep the latest output of each stage
+    for old_file in os.listdir(CACHE_DIR):
+        if old_file.endswith('.pkl') and old_file.rsplit('-', 1)[0] == name and old_file != os.path.basename(path):
+            os.remove(os.path.join(CACHE_DIR, old_file))
+
+    print(f'stage <{name}> executed and cached')
+
+    return(output, key)
+
+# %%
+if __name__ == "__main__":
+    run_stage
@@ -0,0 +1,116 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+from countrynamefix import CountryResolver
+
+# %% [markdown]
+# ### Steel emissions by production route
+# A steel plant's CO2 is the sum over its production routes (BOF, EAF, DRI, ...) of its capacity on the route (ttpa)
+# times the emissions intensity (tCO2/t steel) and the capacity utilization rate of the route in its country.
+# The route columns of the three tables are matched to the routes once, the intensities and utilization rates are held as
+# (country x route) matrices, and the CO2 of every plant is one row-wise dot product of the (plant x route) capacity matrix with
+# the (intensity * utilization) row of the plant's country.
+# Countries without weights get the fallback row: the mean intensity times the mean utilization of each route over the countries
+# which have them.
+
+# %%
+# the keywords naming each production route in the column names of the steel data and the weight files
+ROUTES = ['crude', 'BOF', 'EAF', 'OHF', 'Iron', 'BF', 'DRI', 'Ferronickel', 'Sinter plant', 'Coking plant', 'Pelletizing']
+
+# %%
+# the first column of columns naming the route and holding all of the given words, or None
+def route_col(columns, route, words):
+    return(next((col for col in columns if route in col and all(word in col for word in words)), None))
+
+# map every route to its (intensity, utilization, capacity) columns
+# a route missing any of its 3 columns is left out, it can't be weighted
+def resolve_routes(intensity_cols, utilization_cols, capacity_cols, routes = ROUTES):
+
+    mapping = {}
+    for route in routes:
+        cols = (route_col(intensity_cols, route, ['emissions intensity']), route_col(utilization_cols, route, ['capacity', 'per annum']),
+                route_col(capacity_cols, route, ['(ttpa)']))
+        if None not in cols:
+            mapping[route] = cols
+
+    return(mapping)
+
+# %%
+# the capacities of the plants on each route as a (plant x route) matrix, in ttpa
+# the GEM values are strings, ' ', 'unknown', '>0' and missing values count as 1 ttpa, like 0 does,
+# so a plant known to produce on a route never drops out of it
+def capacity_matrix(steel, capacity_cols):
+
+    capacity = np.empty((len(steel), len(capacity_cols)))
+    for j, col in enumerate(capacity_cols):
+        values = pd.to_numeric(steel[col].astype(str).str.replace(',', '').str.strip(), errors = 'coerce').to_numpy(dtype = float)
+        values[np.isnan(values) | (values == 0)] = 1
+        capacity[:, j] = values
+
+    return(capacity)
+
+# %%
+class SteelEmissions:
+
+    def __init__(self, countries, routes, intensity, utilization, capacity_cols):
+        # the countries of the weight tables, row i of the matrices is country i
+        self.countries = pd.Index(countries)
+        # the routes, with the capacity column of the steel data each is read from
+        self.routes = list(routes)
+        self.capacity_cols = list(capacity_cols)
+        # (country x route) emissions intensities and utilization rates
+        # a missing weight of a country is the mean of its route, and a weight of 0 counts as 1 so no route is ever zeroed out
+        self.intensity = self.fill(intensity)
+        self.utilization = self.fill(utilization)
+        # tCO2 per tonne of capacity on each route, in every country, with the fallback row for countries without weights last
+        self.fallback = self.intensity.mean(axis = 0) * self.utilization.mean(axis = 0)
+        self.weights = np.vstack([self.intensity * self.utilization, self.fallback])
+
+    @staticmethod
+    def fill(matrix):
+        matrix = np.array(matrix, dtype = float)
+        matrix = np.where(np.isnan(matrix), np.nanmean(matrix, axis = 0), matrix)
+        matrix[matrix == 0] = 1
+        return(matrix)
+
+    # build the engine from the weight files and the columns of the raw steel data
+    # the weight tables spell their countries the way the plant data (already run through countrynamefix) does,
+    # names the resolver doesn't know are kept as they are
+    @classmethod
+    def from_files(cls, steel_cols, intensity_path = 'data/emit_int_weights.csv', utilization_path = 'data/utilization_rt_weights.csv'):
+
+        intensity = pd.read_csv(intensity_path, index_col = 0).astype(float)
+        utilization = pd.read_csv(utilization_path, index_col = 0).astype(float)
+
+        resolver = CountryResolver.load()
+        for weights in [intensity, utilization]:
+            weights.index = resolver.resolve(pd.Series(weights.index)).fillna(pd.Series(weights.index)).to_numpy()
+
+        mapping = resolve_routes(intensity.columns, utilization.columns, steel_cols)
+        int_cols, util_cols, cap_cols = [[cols[i] for cols in mapping.values()] for i in range(3)]
+
+        # the countries of either table, a country only in one of them gets the mean weight for the other
+        countries = pd.Index(intensity.index).append(pd.Index(utilization.index)).drop_duplicates()
+        return(cls(countries, mapping, intensity[int_cols].groupby(level = 0).first().reindex(countries).to_numpy(),
+                   utilization[util_cols].groupby(level = 0).first().reindex(countries).to_numpy(), cap_cols))
+
+    # the row of the weight matrix for each plant's country, -1 (the fallback row) for countries without weights
+    def country_rows(self, plant_countries):
+        return(self.countries.get_indexer(pd.Series(plant_countries, dtype = object)))
+
+    # the CO2 of every plant in Mt/yr
+    # the capacities are in ttpa, so tCO2 per year is capacity * 1000 * weight, divided by 1,000,000 to get MtCO2/yr
+    def plant_co2(self, steel, plant_countries):
+
+        capacity = capacity_matrix(steel, self.capacity_cols)
+        rows = self.country_rows(plant_countries)
+
+        co2 = np.einsum('pr,pr->p', capacity, self.weights[rows]) * 1000 / 1000000
+
+        return(co2, int(np.sum(rows == -1)))
+
+# %%
+if __name__ == "__main__":
+    SteelEmissions
+    resolve_routes
@@ -0,0 +1,239 @@
+# %%
+# import libraries
+import pandas as pd
+import numpy as np
+import json
+import os
+import re
+
+# %% [markdown]
+# ### Year-indexed panel storage
+# The wide tables written by each stage bake the year into their column names (e.g. 'consid+commit.total.2057').
+# A panel is stored instead as a directory holding:
+# - values.npy: a typed (row x metric x year) array, NaN where a metric has no column for a year
+# - one .npy file per key column (country, region, SSP, RCP, ...), as categorical codes for text columns
+# - meta.json: the metrics, years, key categories, and the original column order, so the wide df can be rebuilt exactly
+# The .npy files are memory-mapped on load, so reading one metric or a range of years only touches those bytes.
+# Panels can be saved as float32 to halve their size, or compressed (mostly zero tables shrink a lot) at the cost of the memory map.
+
+# %%
+# a column belongs to the year block if its name ends in a 4 digit year, e.g. 'coal.operating.2030' or '2030'
+YEAR_COL = re.compile(r'^(?:(?P<metric>.*)\.)?(?P<year>\d{4})$')
+
+# %%
+# split column names into (metric, year) pairs, with None for the columns which aren't year columns
+# the scenario columns are only named by their year, so their metric is ''
+def split_year_cols(columns):
+
+    parsed = []
+    for col in columns:
+        match = YEAR_COL.match(str(col))
+        parsed.append((match.group('metric') or '', int(match.group('year'))) if match else None)
+
+    return(parsed)
+
+# %%
+# list the columns of one metric (e.g. 'expectable' or 'consid+commit.total') in year order, optionally only for some years
+def year_cols(columns, metric, years = None):
+
+    cols = [(parsed[1], col) for col, parsed in zip(columns, split_year_cols(columns)) if parsed is not None and parsed[0] == metric]
+
+    if years is not None:
+        keep = set(years)
+        cols = [(yr, col) for yr, col in cols if yr in keep]
+
+    return([col for yr, col in sorted(cols)])
+
+# %%
+# json can't hold numpy scalars, so turn the category values back into plain python ones
+def to_json_value(value):
+    return(value.item() if isinstance(value, np.generic) else value)
+
+# %%
+# the year columns of a wide df as one (row x metric x year) array, with the metrics and years along its axes
+# cells holds the [metric, year] slot of every column, None for the key columns
+def panel_block(df, dtype = 'float64'):
+
+    # sort the columns into the numeric year block and the key columns
+    parsed = split_year_cols(df.columns)
+    is_year = [p is not None and pd.api.types.is_numeric_dtype(df[col]) for col, p in zip(df.columns, parsed)]
+
+    year_cells = [p for p, year in zip(parsed, is_year) if year]
+    metrics = list(dict.fromkeys(metric for metric, yr in year_cells))
+    years = sorted(set(yr for metric, yr in year_cells))
+
+    # write every year column into its (metric, year) slot of one preallocated array
+    metric_idx = {metric: i for i, metric in enumerate(metrics)}
+    year_idx = {yr: i for i, yr in enumerate(years)}
+
+    values = np.full((len(df), len(metrics), len(years)), np.nan, dtype = dtype)
+    cells = []
+
+    for col, p, year in zip(df.columns, parsed, is_year):
+        if year:
+            m, y = metric_idx[p[0]], year_idx[p[1]]
+            values[:, m, y] = df[col].to_numpy(dtype = dtype)
+            cells.append([m, y])
+        else:
+            cells.append(None)
+
+    return(values, metrics, years, cells)
+
+# %%
+def save_panel(df, path, dtype = 'float64', compress = False):
+
+    os.makedirs(path, exist_ok = True)
+    values, metrics, years, cells = panel_block(df, dtype)
+    is_year = [cell is not None for cell in cells]
+
+    # remove the values written by an earlier save in the other format, so the panel can't be read from a stale file
+    for old_file in ['values.npy', 'values.npz']:
+        if os.path.exists(os.path.join(path, old_file)):
+            os.remove(os.path.join(path, old_file))
+
+    if compress:
+        np.savez_compressed(os.path.join(path, 'values.npz'), values = values)
+    else:
+        np.save(os.path.join(path, 'values.npy'), values)
+
+    # key columns: text (and mixed) columns become categorical codes, numeric ones are stored as they are
+    keys = []
+    for i, (col, year) in enumerate(zip(df.columns, is_year)):
+        if year:
+            continue
+
+        key_file = f'key_{i}.npy'
+
+        if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            np.save(os.path.join(path, key_file), df[col].to_numpy())
+            keys.append({'column': str(col), 'kind': 'numeric', 'file': key_file})
+        elif isinstance(df[col].dtype, pd.CategoricalDtype):
+            # typed keys (e.g. SSP and RCP) keep all their categories and their order, so they load back with the same dtype
+            np.save(os.path.join(path, key_file), df[col].cat.codes.to_numpy().astype(np.int32))
+            keys.append({'column': str(col), 'kind': 'categorical', 'file': key_file, 'categories': [to_json_value(c) for c in df[col].cat.categories],
+                         'ordered': bool(df[col].cat.ordered)})
+        else:
+            codes, categories = pd.factorize(df[col])
+            np.save(os.path.join(path, key_file), codes.astype(np.int32))
+            keys.append({'column': str(col), 'kind': 'categorical', 'file': key_file, 'categories': [to_json_value(c) for c in categories]})
+
+    meta = {'columns': [str(col) for col in df.columns], 'cells': cells, 'metrics': metrics, 'years': years, 'keys': keys, 
+            'dtype': str(values.dtype), 'compressed': compress}
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return(path)
+
+# %%
+def read_panel_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return(json.load(f))
+
+# %%
+# load the key columns (country, region, SSP, RCP, ...) of a panel as a df
+def load_panel_keys(path, meta = None):
+
+    meta = meta or read_panel_meta(path)
+    keys = {}
+
+    for key in meta['keys']:
+        data = np.load(os.path.join(path, key['file']), allow_pickle = False)
+
+        if key['kind'] == 'categorical' and 'ordered' in key:
+            keys[key['column']] = pd.Categorical.from_codes(data, categories = pd.Index(key['categories'], dtype = object), ordered = key['ordered'])
+        elif key['kind'] == 'categorical':
+            keys[key['column']] = pd.Categorical.from_codes(data, categories = pd.Index(key['categories'], dtype = object)).astype(object)
+        else:
+            keys[key['column']] = data
+
+    return(pd.DataFrame(keys))
+
+# %%
+# load the (row x metric x year) array of a panel, optionally only some metrics and a range of years
+# with mmap = True the file isn't read up front, only the selected slices are paged in (compressed panels are always read whole)
+def load_panel_values(path, metrics = None, years = None, mmap = True, meta = None):
+
+    meta = meta or read_panel_meta(path)
+
+    if meta.get('compressed'):
+        values = np.load(os.path.join(path, 'values.npz'))['values']
+    else:
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode = 'r' if mmap else None)
+
+    metric_sel = list(range(len(meta['metrics']))) if metrics is None else [meta['metrics'].index(m) for m in metrics]
+
+    # years can be a (first, last) range, inclusive, or None for all of them
+    all_yrs = np.asarray(meta['years'])
+    year_sel = np.ones(len(all_yrs), dtype = bool) if years is None else (all_yrs >= years[0]) & (all_yrs <= years[1])
+    year_sel = np.flatnonzero(year_sel)
+
+    # a slice of the contiguous year axis keeps the selection a view into the memory map
+    if len(year_sel) and np.all(np.diff(year_sel) == 1):
+        year_sel = slice(year_sel[0], year_sel[-1] + 1)
+
+    selected = values[:, metric_sel][:, :, year_sel] if metrics is not None else values[:, :, year_sel]
+
+    return([meta['metrics'][m] for m in metric_sel], all_yrs[year_sel].tolist(), selected)
+
+# %%
+# load a panel back into the wide df format the rest of the pipeline uses
+# with no metrics or years given this rebuilds the saved df exactly, column order included
+def load_panel(path, metrics = None, years = None, mmap = True):
+
+    meta = read_panel_meta(path)
+    keys = load_panel_keys(path, meta)
+    metric_names, yrs, values = load_panel_values(path, metrics, years, mmap, meta)
+
+    metric_pos = {metric: i for i, metric in enumerate(metric_names)}
+    year_pos = {yr: i for i, yr in enumerate(yrs)}
+
+    # rebuild the columns in their saved order, skipping the (metric, year) cells which weren't selected
+    cols = {}
+    for col, cell in zip(meta['columns'], meta['cells']):
+        if cell is None:
+            cols[col] = keys[col]
+            continue
+
+        metric, yr = meta['metrics'][cell[0]], meta['years'][cell[1]]
+        if metric in metric_pos and yr in year_pos:
+            cols[col] = values[:, metric_pos[metric], year_pos[yr]]
+
+    return(pd.DataFrame(cols))
+
+# %% [markdown]
+# ### Compact panels in memory
+# The master file's emissions can also be held in memory in the panel layout: one contiguous float32 (row x metric x year) block
+# with categorical key columns, about half the size of the float64 wide df. compact_view gives the wide df the rest of the pipeline
+# reads as a view over the block, without copying it.
+
+# %%
+def compact_frame(df, dtype = 'float32'):
+
+    values, metrics, years, cells = panel_block(df, dtype)
+
+    keys = df[[col for col, cell in zip(df.columns, cells) if cell is None]].reset_index(drop = True)
+    for col in keys.columns:
+        if not isinstance(keys[col].dtype, pd.CategoricalDtype) and not pd.api.types.is_numeric_dtype(keys[col]):
+            keys[col] = keys[col].astype('category')
+
+    return({'keys': keys, 'values': values, 'metrics': metrics, 'years': years})
+
+# %%
+# the wide df over a compact panel, the year columns (named like the master file's, metric by metric) are a view of the block
+def compact_view(panel):
+
+    n_rows, n_metrics, n_years = panel['values'].shape
+    cols = [f'{metric}.{yr}' if metric else str(yr) for metric in panel['metrics'] for yr in panel['years']]
+
+    view = pd.DataFrame(panel['values'].reshape(n_rows, n_metrics * n_years), columns = cols, copy = False)
+    for i, col in enumerate(panel['keys'].columns):
+        view.insert(i, col, panel['keys'][col].values)
+
+    return(view)
+
+# %%
+if __name__ == "__main__":
+    save_panel
+    load_panel
+    compact_frame
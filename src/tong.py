@@ -1,5 +1,6 @@
 # %%
 import pandas as pd
+from storage import save_panel
 
 # %%
 def clean_tong(tong_cntry_fix):
@@ -27,6 +28,7 @@ def clean_tong(tong_cntry_fix):
 
     # write the cleaned plotting formatted data to a csv
     pivoted_data.to_csv('data/tong_country_sector_CO2.csv')
+    save_panel(pivoted_data, 'data/tong_country_sector_CO2')
 
     # test that this function worked
     print('Tong data pivoted and written to a panel data CSV <tong_country_sector_CO2>')    
@@ -0,0 +1,5 @@
+# the src modules import each other by their flat names, like when the pipeline runs from src/
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from clean_gem import parse_year_field, resolve_year, clean_gas_starts
+
+
+# retirement years past the modelled years are still years, not junk filled with start + 40
+def test_retirement_years_from_2100_on_are_kept():
+    parsed = parse_year_field(pd.Series(['2100', '2105', '2100.0', 2150.0], dtype = object))
+
+    assert list(parsed['parse_rule']) == ['year'] * 4
+    assert list(resolve_year(parsed, 'retire')) == [2100, 2105, 2100, 2150]
+
+
+# values mixing a range and a list are junk, their start and retirement years are imputed
+def test_mixed_year_fields_are_junk():
+    parsed = parse_year_field(pd.Series(['2000-2005, 2010', '2010, 2015-2020']))
+
+    assert list(parsed['parse_rule']) == ['junk', 'junk']
+    assert np.isnan(resolve_year(parsed, 'start')).all()
+
+
+# the retirement year of a gas comma list is its second year (the closing year), not the last one
+def test_gas_list_retires_in_its_second_year():
+    gas = pd.DataFrame({'Start year': ['2000, 2010, 2040', '1995, 2030', '2012'], 'Planned retire': [2005, 2045, 2050]})
+
+    cleaned = clean_gas_starts(gas)
+
+    assert list(cleaned['Start year'].astype(float)) == [2000, 1995, 2012]
+    assert list(cleaned['Planned retire'].astype(float)) == [2010, 2045, 2050]
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+import ensemble
+from ensemble import sample_credences, make_ensemble
+
+
+# the mean sample weights the scenarios by the raw Central credences, like the expectations, even when they don't sum to 1
+def test_sampled_credences_keep_the_raw_weights():
+    central = np.array([0.2, 0.3, 0.1])
+    weights = sample_credences(central, 20000, 20, 0)
+
+    np.testing.assert_allclose(weights.sum(axis = 1), central.sum())
+    np.testing.assert_allclose(weights.mean(axis = 0), central, atol = 0.005)
+
+
+# the steel plants only go into the ensemble when asked for, like into the master file
+def test_steel_only_included_when_asked_for(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+
+    given = []
+    monkeypatch.setattr(ensemble, 'run_ensemble', lambda plants, *args, **kwargs: given.append(list(plants)) or pd.DataFrame({'country': ['A']}))
+
+    plants = pd.DataFrame({'country': ['A']})
+    make_ensemble(plants, plants, plants, None, None)
+    make_ensemble(plants, plants, plants, None, None, include_steel = True)
+
+    assert given == [['gas', 'coal'], ['gas', 'coal', 'steel']]
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from rcp_ssp import parse_scenarios, unknown_rcp, clean_scen_CO2
+
+
+# RCP codes outside the categories are left missing rather than relabelled as the baseline
+def test_unknown_rcp_codes_are_not_baseline():
+    parsed = parse_scenarios(['SSP119IMAGE', 'SSP370IMAGE', 'SSP585REMIND', 'SSP1BLIMAGE', 'HISTORY'])
+
+    assert list(parsed['RCP'].astype(object).iloc[[0, 3]]) == [1.9, 'BL']
+    assert parsed['RCP'].iloc[[1, 2, 4]].isna().all()
+    assert list(unknown_rcp(parsed)) == [False, True, True, False, False]
+
+
+# the rows of scenarios with an unknown RCP are dropped and counted, the baseline keeps only its own rows (in Mt)
+def test_clean_scen_drops_unknown_rcps(tmp_path, monkeypatch, capsys):
+    # the cleaned scenarios are written to data/
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+
+    years = {str(yr): [1.0, 2.0, 100.0] for yr in range(2021, 2101)}
+    scen = pd.DataFrame({'entity': 'KYOTOGHGAR4', 'source': 'PMSSPBIE', 'country.name.en': 'A',
+                         'scenario': ['SSP3BLIMAGE', 'SSP3BLREMIND', 'SSP370IMAGE'], **years})
+
+    clean = clean_scen_CO2(scen)
+
+    assert '1 rows of scenarios with an unknown RCP code were dropped' in capsys.readouterr().out
+    assert list(clean['RCP'].astype(object)) == ['BL']
+    np.testing.assert_allclose(clean['2050'], 1.5 / 1000)
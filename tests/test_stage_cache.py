@@ -0,0 +1,34 @@
+import stage_cache
+from stage_cache import run_stage
+
+
+def double(x):
+    return(2 * x)
+
+
+# forcing a stage reruns the stages taking its key upstream, without rerunning the ones beside it
+def test_force_reaches_downstream_stages(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(stage_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(stage_cache, 'FORCED_KEYS', set())
+
+    def pipeline(force):
+        a, a_key = run_stage('a', double, args = (1,), force = force)
+        b, b_key = run_stage('b', double, args = (a,), upstream = [a_key], force = force)
+        run_stage('c', double, args = (b,), upstream = [b_key], force = force)
+        run_stage('d', double, args = (3,), force = force)
+        return(capsys.readouterr().out)
+
+    assert pipeline(set()).count('executed') == 4
+    out = pipeline({'a'})
+    assert '<a> executed' in out and '<b> executed' in out and '<c> executed' in out
+    assert '<d> unchanged' in out
+
+
+# the code version covers every module in src/, not only the one defining the stage's function
+def test_code_hash_covers_src(tmp_path, monkeypatch):
+    (tmp_path / 'helper.py').write_text('x = 1\n')
+    monkeypatch.setattr(stage_cache, 'SRC_DIR', str(tmp_path))
+    before = stage_cache.code_hash(double)
+
+    (tmp_path / 'helper.py').write_text('x = 20\n')
+    assert stage_cache.code_hash(double) != before